@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the server CPU time spent per million rows by COPY CSV and COPY BINARY
+on a typed table.
+
+The backend CPU time is read from /proc, the server must run on this host:
+
+    PGPASSWORD=test PYTHONPATH=. python benchmarks/bench_binary.py \
+        --host localhost --port 25432 --dbname test --username test --rows 1000000
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+import psycopg2
+
+from csv2pg.main import copy_to
+
+
+COLUMNS = "id,amount,day,created_at,flag,label"
+TYPES = "id BIGINT, amount NUMERIC, day DATE, created_at TIMESTAMP, flag BOOLEAN, label TEXT"
+
+
+def generate(filepath, rows):
+    random.seed(0)
+    start = datetime.datetime(2020, 1, 1)
+    with open(filepath, "w") as f:
+        f.write(COLUMNS + "\n")
+        for i in range(rows):
+            ts = start + datetime.timedelta(seconds=random.randint(0, 10 ** 8))
+            f.write(
+                "{},{:.2f},{},{},{},label {}\n".format(
+                    i,
+                    random.uniform(-1e6, 1e6),
+                    ts.date().isoformat(),
+                    ts.isoformat(sep=" "),
+                    random.choice(["true", "false"]),
+                    random.randint(0, 1000),
+                )
+            )
+
+
+def postmaster_pid(dsn):
+    with psycopg2.connect(dsn) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            backend = cursor.fetchone()[0]
+    return int(_proc_stat(backend)[1])
+
+
+def children_cpu(pid):
+    """
+    CPU time of the exited children of a local process (the postgres backends
+    once the postmaster reaped them), in seconds
+    """
+    fields = _proc_stat(pid)
+    return (int(fields[13]) + int(fields[14])) / os.sysconf("SC_CLK_TCK")
+
+
+def _proc_stat(pid):
+    with open("/proc/{}/stat".format(pid)) as f:
+        return f.read().rsplit(")", 1)[1].split()
+
+
+def bench(args, filepath, binary):
+    dsn = "host={} port={} dbname={} user={} password={}".format(
+        args.host, args.port, args.dbname, args.username, args.password
+    )
+    with psycopg2.connect(dsn) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS bench_binary")
+            cursor.execute("CREATE UNLOGGED TABLE bench_binary ({})".format(TYPES))
+    postmaster = postmaster_pid(dsn)
+
+    time.sleep(1)
+    before = children_cpu(postmaster)
+    start = time.perf_counter()
+    copy_to(
+        args.host,
+        args.port,
+        args.dbname,
+        args.username,
+        args.password,
+        "bench_binary",
+        filepath,
+        lineterminator="\n",
+        binary=binary,
+    )
+    wall = time.perf_counter() - start
+    time.sleep(1)  # let the postmaster reap the backends
+    return wall, children_cpu(postmaster) - before
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--dbname", default=os.getenv("PGDATABASE", "postgres"))
+    parser.add_argument("--username", default=os.getenv("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.getenv("PGPASSWORD"))
+    parser.add_argument("--rows", type=int, default=1000000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath = os.path.join(tmp, "bench_binary.csv")
+        generate(filepath, args.rows)
+        for name, binary in (("csv", False), ("binary", True)):
+            wall, server = bench(args, filepath, binary)
+            print(
+                "{:<8} wall {:>7.2f}s  server cpu {:>7.2f}s/M rows".format(
+                    name, wall, server * 10 ** 6 / args.rows
+                )
+            )
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the throughput of copy_to on a synthetic csv file, with and without
+the options doing work per row.
+
+Each case loads the file in its own process and reports rows/s, MB/s, the
+peak RSS of the process (and of its workers) and its overhead compared to the
+first case. Against a local postgres:
+
+    PGPASSWORD=test PYTHONPATH=. python benchmarks/bench_load.py \
+        --host localhost --port 25432 --dbname test --username test \
+        --size 100 --quoted 0.2 --errors 0.01 --output results.json
+
+With --sink, the COPY stream is read and discarded on the client instead, to
+measure csv2pg alone: the options querying the table, like --binary and
+--server-inject, are not supported and their cases are skipped. --compare
+reports the change of rows/s from a previous output and exits with an error
+when a case slowed down by more than --threshold.
+
+--asset scales up a test asset instead, like the multibyte encoding ones,
+whose --encoding must be given. The transcode cases decode and encode the
+rows in python, as with a client_encoding other than the file encoding:
+
+    PGPASSWORD=test PYTHONPATH=. python benchmarks/bench_load.py \
+        --host localhost --port 25432 --dbname test --username test \
+        --size 100 --asset tests/assets/encoding_GB18030.csv --encoding gb18030 \
+        --cases baseline,transcode
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg2
+import psycopg2.pool
+from generate import add_arguments, generate, generate_options, scale
+
+from csv2pg import __version__
+from csv2pg.main import copy_to
+
+
+TABLE = "bench_load"
+CASES = {
+    "baseline": {},
+    "rownum": {"inject_rownum": True},
+    "filename": {"inject_filename": True},
+    "skip_error": {"skip_error": True},
+    "all": {"inject_rownum": True, "inject_filename": True, "skip_error": True},
+    "arrow": {"skip_error": True, "engine": "arrow"},
+    "transcode": {"connection_options": {"client_encoding": "UTF8"}},
+    "inject": {"inject_rownum": True, "inject_filename": True},
+    "server_inject": {
+        "inject_rownum": True,
+        "inject_filename": True,
+        "server_inject": True,
+    },
+}
+SERVER_CASES = {"server_inject"}  # cases querying the table, not run with --sink
+
+
+class SinkPool:
+    """
+    Stand-in for psycopg2.pool.ThreadedConnectionPool whose connections read
+    the COPY stream and discard it
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        pass
+
+    def getconn(self):
+        return SinkConnection()
+
+    def putconn(self, connection):
+        pass
+
+    def closeall(self):
+        pass
+
+
+class SinkConnection:
+    encoding = "UTF8"
+
+    def __init__(self):
+        self.notices = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def cursor(self):
+        return SinkCursor(self)
+
+    def get_parameter_status(self, parameter):
+        return "sink"
+
+
+class SinkCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.query = b""
+        self.rowcount = -1
+        self.statusmessage = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql, params=None):
+        self.query = sql.encode()
+        self.statusmessage = sql.split(None, 1)[0]
+
+    def fetchone(self):
+        return {"exists": False}
+
+    def copy_expert(self, sql, f, size=8192):
+        self.query = sql.encode()
+        self.rowcount = 0
+        while True:
+            data = f.read(size)
+            if not data:
+                break
+            self.rowcount += data.count(b"\n")
+
+
+def run_case(args, filepath, options):
+    """
+    Load filepath with options in the current process, return the wall time
+    and the peak RSS in bytes
+    """
+    if args.sink:
+        psycopg2.pool.ThreadedConnectionPool = SinkPool
+    start = time.perf_counter()
+    copy_to(
+        args.host,
+        args.port,
+        args.dbname,
+        args.username,
+        args.password,
+        TABLE,
+        filepath,
+        delimiter=args.delimiter,
+        quotechar=args.quotechar,
+        escapechar=args.escapechar,
+        encoding=args.encoding,
+        overwrite=True,
+        unlogged=True,
+        **options,
+    )
+    elapsed = time.perf_counter() - start
+    rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return elapsed, rss * 1024  # ru_maxrss is in KB on linux
+
+
+def bench(args, filepath, stats, options):
+    """
+    Best of args.repeat loads, each in a new process
+    """
+    runs = []
+    for _ in range(args.repeat):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            runs.append(executor.submit(run_case, args, filepath, options).result())
+    elapsed = min(elapsed for elapsed, _ in runs)
+    return {
+        "seconds": elapsed,
+        "rows_per_s": stats["rows"] / elapsed,
+        "mb_per_s": stats["bytes"] / 2 ** 20 / elapsed,
+        "peak_rss_mb": max(rss for _, rss in runs) / 2 ** 20,
+    }
+
+
+def compare(results, previous, threshold):
+    """
+    Print the change of rows/s of each case from a previous output, return the
+    names of the cases slower by more than threshold
+    """
+    before = {result["case"]: result for result in previous["results"]}
+    regressions = []
+    for result in results:
+        if result["case"] not in before:
+            continue
+        change = result["rows_per_s"] / before[result["case"]]["rows_per_s"] - 1
+        print("{:<12} {:>+8.1%} rows/s".format(result["case"], change))
+        if change < -threshold:
+            regressions.append(result["case"])
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--dbname", default=os.getenv("PGDATABASE", "postgres"))
+    parser.add_argument("--username", default=os.getenv("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.getenv("PGPASSWORD"))
+    parser.add_argument("--sink", action="store_true", help="discard the COPY")
+    parser.add_argument(
+        "--cases",
+        default=",".join(CASES),
+        help="comma separated cases among {}".format(", ".join(CASES)),
+    )
+    parser.add_argument("--jobs", type=int, default=1, help="--jobs of every case")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results as json")
+    parser.add_argument("--compare", help="json output of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.rows is None and args.size is None:
+        args.rows = 100000
+    names = args.cases.split(",")
+    unknown = set(names) - set(CASES)
+    if unknown:
+        parser.error("unknown cases {}".format(", ".join(sorted(unknown))))
+    if args.sink and SERVER_CASES.intersection(names):
+        print(
+            "Skipping {} with --sink".format(
+                ", ".join(name for name in names if name in SERVER_CASES)
+            )
+        )
+        names = [name for name in names if name not in SERVER_CASES]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # COPY fails on invalid rows without --skip-error: they get a clean file
+        files = {}
+        for skip_error in (False, True):
+            options = generate_options(args)
+            if not skip_error:
+                options["errors"] = 0.0
+            filepath = os.path.join(tmp, "bench_load_{:d}.csv".format(skip_error))
+            if args.asset:
+                stats = scale(
+                    args.asset, filepath, rows=options["rows"], size=options["size"]
+                )
+            else:
+                stats = generate(filepath, **options)
+            files[skip_error] = (filepath, stats)
+            print(
+                "{rows} rows ({invalid} invalid), {mb:.1f} MB".format(
+                    mb=stats["bytes"] / 2 ** 20, **stats
+                )
+            )
+        results = []
+        for name in names:
+            options = dict(CASES[name], jobs=args.jobs)
+            filepath, stats = files[bool(options.get("skip_error"))]
+            result = dict(
+                case=name,
+                options=options,
+                invalid=stats["invalid"],
+                **bench(args, filepath, stats, options),
+            )
+            baseline = results[0]["seconds"] if results else result["seconds"]
+            result["overhead"] = result["seconds"] / baseline - 1
+            results.append(result)
+            print(
+                "{case:<12} {rows_per_s:>10.0f} rows/s {mb_per_s:>8.1f} MB/s "
+                "{peak_rss_mb:>8.1f} MB RSS {overhead:>+8.1%}".format(**result)
+            )
+
+    report = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "version": __version__,
+        "python": platform.python_version(),
+        "target": "sink" if args.sink else "postgres",
+        "file": dict(
+            generate_options(args),
+            asset=args.asset,
+            rows=stats["rows"],
+            bytes=stats["bytes"],
+        ),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("Slower than {}: {}".format(args.compare, ", ".join(regressions)))
+            sys.exit(1)
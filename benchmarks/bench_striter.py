@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the readers wrapping the _wrap generator for copy_expert.
+
+    PYTHONPATH=. python benchmarks/bench_striter.py
+"""
+import time
+
+from csv2pg.main import COPY_BUFFER
+from csv2pg.striter import BytesIteratorIO, StringIteratorIO
+
+
+CASES = [
+    # (name, row size in chars, number of rows)
+    ("short rows", 100, 500000),
+    ("2MB rows", 2 * 2 ** 20, 16),
+]
+
+
+def _rows(size, count):
+    row = "x" * (size - 1) + "\n"
+    for _ in range(count):
+        yield row
+
+
+def _drain(reader, size=COPY_BUFFER):
+    while reader.read(size):
+        pass
+
+
+def bench(name, factory, size, count):
+    start = time.perf_counter()
+    _drain(factory(_rows(size, count)))
+    elapsed = time.perf_counter() - start
+    mb = size * count / 2 ** 20
+    print("{:<12} {:<16} {:>10.1f} MB/s".format(name, factory.__name__, mb / elapsed))
+
+
+if __name__ == "__main__":
+    for name, size, count in CASES:
+        for factory in (StringIteratorIO, BytesIteratorIO):
+            bench(name, factory, size, count)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the --skip-error validation on a single core: rows/s of
+check_records on synthetic files, with and without quoted fields.
+
+    PYTHONPATH=. python benchmarks/bench_validate.py --size 20
+"""
+import argparse
+import csv
+import io
+import os
+import tempfile
+import time
+
+from generate import generate
+
+from csv2pg.engines import check_records
+
+
+CASES = [
+    # (name, ratio of quoted fields)
+    ("unquoted", 0.0),
+    ("quoted", 0.2),
+]
+
+
+def _dialect():
+    dialect = csv.Dialect
+    dialect.delimiter = ","
+    dialect.quotechar = '"'
+    dialect.doublequote = "False"
+    dialect.escapechar = "\\"
+    dialect.lineterminator = "\r\n"
+    dialect.quoting = csv.QUOTE_MINIMAL
+    dialect.skipinitialspace = True
+    return dialect
+
+
+def bench(filepath, columns, repeat):
+    """
+    Best time of `repeat` validations of filepath, and the numbers of valid
+    and rejected records
+    """
+    expected_columns = ["column_{}".format(i) for i in range(columns)]
+    elapsed = None
+    for _ in range(repeat):
+        with io.open(filepath, encoding="utf-8") as f_in, io.StringIO() as f_err:
+            start = time.perf_counter()
+            valid = sum(
+                1
+                for _ in check_records(
+                    f_in, f_err, _dialect(), True, expected_columns, filepath
+                )
+            )
+            run = time.perf_counter() - start
+            rejected = f_err.getvalue().count("Exception:")
+        elapsed = run if elapsed is None else min(elapsed, run)
+    return elapsed, valid, rejected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=float, default=20, help="size in MB")
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--errors", type=float, default=0.01)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, quoted in CASES:
+            filepath = os.path.join(tmp, "bench_validate.csv")
+            stats = generate(
+                filepath,
+                size=int(args.size * 2 ** 20),
+                columns=args.columns,
+                quoted=quoted,
+                errors=args.errors,
+            )
+            elapsed, valid, rejected = bench(filepath, args.columns, args.repeat)
+            print(
+                "{:<10} {:>10.0f} rows/s  {} valid, {} rejected ({} invalid)".format(
+                    name, stats["rows"] / elapsed, valid, rejected, stats["invalid"]
+                )
+            )
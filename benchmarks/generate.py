@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Generate a synthetic csv file of a given number of rows or size.
+
+The quoting density, the encoding (multibyte like the GB18030 test asset), the
+dialect and the ratio of invalid rows are configurable:
+
+    python benchmarks/generate.py data.csv --size 100 --columns 20 \
+        --quoted 0.2 --errors 0.01 --encoding gb18030
+
+or scale up a test asset, repeating its records after its header:
+
+    python benchmarks/generate.py data.csv --size 100 \
+        --asset tests/assets/encoding_ISO_8859_1.csv
+"""
+
+import argparse
+import io
+import random
+
+
+WORDS = [
+    "alpha",
+    "bravo",
+    "charlie",
+    "delta",
+    "echo",
+    "1234",
+    "3.1415",
+    "2020-08-13",
+    "Zoë",
+    "crème brûlée",
+    "Ærøskøbing",
+    "数据",
+    "北京市",
+    "ｃｓｖ",
+]
+# kinds of invalid rows, rejected by --skip-error
+ERRORS = ["missing", "extra", "dialect"]
+
+
+def generate(
+    filepath,
+    rows=None,
+    size=None,
+    columns=10,
+    quoted=0.1,
+    errors=0.0,
+    encoding="utf-8",
+    delimiter=",",
+    quotechar='"',
+    escapechar="\\",
+    lineterminator="\n",
+    header=True,
+    seed=0,
+):
+    """
+    Write a csv file of `rows` records or of at least `size` bytes. A ratio
+    `quoted` of the fields are quoted, some of them holding a delimiter, a
+    quote or a newline, and a ratio `errors` of the records are invalid.
+    Return the numbers of rows, invalid rows and bytes written.
+    """
+    if rows is None and size is None:
+        raise ValueError("rows or size is required")
+    rng = random.Random(seed)
+    words = [word for word in WORDS if _encodable(word, encoding)]
+    if escapechar and escapechar != quotechar:
+        escaped_quote = escapechar + quotechar
+    else:
+        escaped_quote = quotechar * 2
+    specials = [delimiter, escaped_quote, lineterminator]
+
+    def _field():
+        value = " ".join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+        if rng.random() >= quoted:
+            return value
+        if rng.random() < 0.5:
+            position = rng.randint(0, len(value))
+            value = value[:position] + rng.choice(specials) + value[position:]
+        return quotechar + value + quotechar
+
+    def _record():
+        fields = [_field() for _ in range(columns)]
+        if rng.random() >= errors:
+            return fields, False
+        kind = rng.choice(ERRORS)
+        if kind == "missing" and columns > 1:
+            fields.pop()
+        elif kind == "extra":
+            fields.append(_field())
+        else:
+            # a quote in an unquoted field
+            fields[rng.randrange(columns)] = "bad" + quotechar + "value"
+        return fields, True
+
+    written = invalid = size_written = 0
+    with io.open(filepath, "wb") as f:
+        if header:
+            line = delimiter.join("column_{}".format(i) for i in range(columns))
+            size_written += f.write((line + lineterminator).encode(encoding))
+        while (rows is None or written < rows) and (
+            size is None or size_written < size
+        ):
+            fields, error = _record()
+            line = delimiter.join(fields) + lineterminator
+            size_written += f.write(line.encode(encoding))
+            written += 1
+            invalid += error
+    return {"rows": written, "invalid": invalid, "bytes": size_written}
+
+
+def scale(asset, filepath, rows=None, size=None, header=True):
+    """
+    Write a csv file of `rows` records or of at least `size` bytes repeating
+    the records of asset, in its encoding and dialect. Return the numbers of
+    rows, invalid rows (0) and bytes written.
+    """
+    if rows is None and size is None:
+        raise ValueError("rows or size is required")
+    with io.open(asset, "rb") as f:
+        lines = f.read().splitlines(keepends=True)
+    if lines and not lines[-1].endswith(b"\n"):
+        lines[-1] += b"\n"
+    head, records = (lines[:1], lines[1:]) if header else ([], lines)
+    if not records:
+        raise ValueError("{} has no record to repeat".format(asset))
+
+    written = size_written = 0
+    with io.open(filepath, "wb") as f:
+        for line in head:
+            size_written += f.write(line)
+        while (rows is None or written < rows) and (
+            size is None or size_written < size
+        ):
+            size_written += f.write(records[written % len(records)])
+            written += 1
+    return {"rows": written, "invalid": 0, "bytes": size_written}
+
+
+def _encodable(text, encoding):
+    try:
+        text.encode(encoding)
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def add_arguments(parser):
+    parser.add_argument("--rows", type=int, help="number of records")
+    parser.add_argument("--size", type=float, help="minimum size in MB")
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument(
+        "--quoted", type=float, default=0.1, help="ratio of quoted fields"
+    )
+    parser.add_argument(
+        "--errors", type=float, default=0.0, help="ratio of invalid records"
+    )
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument("--delimiter", default=",")
+    parser.add_argument("--quotechar", default='"')
+    parser.add_argument("--escapechar", default="\\")
+    parser.add_argument("--lineterminator", default="\n")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--asset", help="repeat the records of this csv instead of random ones"
+    )
+
+
+def generate_options(args):
+    """
+    Keyword arguments of generate from the parsed command line
+    """
+    return dict(
+        rows=args.rows,
+        size=int(args.size * 2 ** 20) if args.size else None,
+        columns=args.columns,
+        quoted=args.quoted,
+        errors=args.errors,
+        encoding=args.encoding,
+        delimiter=args.delimiter,
+        quotechar=args.quotechar,
+        escapechar=args.escapechar,
+        lineterminator=args.lineterminator,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filepath")
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.rows is None and args.size is None:
+        parser.error("--rows or --size is required")
+    options = generate_options(args)
+    if args.asset:
+        print(
+            scale(args.asset, args.filepath, rows=options["rows"], size=options["size"])
+        )
+    else:
+        print(generate(args.filepath, **options))
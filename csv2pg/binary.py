@@ -0,0 +1,201 @@
+import datetime
+import decimal
+import struct
+
+
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+
+
+SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+HEADER = SIGNATURE + struct.pack("!ii", 0, 0)
+TRAILER = struct.pack("!h", -1)
+NULL = struct.pack("!i", -1)
+
+POSTGRES_EPOCH = datetime.datetime(2000, 1, 1)
+POSTGRES_EPOCH_DATE = POSTGRES_EPOCH.date().toordinal()
+_MICROSECOND = datetime.timedelta(microseconds=1)
+INFINITY = {"infinity": 2 ** 63 - 1, "-infinity": -(2 ** 63)}
+DATE_INFINITY = {"infinity": 2 ** 31 - 1, "-infinity": -(2 ** 31)}
+TRUE_VALUES = {"t", "true", "y", "yes", "on", "1"}
+FALSE_VALUES = {"f", "false", "n", "no", "off", "0"}
+
+NUMERIC_POS = 0x0000
+NUMERIC_NEG = 0x4000
+NUMERIC_NAN = 0xC000
+NUMERIC_PINF = 0xD000
+NUMERIC_NINF = 0xF000
+
+
+def binary_encoders(types, encoding="utf-8", timezone="UTC"):
+    """
+    Return a function encoding a field value to its COPY binary representation
+    for each postgres type name (as returned by format_type). Timestamps
+    without time zone stored in a timestamptz are read in `timezone`, the
+    session TimeZone.
+    Raise ValueError for unsupported types.
+    """
+    encoders = []
+    for type in types:
+        if type in TEXT_TYPES:
+            encoders.append(_text_encoder(encoding))
+        elif type == "timestamp with time zone":
+            encoders.append(_timestamptz_encoder(timezone))
+        elif type in ENCODERS:
+            encoders.append(ENCODERS[type])
+        else:
+            raise ValueError("Unsupported type {} for binary COPY".format(type))
+    return encoders
+
+
+def encode_row(values, encoders):
+    """
+    Encode a row of string values to a COPY binary tuple, None being NULL.
+    Raise (ValueError, field index) when a value can not be converted.
+    """
+    parts = [struct.pack("!h", len(values))]
+    for i, (value, encoder) in enumerate(zip(values, encoders)):
+        if value is None:
+            parts.append(NULL)
+            continue
+        try:
+            payload = encoder(value)
+        except (ValueError, ArithmeticError, OverflowError, struct.error) as e:
+            raise ValueError(str(e), i)
+        parts.append(struct.pack("!i", len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def _text_encoder(encoding):
+    def _text(value):
+        return value.encode(encoding)
+
+    return _text
+
+
+def _int2(value):
+    return struct.pack("!h", int(value))
+
+
+def _int4(value):
+    return struct.pack("!i", int(value))
+
+
+def _int8(value):
+    return struct.pack("!q", int(value))
+
+
+def _float4(value):
+    return struct.pack("!f", float(value))
+
+
+def _float8(value):
+    return struct.pack("!d", float(value))
+
+
+def _bool(value):
+    value = value.strip().lower()
+    if value in TRUE_VALUES:
+        return b"\x01"
+    if value in FALSE_VALUES:
+        return b"\x00"
+    raise ValueError("invalid boolean {}".format(repr(value)))
+
+
+def _date(value):
+    value = value.strip()
+    if value.lower() in DATE_INFINITY:
+        return struct.pack("!i", DATE_INFINITY[value.lower()])
+    days = datetime.date.fromisoformat(value).toordinal() - POSTGRES_EPOCH_DATE
+    return struct.pack("!i", days)
+
+
+def _timestamp(value):
+    value = value.strip()
+    if value.lower() in INFINITY:
+        return struct.pack("!q", INFINITY[value.lower()])
+    timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        raise ValueError("unexpected time zone in timestamp {}".format(repr(value)))
+    return struct.pack("!q", (timestamp - POSTGRES_EPOCH) // _MICROSECOND)
+
+
+def _timestamptz_encoder(timezone):
+    if timezone.upper() == "UTC":
+        tzinfo = datetime.timezone.utc
+    elif zoneinfo is None:
+        raise ValueError("Time zone {} requires python 3.9".format(timezone))
+    else:
+        try:
+            tzinfo = zoneinfo.ZoneInfo(timezone)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            raise ValueError("Unknown time zone {}".format(timezone))
+
+    def _timestamptz(value):
+        value = value.strip()
+        if value.lower() in INFINITY:
+            return struct.pack("!q", INFINITY[value.lower()])
+        timestamp = datetime.datetime.fromisoformat(value)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=tzinfo)
+        utc = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return struct.pack("!q", (utc - POSTGRES_EPOCH) // _MICROSECOND)
+
+    return _timestamptz
+
+
+def _numeric(value):
+    number = decimal.Decimal(value.strip())
+    if number.is_nan():
+        return struct.pack("!hhHh", 0, 0, NUMERIC_NAN, 0)
+    if number.is_infinite():
+        sign = NUMERIC_NINF if number < 0 else NUMERIC_PINF
+        return struct.pack("!hhHh", 0, 0, sign, 0)
+
+    sign, digits, exponent = number.as_tuple()
+    dscale = max(0, -exponent)
+    digits = "".join(str(d) for d in digits)
+    point = len(digits) + exponent  # number of digits before the decimal point
+    if point <= 0:
+        digits = "0" * -point + digits
+        point = 0
+    elif point > len(digits):
+        digits += "0" * (point - len(digits))
+    integer, fraction = digits[:point], digits[point:]
+    integer = "0" * (-len(integer) % 4) + integer
+    fraction += "0" * (-len(fraction) % 4)
+    groups = [int(integer[i : i + 4]) for i in range(0, len(integer), 4)]
+    weight = len(groups) - 1
+    groups += [int(fraction[i : i + 4]) for i in range(0, len(fraction), 4)]
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return struct.pack(
+        "!hhHh{}H".format(len(groups)),
+        len(groups),
+        weight,
+        NUMERIC_NEG if sign else NUMERIC_POS,
+        dscale,
+        *groups
+    )
+
+
+TEXT_TYPES = {"text", "character varying", "character", "bpchar", "name"}
+ENCODERS = {
+    "smallint": _int2,
+    "integer": _int4,
+    "bigint": _int8,
+    "real": _float4,
+    "double precision": _float8,
+    "numeric": _numeric,
+    "boolean": _bool,
+    "date": _date,
+    "timestamp without time zone": _timestamp,
+}
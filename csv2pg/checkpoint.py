@@ -0,0 +1,84 @@
+import io
+import json
+import os
+import re
+
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+SIZE_PATTERN = re.compile(r"^([0-9]+)\s*([KMGT]?B)$", re.IGNORECASE)
+SIZE_UNITS = {"B": 1, "KB": 2 ** 10, "MB": 2 ** 20, "GB": 2 ** 30, "TB": 2 ** 40}
+
+
+def parse_commit_every(value):
+    """
+    Parse a --commit-every value: a number of rows ("100000") or a size in
+    bytes ("512MB"). Return a (rows, size) tuple with one of them set.
+    """
+    value = str(value).strip()
+    if value.isdigit() and int(value) > 0:
+        return int(value), None
+    match = SIZE_PATTERN.match(value)
+    if match and int(match.group(1)) > 0:
+        return None, int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+    raise ValueError(
+        "Invalid commit size {}, expected a number of rows or a size like 512MB".format(
+            repr(value)
+        )
+    )
+
+
+def checkpoint_path(filepath):
+    return filepath + CHECKPOINT_SUFFIX
+
+
+def read_checkpoint(filepath):
+    """
+    Return the checkpoint of a partially loaded file, None if there is none.
+    Raise ValueError if the file changed since the checkpoint was written.
+    """
+    try:
+        with io.open(checkpoint_path(filepath)) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    if checkpoint["file"] != _file_identity(filepath):
+        raise ValueError(
+            "{} changed since its checkpoint, remove {} to load it again".format(
+                filepath, checkpoint_path(filepath)
+            )
+        )
+    return checkpoint
+
+
+def write_checkpoint(filepath, offset, line, rows, chunks, err_size=None):
+    """
+    Record the state after a committed chunk: the byte offset and line number
+    to resume from, the number of committed rows and chunks, and the size of
+    the error file. The file is replaced atomically.
+    """
+    checkpoint = {
+        "file": _file_identity(filepath),
+        "offset": offset,
+        "line": line,
+        "rows": rows,
+        "chunks": chunks,
+        "err_size": err_size,
+    }
+    path = checkpoint_path(filepath)
+    with io.open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def remove_checkpoint(filepath):
+    try:
+        os.remove(checkpoint_path(filepath))
+    except FileNotFoundError:
+        pass
+
+
+def _file_identity(filepath):
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
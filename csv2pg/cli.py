@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import contextlib
 import getpass
 import os
 
 import click
 
 from csv2pg import __version__, copy_to
+from csv2pg.compression import COMPRESSIONS
+from csv2pg.engines import ENGINES
+from csv2pg.inference import INFER_SAMPLE
 from csv2pg.main import COPY_BUFFER
+from csv2pg.profiling import profiled
 
 
 @click.command()
@@ -62,6 +67,26 @@ from csv2pg.main import COPY_BUFFER
     show_default=True,
     help="detect, ignore and export errors to <filepath>.err",
 )
+@click.option(
+    "--max-errors",
+    "max_errors",
+    type=int,
+    default=None,
+    help="with --skip-error, abort the load once more than MAX_ERRORS rows are rejected",
+)
+@click.option(
+    "--max-error-rate",
+    "max_error_rate",
+    type=float,
+    default=None,
+    help="with --skip-error, abort the load once more than this ratio of the rows read are rejected",
+)
+@click.option(
+    "--error-dir",
+    "error_dir",
+    type=click.Path(file_okay=False),
+    help="export errors to ERROR_DIR/<filename>.err instead of next to the file",
+)
 @click.option(
     "--header/--no-header", "header", is_flag=True, default=True, show_default=True
 )
@@ -81,6 +106,14 @@ from csv2pg.main import COPY_BUFFER
     show_default=True,
     help="include filename in a _filename column",
 )
+@click.option(
+    "--server-inject/--no-server-inject",
+    "server_inject",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="fill _rownum and _filename with column defaults in postgres instead of in the rows sent",
+)
 @click.option(
     "--delimiter",
     "delimiter",
@@ -149,8 +182,139 @@ from csv2pg.main import COPY_BUFFER
     show_default=True,
     help="size of the read buffer to be used by COPY FROM",
 )
+@click.option(
+    "-j",
+    "--jobs",
+    "jobs",
+    type=int,
+    default=1,
+    show_default=True,
+    help="number of parallel connections, loading files or ranges of a single file",
+)
+@click.option(
+    "--compression",
+    "compression",
+    type=click.Choice(["infer", "none"] + COMPRESSIONS),
+    default="infer",
+    show_default=True,
+    help="compression of the csv, infer detects it from extension or content",
+)
+@click.option(
+    "--infer-types/--no-infer-types",
+    "infer_types",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="create typed columns instead of TEXT, inferred from a sample of rows",
+)
+@click.option(
+    "--infer-sample",
+    "infer_sample",
+    type=int,
+    default=INFER_SAMPLE,
+    show_default=True,
+    help="number of rows sampled by --infer-types, 0 to read the whole file",
+)
+@click.option(
+    "--binary/--no-binary",
+    "binary",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="convert rows on the client and COPY them in binary format",
+)
+@click.option(
+    "--defer-indexes/--no-defer-indexes",
+    "defer_indexes",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="drop the indexes and constraints of the table during the load, then rebuild them",
+)
+@click.option(
+    "--atomic/--no-atomic",
+    "atomic",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="load in a staging table, then swap it with the table in a short transaction",
+)
+@click.option(
+    "--truncate/--no-truncate",
+    "truncate",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="empty the existing table with TRUNCATE instead of dropping it",
+)
+@click.option(
+    "--freeze/--no-freeze",
+    "freeze",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="create or truncate the table and COPY FREEZE in a single transaction",
+)
+@click.option(
+    "--commit-every",
+    "commit_every",
+    default=None,
+    help="commit each file in chunks of ROWS rows or of a size like 512MB, checkpointing each",
+)
+@click.option(
+    "--resume/--no-resume",
+    "resume",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="continue a --commit-every load from its last committed chunk",
+)
+@click.option(
+    "--optimistic/--no-optimistic",
+    "optimistic",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="with --skip-error, let the server reject rows instead of validating each one",
+)
+@click.option(
+    "--pipeline",
+    "pipeline",
+    type=int,
+    default=0,
+    show_default=True,
+    help="read and validate rows in a background thread, up to PIPELINE chunks of 64KB ahead of COPY",
+)
+@click.option(
+    "--workers",
+    "workers",
+    type=int,
+    default=0,
+    show_default=True,
+    help="with --skip-error, validate rows in WORKERS processes feeding a single COPY",
+)
+@click.option(
+    "--engine",
+    "engine",
+    type=click.Choice(ENGINES),
+    default="stdlib",
+    show_default=True,
+    help="with --skip-error, parse rows with the python csv module or with pyarrow in WORKERS threads",
+)
+@click.option(
+    "--report",
+    "report",
+    type=click.Path(dir_okay=False),
+    help="write a report of the load as json, or as a prometheus textfile if REPORT ends with .prom",
+)
+@click.option(
+    "--profile",
+    "profile",
+    type=click.Path(dir_okay=False),
+    help="profile the load in PROFILE (pstats) and its stack samples by stage in PROFILE.collapsed",
+)
 @click.argument("table", nargs=1)
-@click.argument("filepath", nargs=1, type=click.Path())
+@click.argument("filepath", nargs=-1, required=True, type=click.Path())
 @click.version_option(version=__version__)
 def cli(
     hostname,
@@ -161,9 +325,13 @@ def cli(
     verbose,
     progress,
     skip_error,
+    max_errors,
+    max_error_rate,
+    error_dir,
     header,
     rownum,
     filename,
+    server_inject,
     delimiter,
     quotechar,
     doublequote,
@@ -174,6 +342,23 @@ def cli(
     overwrite,
     unlogged,
     buffer,
+    jobs,
+    compression,
+    infer_types,
+    infer_sample,
+    binary,
+    defer_indexes,
+    atomic,
+    truncate,
+    freeze,
+    commit_every,
+    resume,
+    optimistic,
+    pipeline,
+    workers,
+    engine,
+    report,
+    profile,
     table,
     filepath,
 ):
@@ -190,32 +375,53 @@ def cli(
     if password:
         pgpassword = click.prompt("Password", hide_input=True)
 
-    copy_to(
-        hostname,
-        port,
-        dbname,
-        username,
-        pgpassword,
-        table,
-        filepath,
-        connection_options=default_options,
-        verbose=verbose,
-        progress=progress,
-        skip_error=skip_error,
-        header=header,
-        inject_rownum=rownum,
-        inject_filename=filename,
-        delimiter=delimiter,
-        quotechar=quotechar,
-        doublequote=doublequote,
-        escapechar=escapechar,
-        lineterminator=lineterminator,
-        null=null,
-        encoding=encoding,
-        overwrite=overwrite,
-        unlogged=unlogged,
-        buffer=buffer,
-    )
+    with profiled(profile) if profile else contextlib.nullcontext():
+        copy_to(
+            hostname,
+            port,
+            dbname,
+            username,
+            pgpassword,
+            table,
+            list(filepath),
+            connection_options=default_options,
+            verbose=verbose,
+            progress=progress,
+            skip_error=skip_error,
+            header=header,
+            inject_rownum=rownum,
+            inject_filename=filename,
+            delimiter=delimiter,
+            quotechar=quotechar,
+            doublequote=doublequote,
+            escapechar=escapechar,
+            lineterminator=lineterminator,
+            null=null,
+            encoding=encoding,
+            overwrite=overwrite,
+            unlogged=unlogged,
+            buffer=buffer,
+            jobs=jobs,
+            compression=None if compression == "none" else compression,
+            infer_types=infer_types,
+            infer_sample=infer_sample,
+            binary=binary,
+            defer_indexes=defer_indexes,
+            atomic=atomic,
+            truncate=truncate,
+            freeze=freeze,
+            commit_every=commit_every,
+            resume=resume,
+            optimistic=optimistic,
+            pipeline=pipeline,
+            workers=workers,
+            report_filepath=report,
+            engine=engine,
+            server_inject=server_inject,
+            max_errors=max_errors,
+            max_error_rate=max_error_rate,
+            error_dir=error_dir,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+import time
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSIONS = ["gzip", "bz2", "xz", "zstd"]
+EXTENSIONS = {
+    ".gz": "gzip",
+    ".gzip": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+    ".lzma": "xz",
+    ".zst": "zstd",
+    ".zstd": "zstd",
+}
+MAGIC_NUMBERS = {
+    b"\x1f\x8b": "gzip",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+DECOMPRESS_BUFFER = 2 ** 16  # size of the chunks decompressed in background
+DECOMPRESS_DEPTH = 16  # number of chunks decompressed ahead
+
+
+def detect_compression(filepath, head=None):
+    """
+    Detect the compression of a file from its extension, then its magic number
+    (in head, the first bytes of a stream, when given).
+    Return None for an uncompressed file.
+    """
+    compression = EXTENSIONS.get(os.path.splitext(filepath)[1].lower())
+    if compression:
+        return compression
+    if head is None:
+        with io.open(filepath, "rb") as f:
+            head = f.read(max(len(magic) for magic in MAGIC_NUMBERS))
+    for magic, compression in MAGIC_NUMBERS.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def decompress(f, compression):
+    """
+    Wrap a binary file object in a decompressing reader
+    """
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if compression == "bz2":
+        return bz2.BZ2File(f, mode="rb")
+    if compression == "xz":
+        return lzma.LZMAFile(f, mode="rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    raise ValueError("Unknown compression {}".format(compression))
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Read a binary stream from a background thread, up to `depth` chunks ahead
+
+    `timings` accumulates the seconds spent by the background thread reading
+    (`read`, of which `read_cpu` on CPU) and waiting for room in the queue
+    (`read_stall`), and by the consumer waiting for a chunk (`consume_stall`).
+    """
+
+    def __init__(
+        self, f, name=None, chunk_size=DECOMPRESS_BUFFER, depth=DECOMPRESS_DEPTH
+    ):
+        self.name = name
+        self._f = f
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._chunk = b""
+        self._pos = 0
+        self._eof = False
+        self.timings = {
+            "read": 0.0,
+            "read_cpu": 0.0,
+            "read_stall": 0.0,
+            "consume_stall": 0.0,
+        }
+        self._thread = threading.Thread(target=self._run, args=(chunk_size,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, chunk_size):
+        cpu = time.thread_time()
+        try:
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                chunk = self._f.read(chunk_size)
+                self.timings["read"] += time.perf_counter() - start
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self._put(e)
+        finally:
+            self.timings["read_cpu"] = time.thread_time() - cpu
+
+    def _put(self, item):
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+        finally:
+            self.timings["read_stall"] += time.perf_counter() - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._pos >= len(self._chunk):
+            if self._eof:
+                return 0
+            start = time.perf_counter()
+            item = self._queue.get()
+            self.timings["consume_stall"] += time.perf_counter() - start
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._chunk = item
+            self._pos = 0
+        n = min(len(b), len(self._chunk) - self._pos)
+        with memoryview(self._chunk) as view:
+            b[:n] = view[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._f.close()
+        super().close()
@@ -0,0 +1,719 @@
+import collections
+import csv
+import io
+import itertools
+import logging
+import os
+import re
+import time
+
+from csv2pg.exceptions import (
+    CsvException,
+    MissingFieldsException,
+    TooManyFieldsException,
+    WrongFieldDialectException,
+)
+from csv2pg.report import ERROR_RATE_ROWS, LoadReport
+from csv2pg.split import RangeIO
+
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+
+ENGINES = ["stdlib", "arrow"]
+WORKER_CHUNK = 2 ** 20  # size of the byte ranges validated by --workers
+ARROW_CHUNK = 2 ** 22  # size of the byte ranges parsed by a thread of --engine arrow
+FIELD_VALIDITY_PATTERN = (
+    "^([^{quotechar}]+|{quotechar}(?:[^{quotechar}]|{escaped})*{quotechar})?$"
+)
+
+logger = logging.getLogger("csv2pg")
+
+
+class Engine:
+    """
+    Parser of the records validated by --skip-error.
+
+    records(f_in, f_err, dialect, header, expected_columns, filename, ...)
+    validates a text stream and yields its valid records, with the csv module
+    whatever the engine. check(filepath, start, end, first_line, end_line,
+    dialect, **options) parses and validates a record-aligned byte range of
+    about chunk_size bytes in the executor of the load, a thread pool with one
+    thread per core by default when threads, else a pool of --workers
+    processes. It returns the valid records ready for COPY, the error rows as
+    text, the number of valid records and the as_dict() of the report of the
+    range. The records are standard csv in utf-8 when standard_csv, else in
+    the dialect of the file and the client_encoding. Both reject the same
+    records.
+    """
+
+    threads = False
+    standard_csv = False
+    available = True
+
+    @property
+    def chunk_size(self):
+        return WORKER_CHUNK
+
+    def records(
+        self,
+        f_in,
+        f_err,
+        dialect,
+        header,
+        expected_columns,
+        filename,
+        verbose=False,
+        first_line=0,
+        report=None,
+    ):
+        return check_records(
+            f_in,
+            f_err,
+            dialect,
+            header,
+            expected_columns,
+            filename,
+            verbose=verbose,
+            first_line=first_line,
+            report=report,
+        )
+
+    def check(self, filepath, start, end, first_line, end_line, dialect, **options):
+        raise NotImplementedError
+
+
+class StdlibEngine(Engine):
+    """
+    The csv module, checking the byte ranges in worker processes
+    """
+
+    def check(
+        self,
+        filepath,
+        start,
+        end,
+        first_line,
+        end_line,
+        dialect,
+        header,
+        expected_columns,
+        encoding="utf-8",
+        client_encoding="utf-8",
+        null="",
+        verbose=False,
+        inject_rownum=False,
+        inject_filename=False,
+    ):
+        """
+        Validate the records of a byte range with the csv module, the records
+        being sent as read (NULL is left to COPY), encoded in client_encoding
+        """
+        dialect = type("dialect", (csv.Dialect,), dialect)
+        filename = os.path.basename(filepath)
+        report = LoadReport()
+        f_err = io.StringIO()
+
+        clock = time.perf_counter
+        start_read = clock()
+        with RangeIO(filepath, start, end) as f:
+            data = f.read()
+        start_validate = clock()
+        records = list(
+            self.records(
+                io.StringIO(data.decode(encoding), newline=None),
+                f_err,
+                dialect,
+                header,
+                expected_columns,
+                filename,
+                verbose=verbose,
+                first_line=first_line,
+                report=report,
+            )
+        )
+        start_inject = clock()
+        data = "".join(
+            inject_fields(
+                record,
+                dialect.delimiter,
+                rownum=(i if header else i + 1) if inject_rownum else None,
+                filename=filename if inject_filename else None,
+            )
+            for i, record, _ in records
+        )
+        report.add(
+            read=start_validate - start_read,
+            validate=start_inject - start_validate,
+            inject=clock() - start_inject,
+        )
+        return (
+            data.encode(client_encoding),
+            f_err.getvalue(),
+            len(records),
+            report.as_dict(),
+        )
+
+
+class ArrowEngine(Engine):
+    """
+    The multi-threaded pyarrow csv reader, checking the byte ranges in threads
+    """
+
+    threads = True
+    standard_csv = True
+
+    @property
+    def available(self):
+        return arrow_available()
+
+    @property
+    def chunk_size(self):
+        return ARROW_CHUNK
+
+    def check(
+        self,
+        filepath,
+        start,
+        end,
+        first_line,
+        end_line,
+        dialect,
+        header,
+        expected_columns,
+        encoding="utf-8",
+        client_encoding="utf-8",
+        null="",
+        verbose=False,
+        inject_rownum=False,
+        inject_filename=False,
+    ):
+        """
+        Parse the records of a byte range with the pyarrow csv reader, each
+        record with a wrong number of fields or a field failing
+        FIELD_VALIDITY_PATTERN being exported. When the rows do not add up to
+        the end_line - first_line lines of the range (empty lines, \\r line
+        endings), or a rejected record may not be parsed like the csv module
+        does, the range is checked by the csv module instead. Return the valid records as standard csv in utf-8
+        (whatever client_encoding), the error rows as text, the number of
+        valid records and the report of the chunk.
+        """
+        dialect = type("dialect", (csv.Dialect,), dialect)
+        filename = os.path.basename(filepath)
+        report = LoadReport()
+        f_err = io.StringIO()
+
+        clock = time.perf_counter
+        start_read = clock()
+        with RangeIO(filepath, start, end) as f:
+            data = f.read()
+        start_validate = clock()
+        checked = self._arrow_records(
+            data,
+            dialect,
+            header,
+            expected_columns,
+            filename,
+            encoding=encoding,
+            null=null,
+            verbose=verbose,
+            first_line=first_line,
+            end_line=end_line,
+        )
+        if checked is not None:
+            table, rownums, errors = checked
+            writer = csv.writer(f_err, dialect=dialect)
+            for error_row, error in errors:
+                writer.writerow(error_row)
+                report.reject(error)
+        else:
+            rows = []
+            rownums = []
+            for i, record, parsed_line in self.records(
+                io.StringIO(data.decode(encoding), newline=None),
+                f_err,
+                dialect,
+                header,
+                expected_columns,
+                filename,
+                verbose=verbose,
+                first_line=first_line,
+                report=report,
+            ):
+                if header and i == 0:
+                    continue
+                values = parsed_line
+                if null in values:
+                    # like COPY CSV, a quoted value matching null is not NULL
+                    values = [
+                        None if value == null and not quoted else value
+                        for value, quoted in zip(values, quoted_fields(record, dialect))
+                    ]
+                rows.append(values)
+                rownums.append(i if header else i + 1)
+            table = arrow_table(rows, expected_columns)
+
+        start_inject = clock()
+        table = arrow_inject(
+            table,
+            filename=filename if inject_filename else None,
+            rownums=rownums if inject_rownum else None,
+        )
+        data = arrow_write(table)
+        report.add(
+            read=start_validate - start_read,
+            validate=start_inject - start_validate,
+            inject=clock() - start_inject,
+        )
+        return data, f_err.getvalue(), table.num_rows, report.as_dict()
+
+    def _arrow_records(
+        self,
+        data,
+        dialect,
+        header,
+        expected_columns,
+        filename,
+        encoding="utf-8",
+        null="",
+        verbose=False,
+        first_line=0,
+        end_line=0,
+    ):
+        """
+        Parse and check the records of a byte range with pyarrow. Return the
+        table of the valid records, their line numbers and the (error row,
+        exception) of the rejected ones, or None when the range must be checked
+        by the csv module.
+        """
+        skip_rows = int(header and first_line == 0)
+        table, invalid = arrow_read(
+            data,
+            dialect,
+            expected_columns,
+            encoding=encoding,
+            null=null,
+            skip_rows=skip_rows,
+        )
+        header_span = (
+            1 + sum(c.count("\n") for c in expected_columns) if skip_rows else 0
+        )
+        spans = arrow_spans(table)
+        invalid_spans = [text.count("\n") + 1 for _, _, text in invalid]
+        if header_span + sum(spans) + sum(invalid_spans) != end_line - first_line:
+            return None
+        table = arrow_translate_newlines(table)
+
+        # number of the line of each row, from the spans of the rows and of
+        # the records with a wrong number of fields between them
+        rownums = []
+        rejected = []  # (line number, span) of the rejected records
+        line_number = first_line + header_span + (0 if header else 1)
+        valid = 0
+        for k, ((number, _, _), span) in enumerate(zip(invalid, invalid_spans)):
+            before = number - 1 - skip_rows - k
+            rownums.extend(
+                itertools.accumulate(spans[valid:before], initial=line_number)
+            )
+            line_number = rownums.pop()
+            valid = before
+            rejected.append((line_number, span))
+            line_number += span
+        rownums.extend(itertools.accumulate(spans[valid:], initial=line_number))
+        rownums.pop()
+
+        # the fields failing FIELD_VALIDITY_PATTERN, NULL being an unquoted
+        # null value
+        mask = None
+        pattern = field_pattern(dialect).pattern
+        for column in table.columns:
+            matched = pyarrow.compute.match_substring_regex(column, pattern)
+            matched = matched.fill_null(True)
+            mask = matched if mask is None else pyarrow.compute.and_(mask, matched)
+        if mask is not None and not pyarrow.compute.all(mask).as_py():
+            flags = mask.to_pylist()
+            rejected.extend(
+                (rownum, span)
+                for rownum, span, flag in zip(rownums, spans, flags)
+                if not flag
+            )
+            table = table.filter(mask)
+            rownums = list(itertools.compress(rownums, flags))
+        if not rejected:
+            return table, rownums, []
+
+        # the rejected records parsed again with the csv module, for the
+        # errors of records(). Their parsing only differs from the csv module
+        # on a quote after the spaces skipped by skipinitialspace: a record
+        # the csv module reads otherwise, or of several lines (whose lines it
+        # may parse again), sends the range to it
+        lines = io.StringIO(data.decode(encoding), newline=None).readlines()
+        pattern = field_pattern(dialect)
+        generated_header = ["_rownum", "_error"] + expected_columns
+        errors = []
+        for line_number, span in sorted(rejected):
+            if span > 1:
+                return None
+            k = line_number - first_line - (0 if header else 1)
+            reader = csv.reader(lines[k : k + 2], dialect=dialect)
+            try:
+                parsed_line = next(reader)
+            except csv.Error:
+                return None
+            if reader.line_num != 1:
+                return None
+            try:
+                check_record(expected_columns, parsed_line, pattern)
+            except CsvException as e:
+                errors.append(
+                    (
+                        format_error(
+                            filename,
+                            parsed_line,
+                            line_number,
+                            generated_header,
+                            e,
+                            verbose,
+                        ),
+                        e,
+                    )
+                )
+                continue
+            return None
+        return table, rownums, errors
+
+
+def get_engine(name):
+    """
+    The Engine named name: the csv module in worker processes ("stdlib") or
+    the pyarrow csv reader in threads ("arrow")
+    """
+    return ArrowEngine() if name == "arrow" else StdlibEngine()
+
+
+def arrow_available():
+    return pyarrow is not None
+
+
+def arrow_read(data, dialect, columns, encoding="utf-8", null="", skip_rows=0):
+    """
+    Parse csv records with the arrow reader, every field as a string or NULL
+    for an unquoted null. Return the table of the valid records and the
+    (number, actual_columns, text) of the records with a wrong number of
+    fields, number counting the records of data from 1.
+    """
+    if pyarrow is None:
+        raise ImportError("--engine arrow requires the pyarrow package")
+    invalid = []
+
+    def _invalid_row(row):
+        invalid.append((row.number, row.actual_columns, row.text))
+        return "skip"
+
+    names = ["f{}".format(i) for i in range(len(columns))]
+    return (
+        pyarrow.csv.read_csv(
+            io.BytesIO(data),
+            read_options=pyarrow.csv.ReadOptions(
+                column_names=names,
+                skip_rows=skip_rows,
+                encoding=encoding,
+                use_threads=False,
+                block_size=max(len(data), 1),
+            ),
+            parse_options=pyarrow.csv.ParseOptions(
+                delimiter=dialect.delimiter,
+                quote_char=dialect.quotechar or False,
+                double_quote=bool(dialect.doublequote),
+                escape_char=dialect.escapechar or False,
+                newlines_in_values=True,
+                ignore_empty_lines=True,
+                invalid_row_handler=_invalid_row,
+            ),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={name: pyarrow.string() for name in names},
+                null_values=[null],
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=False,
+            ),
+        ),
+        invalid,
+    )
+
+
+def arrow_table(rows, columns):
+    """
+    Table of string columns from parsed rows, None being NULL
+    """
+    return pyarrow.Table.from_arrays(
+        (
+            [pyarrow.array(values, pyarrow.string()) for values in zip(*rows)]
+            if rows
+            else [pyarrow.array([], pyarrow.string()) for _ in columns]
+        ),
+        names=["f{}".format(i) for i in range(len(columns))],
+    )
+
+
+def arrow_spans(table):
+    """
+    Number of physical lines of each row of a table
+    """
+    spans = pyarrow.array([1] * table.num_rows, pyarrow.int64())
+    for column in table.columns:
+        newlines = pyarrow.compute.count_substring(column, "\n")
+        spans = pyarrow.compute.add(spans, newlines.fill_null(0))
+    return spans.to_pylist()
+
+
+def arrow_translate_newlines(table):
+    """
+    Translate \\r\\n and \\r to \\n in the values of a table, like reading a
+    file in text mode
+    """
+    for i, column in enumerate(table.columns):
+        if pyarrow.compute.any(pyarrow.compute.match_substring(column, "\r")).as_py():
+            table = table.set_column(
+                i,
+                table.field(i),
+                pyarrow.compute.replace_substring_regex(column, "\r\n?", "\n"),
+            )
+    return table
+
+
+def arrow_inject(table, filename=None, rownums=None):
+    """
+    Prepend the _filename and _rownum columns to a table
+    """
+    if rownums is not None:
+        table = table.add_column(0, "_rownum", pyarrow.array(rownums, pyarrow.int64()))
+    if filename is not None:
+        table = table.add_column(
+            0, "_filename", pyarrow.repeat(pyarrow.scalar(filename), table.num_rows)
+        )
+    return table
+
+
+def arrow_write(table):
+    """
+    Write a table as csv records in utf-8: values quoted, NULL unquoted empty
+    """
+    sink = pyarrow.BufferOutputStream()
+    pyarrow.csv.write_csv(table, sink, pyarrow.csv.WriteOptions(include_header=False))
+    return sink.getvalue().to_pybytes()
+
+
+def check_records(
+    f_in,
+    f_err,
+    dialect,
+    header,
+    expected_columns,
+    filename,
+    verbose=False,
+    first_line=0,
+    report=None,
+):
+    """
+    Parse f_in with a single csv reader, export invalid records to f_err
+    (counting them in report) and yield (line index, record, fields) tuples
+    for the valid ones.
+    """
+    pattern = field_pattern(dialect)
+    generated_header = ["_rownum", "_error"] + expected_columns
+    writer = csv.writer(f_err, dialect=dialect)
+
+    pending = collections.deque()  # lines to parse again before reading f_in
+    lines = []  # raw lines of the record being parsed
+
+    def _lines():
+        while True:
+            if pending:
+                line = pending.popleft()
+            else:
+                line = f_in.readline()
+                if not line:
+                    return
+            lines.append(line)
+            yield line
+
+    reader = csv.reader(_lines(), dialect=dialect)
+    i = first_line
+    valid = 0
+    while True:
+        try:
+            parsed_line = next(reader)
+            error = None
+        except StopIteration:
+            break
+        except csv.Error as e:
+            parsed_line = []
+            error = WrongFieldDialectException(str(e), None)
+        record_lines = lines[:]
+        lines.clear()
+        line_number = i if header else i + 1
+
+        record = record_lines[0] if len(record_lines) == 1 else "".join(record_lines)
+        # Check line and skip
+        try:
+            if error:
+                raise error
+            check_record(expected_columns, parsed_line, pattern)
+        except CsvException as e:
+            if len(record_lines) > 1:
+                # A broken quote merged the following lines in this record:
+                # reject the first line alone and parse the others again
+                pending.extendleft(reversed(record_lines[1:]))
+                reader = csv.reader(_lines(), dialect=dialect)
+                record_lines = record_lines[:1]
+                parsed_line = next(csv.reader(record_lines, dialect=dialect), [])
+                try:
+                    check_record(expected_columns, parsed_line, pattern)
+                except CsvException as first_line_error:
+                    e = first_line_error
+            err_row = format_error(
+                filename, parsed_line, line_number, generated_header, e, verbose
+            )
+            writer.writerow(err_row)
+            if report is not None:
+                report.reject(e)
+            i += len(record_lines)
+            continue
+
+        yield i, record, parsed_line
+        i += len(record_lines)
+        valid += 1
+        if report is not None and not valid % ERROR_RATE_ROWS:
+            report.accept(ERROR_RATE_ROWS)
+    if report is not None:
+        report.accept(valid % ERROR_RATE_ROWS, final=True)
+
+
+def field_pattern(dialect):
+    """
+    Compile FIELD_VALIDITY_PATTERN for the quote and escape chars of dialect,
+    each escaped quote alternative only once (a repeated one backtracks
+    exponentially when the escape char is the quote char)
+    """
+    escaped = dict.fromkeys(
+        [dialect.quotechar * 2, "{}{}".format(dialect.escapechar, dialect.quotechar)]
+    )
+    return re.compile(
+        FIELD_VALIDITY_PATTERN.format(
+            quotechar=dialect.quotechar, escaped="|".join(escaped)
+        )
+    )
+
+
+def check_record(ref, target, pattern):
+    """
+    Check the parsed fields of a record against the expected columns, each
+    field matching pattern as a whole: a valid record costs one fullmatch per
+    field, without a python loop, and only an invalid one is walked to tell
+    why
+    """
+    if len(ref) == len(target) and all(map(pattern.fullmatch, target)):
+        return
+    if len(ref) > len(target):
+        missing = len(ref) - len(target)
+        raise MissingFieldsException(f"{missing} missing fields", None)
+    if len(ref) < len(target):
+        extra = len(target) - len(ref)
+        raise TooManyFieldsException(f"{extra} extra fields", None)
+    for i, field in enumerate(target):
+        if not pattern.fullmatch(field):
+            raise WrongFieldDialectException(field, i)
+
+
+def record_check(dialect, expected_columns):
+    """
+    Tell whether the parsed fields of a record pass check_record
+    """
+    pattern = field_pattern(dialect)
+    return lambda fields: len(fields) == len(expected_columns) and all(
+        map(pattern.fullmatch, fields)
+    )
+
+
+def quoted_fields(record, dialect):
+    """
+    Tell for each field of a raw record whether it is quoted, splitting it
+    like the csv reader
+    """
+    quotechar = dialect.quotechar
+    escapechar = dialect.escapechar
+    quoted = []
+    start = True  # at the start of a field
+    in_quote = False
+    i = 0
+    while i < len(record):
+        c = record[i]
+        if in_quote:
+            if c == escapechar and escapechar != quotechar:
+                i += 1
+            elif c == quotechar:
+                if record[i + 1 : i + 2] == quotechar:
+                    i += 1
+                else:
+                    in_quote = False
+        elif start:
+            if c == " " and dialect.skipinitialspace:
+                i += 1
+                continue
+            if c in "\r\n":
+                break
+            start = False
+            quoted.append(c == quotechar)
+            if c == quotechar:
+                in_quote = True
+            elif c == dialect.delimiter:
+                start = True
+            elif c == escapechar:
+                i += 1
+        elif c == dialect.delimiter:
+            start = True
+        elif c == escapechar:
+            i += 1
+        elif c in "\r\n":
+            break
+        i += 1
+    if start:
+        quoted.append(False)
+    return quoted
+
+
+def format_error(
+    filename, parsed_line, line_number, generated_header, exception, verbose
+):
+    error = exception.__class__.__name__
+    message, field_number = exception.args
+    try:
+        header_error = generated_header[field_number]
+    except (IndexError, TypeError):
+        header_error = None
+
+    logger.info(
+        f"{error} in file {filename} at line {line_number}:{field_number}:{header_error}: {message}",
+    )
+    err_row = [line_number, f"{error}:{field_number}:{header_error}"] + parsed_line
+    return err_row
+
+
+def inject_fields(record, delimiter, rownum=None, filename=None):
+    """
+    Prepend the _rownum and _filename fields to a raw record
+    """
+    if rownum is not None:
+        record = "{value}{delimiter}{record}".format(
+            value=rownum, delimiter=delimiter, record=record
+        )
+    if filename is not None:
+        record = "{value}{delimiter}{record}".format(
+            value=filename, delimiter=delimiter, record=record
+        )
+    return record
@@ -0,0 +1,119 @@
+import io
+import os
+import queue
+import threading
+
+
+ERR_BUFFER = 2 ** 16  # characters of error rows buffered before writing them
+ERR_DEPTH = 4  # number of full buffers queued for the writer thread
+
+
+class ErrorFile:
+    """
+    Text file of the rows rejected by a load, only created (with its header)
+    by the first error. The rows written are buffered, and the full buffers of
+    buffer_size characters are appended to the file by a background thread,
+    up to `depth` buffers behind. flush() and close() wait for the rows to be
+    written, and raise the error of the writer thread.
+    """
+
+    def __init__(
+        self,
+        filepath,
+        mode="w",
+        encoding="utf-8",
+        header=None,
+        buffer_size=ERR_BUFFER,
+        depth=ERR_DEPTH,
+    ):
+        self.name = filepath
+        self.encoding = encoding
+        self.header = header
+        self.buffer_size = buffer_size
+        self.depth = depth
+        self._buffer = []
+        self._size = 0
+        self._f = None
+        self._queue = None
+        self._thread = None
+        self._error = None
+        if "w" in mode and os.path.exists(filepath):
+            # errors of a previous load
+            os.remove(filepath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self._submit()
+        return len(text)
+
+    def flush(self):
+        if self._thread is None:
+            if self._buffer:
+                self._write(self._take())
+        else:
+            if self._buffer:
+                self._submit()
+            self._queue.join()
+        self._raise()
+        if self._f is not None:
+            self._f.flush()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+    def _take(self):
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        return text
+
+    def _submit(self):
+        self._raise()
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=self.depth)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(self._take())
+
+    def _run(self):
+        while True:
+            text = self._queue.get()
+            try:
+                if text is not None and self._error is None:
+                    self._write(text)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+            if text is None:
+                return
+
+    def _write(self, text):
+        if self._f is None:
+            created = not os.path.exists(self.name)
+            self._f = io.open(self.name, "a", encoding=self.encoding)
+            if created and self.header:
+                self._f.write(self.header)
+        self._f.write(text)
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
@@ -12,3 +12,23 @@ class MissingFieldsException(CsvException):
 
 class WrongFieldDialectException(CsvException):
     pass
+
+
+class WrongFieldTypeException(CsvException):
+    pass
+
+
+class WrongHeaderException(CsvException):
+    pass
+
+
+class RejectedRowException(CsvException):
+    pass
+
+
+class IndexRebuildException(Exception):
+    pass
+
+
+class ErrorBudgetException(Exception):
+    pass
@@ -0,0 +1,348 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import psycopg2.extensions
+
+from csv2pg.exceptions import IndexRebuildException
+
+
+STAGING_SUFFIX = "_staging"
+NAMEDATALEN = 63  # maximum length of a postgres identifier
+
+logger = logging.getLogger("csv2pg")
+
+
+def capture_definitions(cursor, table):
+    """
+    Capture the indexes and constraints of a table from the catalog, including
+    the foreign keys of other tables referencing it.
+
+    Return a dict of SQL statements: `drop` to run in order, `indexes` that
+    can not fail on the loaded rows and can be built concurrently afterwards,
+    and `constraints` (primary key, unique, exclusion and foreign keys) to run
+    in order in the loading transaction, so that a violation rolls it back.
+    When the rows are committed by several transactions, the constraints are
+    restored by `unique` indexes built concurrently like `indexes`, `attach`
+    to run in order once they are built (ADD CONSTRAINT ... USING INDEX,
+    foreign keys NOT VALID) and `validate`.
+    """
+    drop, indexes, constraints = [], [], []
+    unique, attach, validate = [], [], []
+
+    # foreign keys, from other tables first
+    cursor.execute(
+        "SELECT conrelid::regclass::text AS relation, conname AS name, "
+        "pg_get_constraintdef(oid) AS definition FROM pg_constraint "
+        "WHERE contype = 'f' AND (confrelid = %(table)s::regclass "
+        "OR conrelid = %(table)s::regclass) "
+        "ORDER BY conrelid = %(table)s::regclass, conname",
+        {"table": table},
+    )
+    foreign_keys = cursor.fetchall()
+
+    # primary key, unique and exclusion constraints
+    cursor.execute(
+        "SELECT conname AS name, pg_get_constraintdef(oid) AS definition, "
+        "contype AS type, condeferrable AS deferrable, "
+        "(SELECT quote_ident(relname) FROM pg_class WHERE oid = conindid) AS index, "
+        "pg_get_indexdef(conindid) AS index_definition "
+        "FROM pg_constraint WHERE conrelid = %s::regclass "
+        "AND contype IN ('p', 'u', 'x') ORDER BY contype, conname",
+        (table,),
+    )
+    index_constraints = cursor.fetchall()
+
+    # other indexes
+    cursor.execute(
+        "SELECT indexrelid::regclass::text AS name, indisunique AS unique, "
+        "pg_get_indexdef(indexrelid) AS definition FROM pg_index i "
+        "WHERE indrelid = %s::regclass AND NOT EXISTS ("
+        "SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid "
+        "AND c.conrelid = i.indrelid) ORDER BY 1",
+        (table,),
+    )
+    plain_indexes = cursor.fetchall()
+
+    for fk in foreign_keys:
+        drop.append(_drop_constraint(cursor, fk["relation"], fk["name"]))
+    for constraint in index_constraints:
+        drop.append(_drop_constraint(cursor, table, constraint["name"]))
+    for index in plain_indexes:
+        drop.append("DROP INDEX {};".format(index["name"]))
+
+    for index in plain_indexes:
+        # a unique index may be violated by the new rows
+        if index["unique"]:
+            constraints.append(index["definition"] + ";")
+            unique.append(index["definition"] + ";")
+        else:
+            indexes.append(index["definition"] + ";")
+    for constraint in index_constraints:
+        name = psycopg2.extensions.quote_ident(constraint["name"], cursor)
+        add = "ALTER TABLE {table} ADD CONSTRAINT {name} {definition};".format(
+            table=table, name=name, definition=constraint["definition"]
+        )
+        constraints.append(add)
+        if constraint["type"] == "x" or constraint["deferrable"]:
+            attach.append(add)
+            continue
+        unique.append(constraint["index_definition"] + ";")
+        attach.append(
+            "ALTER TABLE {table} ADD CONSTRAINT {name} {type} USING INDEX {index};".format(
+                table=table,
+                name=name,
+                type="PRIMARY KEY" if constraint["type"] == "p" else "UNIQUE",
+                index=constraint["index"],
+            )
+        )
+    for fk in foreign_keys:
+        name = psycopg2.extensions.quote_ident(fk["name"], cursor)
+        add = "ALTER TABLE {table} ADD CONSTRAINT {name} {definition}".format(
+            table=fk["relation"], name=name, definition=fk["definition"]
+        )
+        constraints.append(add + ";")
+        attach.append(add + " NOT VALID;")
+        validate.append(
+            "ALTER TABLE {table} VALIDATE CONSTRAINT {name};".format(
+                table=fk["relation"], name=name
+            )
+        )
+
+    return {
+        "drop": drop,
+        "indexes": indexes,
+        "constraints": constraints,
+        "unique": unique,
+        "attach": attach,
+        "validate": validate,
+    }
+
+
+def staging_definitions(cursor, table, staging):
+    """
+    Capture the sequences, indexes and constraints of a table to reproduce
+    them on the staging table replacing it, created LIKE the table.
+
+    Return a dict of SQL statements: `indexes` to build on the staging table,
+    `sequences` to run in the swap transaction before the table is dropped,
+    `swap` once the staging table is renamed and `validate` once the swap is
+    committed.
+    """
+    definitions = {"indexes": [], "sequences": [], "swap": [], "validate": []}
+    if not table_exists(cursor, table):
+        return definitions
+
+    # serial sequences would be dropped with the table, identity ones continue
+    cursor.execute(
+        "SELECT s.oid::regclass::text AS sequence, a.attname AS column "
+        "FROM pg_depend d JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S' "
+        "JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid "
+        "WHERE d.refobjid = %s::regclass AND d.deptype = 'a' ORDER BY 1",
+        (table,),
+    )
+    for sequence in cursor.fetchall():
+        definitions["sequences"].append(
+            "ALTER SEQUENCE {sequence} OWNED BY {table}.{column};".format(
+                sequence=sequence["sequence"],
+                table=staging,
+                column=psycopg2.extensions.quote_ident(sequence["column"], cursor),
+            )
+        )
+    cursor.execute(
+        "SELECT attname AS column, pg_get_serial_sequence(%s, attname) AS sequence "
+        "FROM pg_attribute WHERE attrelid = %s::regclass AND attidentity <> '' "
+        "ORDER BY attnum",
+        (table, table),
+    )
+    for identity in cursor.fetchall():
+        definitions["sequences"].append(
+            cursor.mogrify(
+                "SELECT setval(pg_get_serial_sequence(%s, %s), last_value, is_called) "
+                "FROM {};".format(identity["sequence"]),
+                (staging, identity["column"]),
+            ).decode()
+        )
+
+    cursor.execute(
+        "SELECT i.relname AS name, quote_ident(i.relname) AS quoted_name, "
+        "n.nspname AS schema, "
+        "quote_ident(n.nspname) || '.' || quote_ident(t.relname) AS relation, "
+        "pg_get_indexdef(x.indexrelid) AS definition, c.contype AS type, "
+        "c.conname AS constraint_name, c.condeferrable AS deferrable, "
+        "pg_get_constraintdef(c.oid) AS constraint_definition "
+        "FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+        "JOIN pg_class t ON t.oid = x.indrelid "
+        "JOIN pg_namespace n ON n.oid = t.relnamespace "
+        "LEFT JOIN pg_constraint c ON c.conindid = x.indexrelid "
+        "AND c.conrelid = x.indrelid "
+        "WHERE x.indrelid = %s::regclass ORDER BY i.relname",
+        (table,),
+    )
+    for index in cursor.fetchall():
+        if index["type"] == "x" or index["deferrable"]:
+            definitions["swap"].append(
+                "ALTER TABLE {table} ADD CONSTRAINT {name} {definition};".format(
+                    table=table,
+                    name=psycopg2.extensions.quote_ident(
+                        index["constraint_name"], cursor
+                    ),
+                    definition=index["constraint_definition"],
+                )
+            )
+            continue
+
+        # built on the staging table under a temporary name, renamed on swap
+        name = index["quoted_name"]
+        temporary = psycopg2.extensions.quote_ident(
+            index["name"][: NAMEDATALEN - len(STAGING_SUFFIX)] + STAGING_SUFFIX,
+            cursor,
+        )
+        definitions["indexes"].append(
+            index["definition"]
+            .replace(" INDEX {} ON ".format(name), " INDEX {} ON ".format(temporary), 1)
+            .replace(
+                " ON {} USING ".format(index["relation"]),
+                " ON {} USING ".format(staging),
+                1,
+            )
+            + ";"
+        )
+        if index["type"] in ("p", "u"):
+            definitions["swap"].append(
+                "ALTER TABLE {table} ADD CONSTRAINT {name} {type} USING INDEX {index};".format(
+                    table=table,
+                    name=psycopg2.extensions.quote_ident(
+                        index["constraint_name"], cursor
+                    ),
+                    type="PRIMARY KEY" if index["type"] == "p" else "UNIQUE",
+                    index=temporary,
+                )
+            )
+        else:
+            definitions["swap"].append(
+                "ALTER INDEX {schema}.{index} RENAME TO {name};".format(
+                    schema=psycopg2.extensions.quote_ident(index["schema"], cursor),
+                    index=temporary,
+                    name=name,
+                )
+            )
+
+    cursor.execute(
+        "SELECT conname AS name, pg_get_constraintdef(oid) AS definition "
+        "FROM pg_constraint WHERE contype = 'f' AND conrelid = %s::regclass "
+        "ORDER BY conname",
+        (table,),
+    )
+    for fk in cursor.fetchall():
+        name = psycopg2.extensions.quote_ident(fk["name"], cursor)
+        definitions["swap"].append(
+            "ALTER TABLE {table} ADD CONSTRAINT {name} {definition} NOT VALID;".format(
+                table=table, name=name, definition=fk["definition"]
+            )
+        )
+        definitions["validate"].append(
+            "ALTER TABLE {table} VALIDATE CONSTRAINT {name};".format(
+                table=table, name=name
+            )
+        )
+
+    return definitions
+
+
+def table_exists(cursor, table):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL AS exists", (table,))
+    return cursor.fetchone()["exists"]
+
+
+def drop_definitions(cursor, definitions):
+    for sql in definitions["drop"]:
+        logger.info(sql)
+        cursor.execute(sql)
+
+
+def add_constraints(cursor, definitions):
+    """
+    Add the captured constraints back in the current transaction, raise
+    IndexRebuildException on the first one violated by the rows
+    """
+    for sql in definitions["constraints"]:
+        logger.info(sql)
+        try:
+            cursor.execute(sql)
+        except psycopg2.Error as e:
+            raise IndexRebuildException(
+                "Could not restore {}: {}".format(sql, str(e).strip())
+            ) from e
+
+
+def build_indexes(pool, statements, jobs=1):
+    """
+    Build indexes over up to `jobs` pooled connections. A statement failing
+    concurrently is retried alone before giving up, IndexRebuildException
+    lists the indexes that could not be built.
+    """
+    failed = _build(pool, statements, jobs=jobs)
+    if failed:
+        raise IndexRebuildException(
+            "Could not build the following indexes:\n" + "\n".join(failed)
+        )
+
+
+def restore_constraints(pool, definitions, jobs=1):
+    """
+    Restore the captured definitions once the rows are committed: the indexes,
+    unique ones backing a constraint included, are built over up to `jobs`
+    pooled connections, then attached and the foreign keys validated, each in
+    a short transaction. IndexRebuildException lists the definitions that
+    could not be restored, the rows staying loaded.
+    """
+    failed = _build(pool, definitions["indexes"] + definitions["unique"], jobs=jobs)
+    for sql in definitions["attach"] + definitions["validate"]:
+        if _execute(pool, sql) is not None:
+            failed.append(sql)
+
+    if failed:
+        raise IndexRebuildException(
+            "Could not restore the following definitions:\n" + "\n".join(failed)
+        )
+
+
+def _build(pool, statements, jobs=1):
+    """
+    Execute statements over up to `jobs` pooled connections, retrying alone
+    the ones failing concurrently. Return the statements that failed.
+    """
+    failed = []
+    if statements:
+        workers = min(max(jobs, 1), len(statements))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            errors = list(executor.map(lambda sql: _execute(pool, sql), statements))
+        for sql, error in zip(statements, errors):
+            if error is not None and _execute(pool, sql) is not None:
+                failed.append(sql)
+    return failed
+
+
+def _execute(pool, sql):
+    """
+    Execute a statement in its own transaction, return the error if any
+    """
+    connection = pool.getconn()
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                logger.info(sql)
+                cursor.execute(sql)
+    except psycopg2.Error as e:
+        logger.error("{}: {}".format(sql, str(e).strip()))
+        return e
+    finally:
+        pool.putconn(connection)
+    return None
+
+
+def _drop_constraint(cursor, table, name):
+    return "ALTER TABLE {table} DROP CONSTRAINT {name};".format(
+        table=table, name=psycopg2.extensions.quote_ident(name, cursor)
+    )
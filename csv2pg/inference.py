@@ -0,0 +1,108 @@
+import datetime
+import re
+
+
+INFER_SAMPLE = 10000  # default number of rows sampled to infer column types
+
+# types ordered from the narrowest to the widest, a value fitting a type also
+# fits the following ones in its family
+TYPE_FAMILIES = [
+    ["BOOLEAN"],
+    ["INTEGER", "BIGINT", "NUMERIC"],
+    ["DATE", "TIMESTAMP", "TIMESTAMPTZ"],
+]
+FALLBACK_TYPE = "TEXT"
+
+INTEGER_PATTERN = re.compile(r"^[+-]?(0|[1-9][0-9]*)$")
+# leading zeros are kept as TEXT (zip codes, identifiers...)
+NUMERIC_PATTERN = re.compile(
+    r"^[+-]?((0|[1-9][0-9]*)(\.[0-9]*)?|\.[0-9]+)([eE][+-]?[0-9]+)?$"
+)
+DATE_PATTERN = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$")
+TIMESTAMP_PATTERN = re.compile(
+    r"^[0-9]{4}-[0-9]{2}-[0-9]{2}[ T][0-9]{2}:[0-9]{2}(:[0-9]{2}(\.[0-9]{1,6})?)?$"
+)
+TIMESTAMPTZ_PATTERN = re.compile(
+    r"^([0-9]{4}-[0-9]{2}-[0-9]{2}[ T][0-9]{2}:[0-9]{2}(:[0-9]{2}(\.[0-9]{1,6})?)?)"
+    r"(Z|[+-][0-9]{2}(:?[0-9]{2})?)$"
+)
+BOOLEAN_VALUES = {"true", "false"}
+INT4_RANGE = (-(2 ** 31), 2 ** 31 - 1)
+INT8_RANGE = (-(2 ** 63), 2 ** 63 - 1)
+
+
+def infer_types(rows, columns, null=""):
+    """
+    Pick the narrowest postgres type accepting every sampled value of each column.
+
+    rows is an iterable of parsed rows, values equal to `null` are ignored and
+    rows with a wrong number of fields are skipped. Return the list of types
+    and, for each column, the (value, row number) that forced the widest type
+    or None.
+    """
+    types = [None] * len(columns)
+    forced_by = [None] * len(columns)
+    for row_number, row in enumerate(rows, 1):
+        if len(row) != len(columns):
+            continue
+        for i, value in enumerate(row):
+            if value == null or types[i] == FALLBACK_TYPE:
+                continue
+            widened = _widen(types[i], _value_type(value))
+            if widened != types[i]:
+                if types[i] is not None or widened == FALLBACK_TYPE:
+                    forced_by[i] = (value, row_number)
+                types[i] = widened
+    types = [t or FALLBACK_TYPE for t in types]
+    return types, forced_by
+
+
+def _widen(current, candidate):
+    """
+    Narrowest type accepting both types values
+    """
+    if current is None or current == candidate:
+        return candidate
+    for family in TYPE_FAMILIES:
+        if current in family and candidate in family:
+            return family[max(family.index(current), family.index(candidate))]
+    return FALLBACK_TYPE
+
+
+def _value_type(value):
+    """
+    Narrowest type accepting a value
+    """
+    if value.lower() in BOOLEAN_VALUES:
+        return "BOOLEAN"
+    if INTEGER_PATTERN.match(value):
+        number = int(value)
+        if INT4_RANGE[0] <= number <= INT4_RANGE[1]:
+            return "INTEGER"
+        if INT8_RANGE[0] <= number <= INT8_RANGE[1]:
+            return "BIGINT"
+        return "NUMERIC"
+    if NUMERIC_PATTERN.match(value):
+        return "NUMERIC"
+    if DATE_PATTERN.match(value):
+        return "DATE" if _is_datetime(value, "%Y-%m-%d") else FALLBACK_TYPE
+    if TIMESTAMP_PATTERN.match(value):
+        return "TIMESTAMP" if _is_datetime(value[:19]) else FALLBACK_TYPE
+    match = TIMESTAMPTZ_PATTERN.match(value)
+    if match:
+        return "TIMESTAMPTZ" if _is_datetime(match.group(1)[:19]) else FALLBACK_TYPE
+    return FALLBACK_TYPE
+
+
+def _is_datetime(value, format=None):
+    """
+    Check that a date or timestamp value exists in the calendar
+    """
+    if format is None:
+        format = "%Y-%m-%d %H:%M:%S" if len(value) == 19 else "%Y-%m-%d %H:%M"
+        value = value.replace("T", " ")
+    try:
+        datetime.datetime.strptime(value, format)
+    except ValueError:
+        return False
+    return True
@@ -1,26 +1,89 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import bisect
+import codecs
+import collections
 import csv
+import glob
 import io
+import itertools
 import logging
+import os
 import re
+import stat
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
+import psycopg2.pool
 from tqdm import tqdm
 
+from csv2pg.binary import (
+    HEADER as BINARY_HEADER,
+    TRAILER as BINARY_TRAILER,
+    binary_encoders,
+    encode_row,
+)
+from csv2pg.checkpoint import (
+    parse_commit_every,
+    read_checkpoint,
+    remove_checkpoint,
+    write_checkpoint,
+)
+from csv2pg.compression import ThreadedReader, decompress, detect_compression
+from csv2pg.engines import (
+    format_error,
+    get_engine,
+    inject_fields,
+    quoted_fields,
+    record_check,
+)
+from csv2pg.errfile import ErrorFile
 from csv2pg.exceptions import (
     CsvException,
-    MissingFieldsException,
-    TooManyFieldsException,
-    WrongFieldDialectException,
+    IndexRebuildException,
+    RejectedRowException,
+    WrongFieldTypeException,
+    WrongHeaderException,
+)
+from csv2pg.indexes import (
+    STAGING_SUFFIX,
+    add_constraints,
+    build_indexes,
+    capture_definitions,
+    drop_definitions,
+    restore_constraints,
+    staging_definitions,
+    table_exists,
 )
-from csv2pg.striter import StringIteratorIO
+from csv2pg.inference import INFER_SAMPLE, infer_types
+from csv2pg.report import LoadReport, write_report
+from csv2pg.split import RangeIO, is_splittable, iter_chunks, scan_quotes, split_ranges
+from csv2pg.striter import BytesIteratorIO, NewlineIO, ProgressIO, ReplayIO, TimedReader
 
 
 COPY_BUFFER = 2 ** 13  # default read buffer size for copy_expert
-FIELD_VALIDITY_PATTERN = "^([^{quotechar}]+|{quotechar}(?:[^{quotechar}]|{quotechar}{quotechar}|{escapechar}{quotechar})*{quotechar})?$"
+PROGRESS_ROWS = 10000  # refresh rate of the rows/s estimate
+SWAP_LOCK_TIMEOUT = "5s"  # maximum wait for the table lock on an atomic swap
+SWAP_ATTEMPTS = 3
+PIPELINE_CHUNK = 2 ** 16  # size of the buffers queued by --pipeline
+WORKER_DEPTH = 2  # chunks validated ahead per worker
+OPTIMISTIC_ROWS = 10000  # records sent in a savepoint by --optimistic
+OPTIMISTIC_SAVEPOINTS = 1000  # savepoints released before validating the rest
+STDIN = "-"  # filepath of the standard input
+STDIN_NAME = "stdin"  # its name in _filename and in the name of its error file
+STREAM_CHUNK = 2 ** 16  # size of the reads of a stream
+# defaults filling the injected columns with --server-inject, _rownum from a
+# temporary sequence created by each loading session
+GENERATED_DEFAULTS = {
+    "_filename": "current_setting('csv2pg.filename', true)",
+    "_rownum": "nextval('pg_temp.csv2pg_rownum'::text::regclass)",
+}
+COPY_CONTEXT_PATTERN = re.compile(r"^COPY .*?, line (\d+)(?:, column (.*?): |:|$)")
 
 logger = logging.getLogger("csv2pg")
 
@@ -50,9 +113,74 @@ def copy_to(
     overwrite=False,
     unlogged=False,
     buffer=COPY_BUFFER,
+    jobs=1,
+    compression="infer",
+    infer_types=False,
+    infer_sample=INFER_SAMPLE,
+    binary=False,
+    defer_indexes=False,
+    atomic=False,
+    truncate=False,
+    freeze=False,
+    commit_every=None,
+    resume=False,
+    optimistic=False,
+    pipeline=0,
+    workers=0,
+    report_filepath=None,
+    engine="stdlib",
+    server_inject=False,
+    max_errors=None,
+    max_error_rate=None,
+    error_dir=None,
 ):
     """
     COPY FROM 'csv' TO 'postgres'
+
+    filepath can be a path, a glob pattern or a list of them: all the files are
+    loaded in the same table, up to `jobs` at a time. "-" (the standard input)
+    and named pipes are read in a single pass: their header, and the rows
+    sampled by infer_types, are read ahead and replayed.
+    With infer_types, the table columns are typed from the first infer_sample
+    rows of the first file (0 to read it all) instead of TEXT.
+    With binary, rows are converted on the client and sent with COPY BINARY.
+    With defer_indexes, the indexes and constraints of an existing table are
+    dropped before the load. The constraints of a load in a single range are
+    restored in the loading transaction, rolled back if the rows violate them.
+    The indexes, and the constraints of a load committed in several ranges or
+    chunks, are rebuilt afterwards over `jobs` connections.
+    With atomic, the rows are loaded in an unlogged staging table, indexed like
+    the existing table, then swapped with it in a short transaction.
+    With truncate, an existing table is emptied instead of being dropped.
+    With freeze, the table is created or truncated and loaded in a single
+    transaction with COPY FREEZE.
+    With commit_every (a number of rows or a size like "512MB"), each file is
+    committed in record-aligned chunks and a checkpoint is written next to it
+    after each chunk. With resume, a load interrupted that way continues from
+    the last committed chunk.
+    The connections use the encoding of the files as client_encoding when
+    postgres supports it, unless connection_options sets it.
+    With server_inject, _filename and _rownum are filled by column defaults
+    during the load instead of being written in the rows sent, on a table
+    created by the load or the staging table of atomic only: _rownum counts
+    the records from the first line of each range, and is still written by
+    csv2pg for the rows validated with skip_error.
+    With optimistic and skip_error, the rows are not validated on the client:
+    chunks are sent in savepoints and split when the server rejects them until
+    the rejected rows are isolated and exported.
+    With pipeline, the rows are read and validated in a background thread up
+    to `pipeline` chunks ahead of the COPY.
+    With workers and skip_error, the rows are validated by a pool of `workers`
+    processes and sent back in order in the COPY of each unit.
+    With engine "arrow" and skip_error, the records are parsed by blocks with
+    the pyarrow csv reader in `workers` threads (one per core by default).
+    With skip_error, the rejected rows are exported to <file>.err, in
+    error_dir if given, created on the first error. The load is aborted with
+    ErrorBudgetException once more than max_errors rows, or a ratio of the
+    rows read above max_error_rate, are rejected.
+    Return a report of the load (bytes read, rows sent and rejected, time
+    spent in each stage), also written to report_filepath as json or as a
+    prometheus textfile if it ends with .prom.
     """
     if verbose:
         logger.setLevel(logging.INFO)
@@ -77,7 +205,88 @@ def copy_to(
         )
     )
 
-    columns = _get_columns(filepath, header, dialect, encoding=encoding)
+    filepaths = _expand_filepaths(filepath)
+    if not filepaths:
+        raise FileNotFoundError("No file matching {}".format(filepath))
+    if (max_errors is not None or max_error_rate is not None) and not skip_error:
+        logger.warning(
+            "--max-errors and --max-error-rate only apply with --skip-error: ignored"
+        )
+        max_errors = max_error_rate = None
+    if error_dir:
+        os.makedirs(error_dir, exist_ok=True)
+    report = LoadReport(
+        table, filepaths, max_errors=max_errors, max_error_rate=max_error_rate
+    )
+    streams = {}  # the streams opened, and their records read ahead
+    for fp in filepaths:
+        if _is_stream(fp):
+            records = 1
+            if infer_types and fp == filepaths[0]:
+                if not infer_sample:
+                    logger.warning(
+                        "Stream {}: --infer-sample {} instead of 0".format(
+                            fp, INFER_SAMPLE
+                        )
+                    )
+                records += infer_sample or INFER_SAMPLE
+            streams[fp] = _open_stream(
+                fp, compression, dialect, encoding=encoding, records=records
+            )
+    compressions = {
+        fp: None
+        if fp in streams
+        else detect_compression(fp)
+        if compression == "infer"
+        else compression
+        for fp in filepaths
+    }
+
+    def _ahead(fp):
+        return io.BytesIO(streams[fp][1]) if fp in streams else None
+
+    columns = _get_columns(
+        filepaths[0],
+        header,
+        dialect,
+        encoding=encoding,
+        compression=compressions[filepaths[0]],
+        stream=_ahead(filepaths[0]),
+    )
+    for fp in filepaths[1:]:
+        other_columns = _get_columns(
+            fp,
+            header,
+            dialect,
+            encoding=encoding,
+            compression=compressions[fp],
+            stream=_ahead(fp),
+        )
+        if other_columns != columns:
+            raise WrongHeaderException(
+                "{} columns {} differ from {}".format(fp, other_columns, columns),
+                None,
+            )
+
+    types = None
+    if infer_types:
+        types = _infer_types(
+            filepaths[0],
+            header,
+            columns,
+            dialect,
+            encoding=encoding,
+            null=null,
+            compression=compressions[filepaths[0]],
+            sample=infer_sample,
+            stream=_ahead(filepaths[0]),
+        )
+
+    pg_encoding = _pg_encoding(encoding)
+    if pg_encoding and "client_encoding" not in connection_options:
+        # postgres converts the rows from the encoding of the file, sent as
+        # read when there is nothing to validate
+        connection_options = dict(connection_options, client_encoding=pg_encoding)
 
     options = "{has_options}{options}".format(
         has_options="?" if bool(connection_options) else "",
@@ -103,71 +312,592 @@ def copy_to(
         options=options,
     )
 
-    db_status, db_server_version = _check_database(pg_uri)
-    if not db_status:
-        raise ConnectionError("Database connection error {}".format(pg_uri_safe))
-    logger.info(
-        "Database connection success {} [{}]".format(pg_uri_safe, db_server_version)
-    )
+    # the pool closes connections returned above minconn: keep one per job
+    with report.timer("connect"):
+        pool = psycopg2.pool.ThreadedConnectionPool(
+            max(jobs, 1),
+            max(jobs, 1),
+            pg_uri,
+            cursor_factory=psycopg2.extras.RealDictCursor,
+        )
+    try:
+        with report.timer("connect"):
+            db_status, db_server_version = _check_database(pool)
+        if not db_status:
+            raise ConnectionError("Database connection error {}".format(pg_uri_safe))
+        logger.info(
+            "Database connection success {} [{}]".format(pg_uri_safe, db_server_version)
+        )
 
-    with psycopg2.connect(
-        pg_uri, cursor_factory=psycopg2.extras.RealDictCursor
-    ) as connection:
-        with connection.cursor() as cursor:
-            if overwrite:
-                _drop_table(cursor, table, verbose=verbose)
-            _create_table(
-                cursor,
-                table,
-                columns,
-                inject_filename=inject_filename,
-                inject_rownum=inject_rownum,
-                verbose=verbose,
-                unlogged=unlogged,
+        load_table = _staging_table(table) if atomic else table
+        if freeze and jobs > 1:
+            logger.warning("--freeze loads in a single transaction: --jobs ignored")
+        if optimistic and not skip_error:
+            logger.warning("--optimistic only applies with --skip-error: ignored")
+            optimistic = False
+        if optimistic and freeze:
+            logger.warning("--optimistic copies in savepoints: --freeze ignored")
+            freeze = False
+        if workers > 1 and (not skip_error or optimistic or binary):
+            logger.warning(
+                "--workers only applies with --skip-error, without --optimistic and --binary: ignored"
             )
-            connection.commit()
-            _copy(
+            workers = 0
+        if not get_engine(engine).available:
+            logger.warning("--engine {} is not available: ignored".format(engine))
+            engine = "stdlib"
+        if engine != "stdlib" and (not skip_error or optimistic or binary):
+            logger.warning(
+                "--engine {} only applies with --skip-error, without --optimistic and --binary: ignored".format(
+                    engine
+                )
+            )
+            engine = "stdlib"
+        generated = []  # the injected columns filled by postgres
+        if server_inject:
+            if inject_filename:
+                generated.append("_filename")
+            if inject_rownum and skip_error and not optimistic:
+                logger.warning(
+                    "--server-inject does not number the rows validated by --skip-error: _rownum injected by csv2pg"
+                )
+            elif inject_rownum:
+                generated.append("_rownum")
+        chunks = None
+        if commit_every:
+            if freeze or atomic:
+                logger.warning("--commit-every ignored with --freeze and --atomic")
+            else:
+                chunks = parse_commit_every(commit_every)
+        checkpoints = {}
+        if resume and chunks:
+            checkpoints = {
+                fp: read_checkpoint(fp) for fp in filepaths if fp not in streams
+            }
+            if any(checkpoints.values()) and (overwrite or truncate):
+                logger.warning(
+                    "Resuming {}: --overwrite and --truncate ignored".format(table)
+                )
+                overwrite = truncate = False
+        # the records of --skip-error are those of its validation
+        check = record_check(dialect, columns) if skip_error else None
+        units = _split_units(
+            filepaths,
+            compressions,
+            1 if freeze or chunks else jobs,
+            dialect,
+            encoding,
+            streams={fp: stream for fp, (stream, _) in streams.items()},
+            error_dir=error_dir,
+            check=check,
+        )
+        progress_bar = None
+        if progress:
+            sizes = [_unit_size(unit) for unit in units]
+            progress_bar = _progress_bar(None if None in sizes else sum(sizes))
+
+        def _copy_cursor(cursor, unit, **options):
+            if (
+                optimistic
+                and not options
+                and _is_seekable(unit, encoding, "--optimistic")
+            ):
+                return _copy_optimistic(
+                    cursor,
+                    lambda start, end, first_line, retry, checked=False: _copy_cursor(
+                        cursor,
+                        dict(
+                            unit,
+                            start=start,
+                            end=end,
+                            first_line=first_line,
+                            err_mode="a",
+                        ),
+                        skip_error=checked,
+                        progress_bar=None if retry else progress_bar,
+                    ),
+                    unit["filepath"],
+                    header,
+                    columns,
+                    dialect,
+                    encoding=encoding,
+                    verbose=verbose,
+                    start=unit.get("start", 0),
+                    end=unit.get("end"),
+                    first_line=unit.get("first_line", 0),
+                    err_filepath=unit["err_filepath"],
+                    err_mode=unit.get("err_mode", "w"),
+                    err_header=unit.get("err_header", True),
+                    report=report,
+                )
+            return _copy(
                 cursor,
-                table,
-                filepath,
-                header,
-                columns,
-                dialect,
-                buffer_size=buffer,
-                encoding=encoding,
-                null=null,
-                skip_error=skip_error,
-                verbose=verbose,
-                progress=progress,
-                inject_rownum=inject_rownum,
-                inject_filename=inject_filename,
+                load_table,
+                **dict(
+                    dict(
+                        header=header,
+                        expected_columns=columns,
+                        dialect=dialect,
+                        buffer_size=buffer,
+                        encoding=encoding,
+                        null=null,
+                        skip_error=skip_error,
+                        verbose=verbose,
+                        progress_bar=progress_bar,
+                        inject_rownum=inject_rownum,
+                        inject_filename=inject_filename,
+                        binary=binary,
+                        freeze=freeze,
+                        pipeline=pipeline,
+                        executor=executor,
+                        workers=workers,
+                        engine=engine,
+                        server_inject=server_inject,
+                        report=report,
+                    ),
+                    **unit,
+                    **options,
+                ),
+            )
+
+        def _copy_unit(unit):
+            if chunks and _is_seekable(unit, encoding, "--commit-every"):
+                return _copy_chunks(unit)
+            connection = pool.getconn()
+            try:
+                with connection:
+                    with connection.cursor() as cursor:
+                        return _copy_cursor(cursor, unit)
+            finally:
+                pool.putconn(connection)
+
+        def _copy_chunks(unit):
+            """
+            COPY a file in chunks committed one by one, checkpointing each
+            """
+            filepath = unit["filepath"]
+            checkpoint = checkpoints.get(filepath) or {
+                "offset": 0,
+                "line": 0,
+                "rows": 0,
+                "chunks": 0,
+                "err_size": None,
+            }
+            if checkpoint["offset"]:
+                logger.info(
+                    "Resuming {} at byte {} after {} rows".format(
+                        filepath, checkpoint["offset"], checkpoint["rows"]
+                    )
+                )
+                if progress_bar is not None:
+                    progress_bar.update(checkpoint["offset"])
+                if checkpoint["err_size"] is not None and os.path.exists(
+                    unit["err_filepath"]
+                ):
+                    # drop the errors of the chunk rolled back
+                    if checkpoint["err_size"]:
+                        with io.open(unit["err_filepath"], "ab") as f_err:
+                            f_err.truncate(checkpoint["err_size"])
+                    else:
+                        os.remove(unit["err_filepath"])
+            rows, size = chunks
+            rowcount = 0
+            connection = pool.getconn()
+            try:
+                for start, end, first_line, end_line in iter_chunks(
+                    filepath,
+                    dialect,
+                    encoding=encoding,
+                    rows=rows,
+                    size=size,
+                    start=checkpoint["offset"],
+                    first_line=checkpoint["line"],
+                    check=check,
+                ):
+                    chunk = dict(
+                        unit,
+                        start=start,
+                        end=end,
+                        first_line=first_line,
+                        err_mode="a" if start else "w",
+                    )
+                    with connection:
+                        with connection.cursor() as cursor:
+                            chunk_rowcount = _copy_cursor(cursor, chunk)
+                    rowcount += chunk_rowcount
+                    checkpoint = {
+                        "offset": end,
+                        "line": end_line,
+                        "rows": checkpoint["rows"] + chunk_rowcount,
+                        "chunks": checkpoint["chunks"] + 1,
+                        "err_size": _err_size(unit["err_filepath"])
+                        if skip_error
+                        else None,
+                    }
+                    write_checkpoint(filepath, **checkpoint)
+                    logger.info(
+                        "Committed chunk {} of {}: {} rows".format(
+                            checkpoint["chunks"], filepath, checkpoint["rows"]
+                        )
+                    )
+            finally:
+                pool.putconn(connection)
+            return rowcount
+
+        executor = None
+        if get_engine(engine).threads:
+            workers = workers or os.cpu_count() or 1
+            executor = ThreadPoolExecutor(max_workers=workers)
+        elif workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers)
+        definitions = None
+        deferred = False
+        replaced = defaults = None
+        try:
+            connection = pool.getconn()
+            try:
+                with connection:
+                    with connection.cursor() as cursor:
+                        create_start = time.perf_counter()
+                        if (
+                            freeze
+                            and not (overwrite or truncate or atomic)
+                            and table_exists(cursor, load_table)
+                        ):
+                            logger.warning(
+                                "{} is neither created nor truncated: --freeze ignored".format(
+                                    load_table
+                                )
+                            )
+                            freeze = False
+                        if (
+                            generated
+                            and not (overwrite or atomic)
+                            and table_exists(cursor, load_table)
+                        ):
+                            # other sessions inserting in it would get the
+                            # defaults of the load
+                            logger.warning(
+                                "{} is neither created nor staged by --atomic: --server-inject ignored".format(
+                                    load_table
+                                )
+                            )
+                            generated = []
+                            server_inject = False
+                        if overwrite or atomic:
+                            _drop_table(cursor, load_table, verbose=verbose)
+                        if atomic and table_exists(cursor, table):
+                            _create_staging_table(cursor, load_table, table)
+                        else:
+                            _create_table(
+                                cursor,
+                                load_table,
+                                columns,
+                                inject_filename=inject_filename,
+                                inject_rownum=inject_rownum,
+                                verbose=verbose,
+                                unlogged=unlogged or atomic,
+                                types=types,
+                            )
+                        if truncate and not atomic:
+                            _truncate_table(cursor, load_table)
+                        if defer_indexes and not atomic:
+                            definitions = capture_definitions(cursor, table)
+                            drop_definitions(cursor, definitions)
+                        if generated:
+                            replaced = _set_generated_defaults(
+                                cursor, load_table, generated
+                            )
+                        report.add(create_table=time.perf_counter() - create_start)
+                        # COPY FREEZE in the transaction creating the table,
+                        # the constraints of a single range restored in the
+                        # loading transaction, the ones of several ranges
+                        # once they are committed
+                        single_transaction = freeze or bool(
+                            definitions
+                            and definitions["constraints"]
+                            and len(units) == 1
+                            and not chunks
+                        )
+                        if single_transaction:
+                            rowcount = sum(_copy_cursor(cursor, unit) for unit in units)
+                            if definitions:
+                                add_constraints(cursor, definitions)
+                                definitions = dict(
+                                    definitions, unique=[], attach=[], validate=[]
+                                )
+            finally:
+                pool.putconn(connection)
+            deferred = definitions is not None
+            defaults = replaced
+
+            if not single_transaction:
+                if len(units) == 1:
+                    rowcount = _copy_unit(units[0])
+                else:
+                    threads = min(max(jobs, 1), len(units))
+                    with ThreadPoolExecutor(max_workers=threads) as thread_pool:
+                        rowcount = sum(thread_pool.map(_copy_unit, units))
+        except Exception:
+            if atomic:
+                _drop_staging_table(pool, load_table)
+            else:
+                if defaults is not None:
+                    try:
+                        _restore_defaults(pool, load_table, defaults)
+                    except psycopg2.Error as e:
+                        logger.error(e)
+                if deferred:
+                    try:
+                        restore_constraints(pool, definitions, jobs=jobs)
+                    except IndexRebuildException as e:
+                        logger.error(e)
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if progress_bar is not None:
+                progress_bar.close()
+            if skip_error and len(filepaths) < len(units):
+                err_filepaths = [unit["err_filepath"] for unit in units]
+                _concat_files(
+                    err_filepaths[0],
+                    err_filepaths[1:],
+                    encoding=encoding,
+                    header=_error_header(columns, dialect),
+                )
+        resumed = sum(
+            checkpoint["offset"] for checkpoint in checkpoints.values() if checkpoint
+        )
+        report.add(
+            bytes_read=sum(
+                unit["stream"].tell() if unit.get("stream") else _unit_size(unit) or 0
+                for unit in units
             )
+            - resumed,
+            rows_sent=rowcount,
+        )
 
+        if defaults is not None:
+            _restore_defaults(pool, load_table, defaults)
+        if atomic:
+            _swap_table(pool, table, load_table, unlogged=unlogged, jobs=jobs)
+        elif definitions:
+            restore_constraints(pool, definitions, jobs=jobs)
+        if chunks:
+            for fp in filepaths:
+                if fp not in streams:
+                    remove_checkpoint(fp)
+    finally:
+        pool.closeall()
 
-def _check_database(uri):
+    logger.info("COPY {}".format(rowcount))
+    report.stop()
+    report = report.as_dict()
+    if report_filepath:
+        write_report(report, report_filepath)
+    return report
+
+
+def _expand_filepaths(filepath):
+    """
+    Expand a path, a glob pattern or a list of them in a list of paths, an
+    existing file being a path even if its name looks like a pattern
+    """
+    patterns = [filepath] if isinstance(filepath, str) else list(filepath)
+    filepaths = []
+    for pattern in patterns:
+        if glob.escape(pattern) != pattern and not os.path.exists(pattern):
+            filepaths.extend(sorted(glob.glob(pattern)))
+        else:
+            filepaths.append(pattern)
+    return filepaths
+
+
+def _split_units(
+    filepaths,
+    compressions,
+    jobs,
+    dialect,
+    encoding,
+    streams={},
+    error_dir=None,
+    check=None,
+):
+    """
+    Split the load in units of work: one per file, or one per byte range when
+    a single uncompressed file is loaded with several jobs and its encoding
+    can be scanned for record boundaries. streams are the file objects of the
+    filepaths read in a single pass, check the record check of --skip-error
+    (see split_ranges).
+    """
+    units = [
+        {
+            "filepath": fp,
+            "compression": compressions[fp],
+            "err_filepath": _err_filepath(fp, error_dir),
+            "stream": streams.get(fp),
+        }
+        for fp in filepaths
+    ]
+    filepath = filepaths[0]
+    if len(filepaths) > 1 or jobs <= 1 or not _is_seekable(units[0], encoding):
+        if len(filepaths) == 1 and jobs > 1:
+            _is_seekable(units[0], encoding, "--jobs")
+        return units
+
+    ranges = split_ranges(filepath, jobs, dialect, encoding=encoding, check=check)
+    err_filepath = units[0]["err_filepath"]
+    logger.info("Splitting {} in {} ranges".format(filepath, len(ranges)))
+    return [
+        {
+            "filepath": filepath,
+            "start": start,
+            "end": end,
+            "first_line": first_line,
+            "err_filepath": "{}.{}".format(err_filepath, i) if i else err_filepath,
+            "err_header": i == 0,
+        }
+        for i, (start, end, first_line) in enumerate(ranges)
+    ]
+
+
+def _err_filepath(filepath, error_dir=None):
+    """
+    Path of the file the rows of filepath rejected are exported to
+    """
+    name = STDIN_NAME if filepath == STDIN else filepath
+    if error_dir:
+        name = os.path.join(error_dir, os.path.basename(name))
+    return name + ".err"
+
+
+def _is_seekable(unit, encoding, option=None):
+    """
+    Check that a unit of work can be cut in chunks on record boundaries,
+    warning that option is ignored otherwise
+    """
+    if (
+        unit.get("stream") is not None
+        or unit.get("compression")
+        or not is_splittable(encoding)
+    ):
+        if option:
+            logger.warning(
+                "{} file {}: {} ignored".format(
+                    "Streamed"
+                    if unit.get("stream") is not None
+                    else "Compressed"
+                    if unit.get("compression")
+                    else encoding,
+                    unit["filepath"],
+                    option,
+                )
+            )
+        return False
+    return True
+
+
+def _is_stream(filepath):
+    """
+    Check if filepath is the standard input or a named pipe, that can only be
+    read once
+    """
+    return filepath == STDIN or _file_size(filepath) is None
+
+
+def _open_stream(filepath, compression, dialect, encoding="utf-8", records=1):
+    """
+    Open the standard input or a named pipe, decompressing it, and read its
+    first `records` records ahead. Return the stream, replaying the bytes
+    read ahead, and the records read ahead.
+    """
+    if filepath == STDIN:
+        raw = io.open(sys.stdin.fileno(), "rb", buffering=0, closefd=False)
+    else:
+        raw = io.open(filepath, "rb", buffering=0)
+    head = raw.read(STREAM_CHUNK) or b""
+    if compression == "infer":
+        compression = detect_compression(filepath, head=head)
+    raw = ReplayIO(head, raw)
+    if compression is not None:
+        raw = ThreadedReader(decompress(raw, compression), name=filepath)
+
+    quotechar = dialect.quotechar.encode(encoding) if dialect.quotechar else None
+    escapechar = dialect.escapechar.encode(encoding) if dialect.escapechar else None
+    if escapechar == quotechar:
+        escapechar = None
+    ahead = bytearray()
+    end = 0  # end of the last record read ahead
+    in_quote = False
+    while records:
+        newline = ahead.find(b"\n", end)
+        if newline < 0:
+            data = raw.read(STREAM_CHUNK)
+            if not data:
+                end = len(ahead)
+                break
+            ahead += data
+            continue
+        if quotechar is not None:
+            in_quote, _ = scan_quotes(
+                ahead, end, newline + 1, quotechar, escapechar, in_quote, False
+            )
+        end = newline + 1
+        if not in_quote:
+            records -= 1
+    ahead = bytes(ahead)
+    name = STDIN_NAME if filepath == STDIN else filepath
+    return ReplayIO(ahead, raw, name=name), ahead[:end]
+
+
+def _unit_size(unit):
+    """
+    Number of bytes to read for a unit of work, None if unknown
+    """
+    if unit.get("stream") is not None:
+        return None
+    if unit.get("end") is not None:
+        return unit["end"] - unit.get("start", 0)
+    return _file_size(unit["filepath"])
+
+
+def _check_database(pool):
     """
     Check db connection
     """
     status = False
     server_version = None
     try:
-        with psycopg2.connect(
-            uri, cursor_factory=psycopg2.extras.RealDictCursor
-        ) as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT 1")
-                server_version = connection.get_parameter_status("server_version")
+        connection = pool.getconn()
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                    server_version = connection.get_parameter_status("server_version")
+        finally:
+            pool.putconn(connection)
     except psycopg2.OperationalError:
         pass
     status = True
     return status, server_version
 
 
-def _get_columns(filepath, header, dialect, encoding="utf-8"):
+def _get_columns(
+    filepath, header, dialect, encoding="utf-8", compression=None, stream=None
+):
     """
-    Extracting columns from csv file. If --no-header is specified, return generic columns.
+    Extracting columns from csv file, or from stream, the records read ahead of
+    it. If --no-header is specified, return generic columns.
     """
-    with io.open(filepath, "r", newline="", encoding=encoding) as f:
+    with _open_range(
+        filepath,
+        mode="r",
+        encoding=encoding,
+        newline="",
+        compression=compression,
+        stream=stream,
+    ) as f:
         reader = csv.reader(f, dialect=dialect)
         try:
             line = next(reader)
@@ -179,6 +909,48 @@ def _get_columns(filepath, header, dialect, encoding="utf-8"):
     return columns
 
 
+def _infer_types(
+    filepath,
+    header,
+    columns,
+    dialect,
+    encoding="utf-8",
+    null="",
+    compression=None,
+    sample=INFER_SAMPLE,
+    stream=None,
+):
+    """
+    Infer the postgres type of each column from a sample of the csv rows
+    (read from stream, the records read ahead of a stream, if given)
+    """
+    with _open_range(
+        filepath,
+        mode="r",
+        encoding=encoding,
+        newline="",
+        compression=compression,
+        stream=stream,
+    ) as f:
+        reader = csv.reader(f, dialect=dialect)
+        if header:
+            next(reader, None)
+        rows = itertools.islice(reader, sample or None)
+        types, forced_by = infer_types(rows, columns, null=null)
+
+    for column, type, forced in zip(columns, types, forced_by):
+        if forced:
+            value, row_number = forced
+            logger.info(
+                "Column {} inferred as {}, forced by {} at row {}".format(
+                    column, type, repr(value), row_number
+                )
+            )
+        else:
+            logger.info("Column {} inferred as {}".format(column, type))
+    return types
+
+
 def _default_columns(values):
     """
     Generate generic column array
@@ -193,6 +965,24 @@ def _drop_table(cursor, table, verbose=False):
     _log_cursor_execution(cursor)
 
 
+def _create_staging_table(cursor, staging, table):
+    """
+    Create an unlogged copy of a table definition without its indexes, built
+    after the load
+    """
+    sql = "CREATE UNLOGGED TABLE {staging} (LIKE {table} INCLUDING ALL EXCLUDING INDEXES);".format(
+        staging=staging, table=table
+    )
+    cursor.execute(sql)
+    _log_cursor_execution(cursor)
+
+
+def _truncate_table(cursor, table):
+    sql = "TRUNCATE {table};".format(table=table)
+    cursor.execute(sql)
+    _log_cursor_execution(cursor)
+
+
 def _create_table(
     cursor,
     table,
@@ -201,9 +991,12 @@ def _create_table(
     inject_filename=False,
     verbose=False,
     unlogged=False,
+    types=None,
 ):
+    types = types or ["TEXT"] * len(columns)
     columns_sql = ", \n".join(
-        '    "{column}" TEXT'.format(column=column) for column in columns
+        '    "{column}" {type}'.format(column=column, type=type)
+        for column, type in zip(columns, types)
     )
     if inject_rownum:
         columns_sql = "_rownum INTEGER,\n" + columns_sql
@@ -217,6 +1010,157 @@ def _create_table(
     _log_cursor_execution(cursor)
 
 
+def _set_generated_defaults(cursor, table, generated):
+    """
+    Make postgres fill the generated columns of a table during the load,
+    from a setting of the transaction (_filename) and from a sequence of the
+    session (_rownum), see _set_generated. Return their previous defaults.
+    """
+    cursor.execute(
+        "SELECT attname AS column, pg_get_expr(adbin, adrelid) AS expression "
+        "FROM pg_attribute LEFT JOIN pg_attrdef "
+        "ON adrelid = attrelid AND adnum = attnum "
+        "WHERE attrelid = %s::regclass AND attname = ANY(%s)",
+        (table, generated),
+    )
+    defaults = {row["column"]: row["expression"] for row in cursor.fetchall()}
+    sql = "ALTER TABLE {table} {defaults};".format(
+        table=table,
+        defaults=", ".join(
+            "ALTER COLUMN {} SET DEFAULT {}".format(column, GENERATED_DEFAULTS[column])
+            for column in generated
+        ),
+    )
+    cursor.execute(sql)
+    _log_cursor_execution(cursor)
+    return defaults
+
+
+def _restore_defaults(pool, table, defaults):
+    """
+    Restore the column defaults replaced by _set_generated_defaults
+    """
+    sql = "ALTER TABLE {table} {defaults};".format(
+        table=table,
+        defaults=", ".join(
+            "ALTER COLUMN {} SET DEFAULT {}".format(column, expression)
+            if expression
+            else "ALTER COLUMN {} DROP DEFAULT".format(column)
+            for column, expression in defaults.items()
+        ),
+    )
+    connection = pool.getconn()
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+                _log_cursor_execution(cursor)
+    finally:
+        pool.putconn(connection)
+
+
+def _set_generated(cursor, generated, filename, rownum):
+    """
+    Set the values of the generated columns for the next COPY: _filename,
+    and _rownum of its first row, numbered in the order of the COPY
+    """
+    if "_filename" in generated:
+        cursor.execute("SELECT set_config('csv2pg.filename', %s, true)", (filename,))
+    if "_rownum" in generated:
+        cursor.execute("CREATE TEMPORARY SEQUENCE IF NOT EXISTS csv2pg_rownum")
+        cursor.execute("SELECT setval('pg_temp.csv2pg_rownum', %s, false)", (rownum,))
+
+
+def _staging_table(table):
+    schema, _, name = table.rpartition(".")
+    return "{}{}{}".format(schema + "." if schema else "", name, STAGING_SUFFIX)
+
+
+def _drop_staging_table(pool, staging):
+    connection = pool.getconn()
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                _drop_table(cursor, staging)
+    finally:
+        pool.putconn(connection)
+
+
+def _swap_table(pool, table, staging, unlogged=False, jobs=1):
+    """
+    Replace a table by its loaded staging table. The staging table is made
+    logged, indexed and analyzed first so that the swap only holds its lock
+    for a drop and a few renames.
+    """
+    try:
+        connection = pool.getconn()
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    definitions = staging_definitions(cursor, table, staging)
+                    if not unlogged:
+                        cursor.execute("ALTER TABLE {} SET LOGGED;".format(staging))
+                        _log_cursor_execution(cursor)
+        finally:
+            pool.putconn(connection)
+
+        build_indexes(pool, definitions["indexes"], jobs=jobs)
+
+        connection = pool.getconn()
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("ANALYZE {};".format(staging))
+                    _log_cursor_execution(cursor)
+            for attempt in range(1, SWAP_ATTEMPTS + 1):
+                try:
+                    with connection:
+                        with connection.cursor() as cursor:
+                            _rename_table(cursor, table, staging, definitions)
+                    break
+                except psycopg2.errors.LockNotAvailable:
+                    if attempt == SWAP_ATTEMPTS:
+                        raise
+                    logger.warning(
+                        "Lock timeout swapping {} (attempt {}/{})".format(
+                            table, attempt, SWAP_ATTEMPTS
+                        )
+                    )
+        finally:
+            pool.putconn(connection)
+    except Exception:
+        _drop_staging_table(pool, staging)
+        raise
+
+    connection = pool.getconn()
+    try:
+        for sql in definitions["validate"]:
+            try:
+                with connection:
+                    with connection.cursor() as cursor:
+                        logger.info(sql)
+                        cursor.execute(sql)
+            except psycopg2.Error as e:
+                logger.warning("{}: {}".format(sql, str(e).strip()))
+    finally:
+        pool.putconn(connection)
+
+
+def _rename_table(cursor, table, staging, definitions):
+    cursor.execute("SET LOCAL lock_timeout = %s;", (SWAP_LOCK_TIMEOUT,))
+    for sql in definitions["sequences"]:
+        logger.info(sql)
+        cursor.execute(sql)
+    _drop_table(cursor, table)
+    cursor.execute(
+        "ALTER TABLE {} RENAME TO {};".format(staging, table.rpartition(".")[2])
+    )
+    _log_cursor_execution(cursor)
+    for sql in definitions["swap"]:
+        logger.info(sql)
+        cursor.execute(sql)
+
+
 def _log_cursor_execution(cursor):
     logger.info(cursor.statusmessage)
     try:
@@ -237,38 +1181,213 @@ def _copy(
     null="",
     skip_error=False,
     verbose=False,
-    progress=False,
+    progress_bar=None,
     inject_rownum=False,
     inject_filename=False,
+    start=0,
+    end=None,
+    first_line=0,
+    err_filepath=None,
+    compression=None,
+    binary=False,
+    freeze=False,
+    err_mode="w",
+    err_header=True,
+    pipeline=0,
+    executor=None,
+    workers=1,
+    engine="stdlib",
+    report=None,
+    stream=None,
+    server_inject=False,
 ):
-    sql = "COPY {table} FROM STDIN WITH CSV DELIMITER {delimiter} NULL {null}{quote}{escape}{header}".format(
-        table=table,
-        delimiter=psycopg2.extensions.adapt(dialect.delimiter),
-        null=psycopg2.extensions.adapt(null),
-        quote=" QUOTE {}".format(psycopg2.extensions.adapt(dialect.quotechar))
-        if dialect.quotechar
-        else "",
-        escape=" ESCAPE {}".format(psycopg2.extensions.adapt(dialect.escapechar))
-        if dialect.escapechar
-        else "",
-        header=" HEADER" if header else "",
-    )
+    """
+    COPY the [start, end) byte range of a csv file, first_line being the number
+    of lines preceding the range, or the whole stream if given (a file object
+    opened by _open_stream). Return the number of inserted rows.
+    With binary, rows are parsed and sent in the COPY binary format when all
+    the table column types are supported.
+    With freeze, the table must have been created or truncated in the current
+    transaction.
+    err_mode is the mode the error file is opened with, "a" to append to it,
+    the file being created on the first error, with a header row if
+    err_header.
+    With pipeline, the file is read up to `pipeline` chunks ahead of the COPY
+    by a background thread.
+    With executor (a process pool of `workers`) and skip_error, the records
+    are validated by chunks in the pool when the file can be cut on record
+    boundaries, by the pyarrow csv reader in threads with engine "arrow".
+    With server_inject, the injected columns are filled by the defaults set by
+    _set_generated_defaults, except _rownum with skip_error.
+    The bytes, rejected rows and time spent in each stage are added to report.
+    """
+    client_encoding = psycopg2.extensions.encodings[cursor.connection.encoding]
+    generated = []  # the injected columns filled by postgres
+    if server_inject:
+        if inject_filename:
+            generated.append("_filename")
+            inject_filename = False
+        if inject_rownum and not skip_error:
+            generated.append("_rownum")
+            inject_rownum = False
+    target = table
+    if generated:
+        target = "{table} ({columns})".format(
+            table=table,
+            columns=", ".join(
+                (["_filename"] if inject_filename else [])
+                + (["_rownum"] if inject_rownum else [])
+                + ['"{}"'.format(column) for column in expected_columns]
+            ),
+        )
+    encoders = None
+    if binary:
+        try:
+            encoders = binary_encoders(
+                _get_table_types(cursor, table, exclude=generated),
+                encoding=client_encoding,
+                timezone=_get_timezone(cursor),
+            )
+        except ValueError as e:
+            logger.warning("{}, falling back to csv COPY".format(e))
 
-    line_count = 0
-    if progress:
-        logger.info("Estimating file size...")
-        with open(filepath, "rb") as f:
-            for line in f:
-                line_count += 1
+    parallel = (
+        executor is not None
+        and skip_error
+        and encoders is None
+        and _is_seekable(
+            {"filepath": filepath, "compression": compression, "stream": stream},
+            encoding,
+            "--workers" if engine == "stdlib" else "--engine {}".format(engine),
+        )
+    )
+    standard_csv = parallel and get_engine(engine).standard_csv
+    # with nothing to do per line, the records are sent as read (the
+    # client_encoding being the file encoding), otherwise they are decoded and
+    # sent in utf-8: postgres converts them either way
+    raw = (
+        encoders is None
+        and not (skip_error or inject_rownum or inject_filename)
+        and _is_client_encoding(encoding, cursor.connection)
+    )
+    text_encoding = "utf-8"
+    if standard_csv:
+        # the records are written back by the engine: standard csv in utf-8
+        sql = (
+            "COPY {table} FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8'{freeze})".format(
+                table=target, freeze=", FREEZE" if freeze else ""
+            )
+        )
+    elif encoders is not None:
+        sql = "COPY {table} FROM STDIN WITH BINARY".format(table=target)
+    else:
+        sql = "COPY {table} FROM STDIN WITH CSV DELIMITER {delimiter} NULL {null}{quote}{escape}{header}{encoding}".format(
+            table=target,
+            delimiter=psycopg2.extensions.adapt(dialect.delimiter),
+            null=psycopg2.extensions.adapt(null),
+            quote=" QUOTE {}".format(psycopg2.extensions.adapt(dialect.quotechar))
+            if dialect.quotechar
+            else "",
+            escape=" ESCAPE {}".format(psycopg2.extensions.adapt(dialect.escapechar))
+            if dialect.escapechar
+            else "",
+            header=" HEADER" if header and start == 0 else "",
+            encoding=""
+            if raw or _is_client_encoding(text_encoding, cursor.connection)
+            else " ENCODING 'UTF8'",
+        )
+    if freeze and not standard_csv:
+        sql += " FREEZE"
 
     logger.info(sql)
+    if generated:
+        _set_generated(
+            cursor,
+            generated,
+            (stream.name if stream is not None else filepath).split("/")[-1],
+            first_line + 1 if start == 0 or not header else first_line,
+        )
+
+    if raw:
+        # Nothing to do per line: stream raw bytes to postgres, translating
+        # line endings like the text path
+        with _open_range(
+            filepath,
+            start,
+            end,
+            "rb",
+            progress_bar=progress_bar,
+            compression=compression,
+            stream=stream,
+        ) as f_in:
+            reader = TimedReader(f_in)
+            _copy_stream(
+                cursor, sql, reader, buffer_size, pipeline=pipeline, report=report
+            )
+        if report is not None:
+            report.add(read=reader.seconds)
+        return cursor.rowcount
 
-    with io.open(filepath, "r", encoding=encoding) as f_in:
+    err_header = _error_header(expected_columns, dialect) if err_header else None
+    if parallel:
+        err_filepath = err_filepath or filepath + ".err"
+        with ErrorFile(
+            err_filepath, err_mode, encoding=encoding, header=err_header
+        ) as f_err:
+            wrapper = BytesIteratorIO(
+                _wrap_parallel(
+                    executor,
+                    workers,
+                    filepath,
+                    f_err,
+                    dialect,
+                    header,
+                    expected_columns,
+                    encoding=encoding,
+                    client_encoding=text_encoding,
+                    verbose=verbose,
+                    progress_bar=progress_bar,
+                    inject_rownum=inject_rownum,
+                    inject_filename=inject_filename,
+                    start=start,
+                    end=end,
+                    first_line=first_line,
+                    null=null,
+                    engine=engine,
+                    report=report,
+                ),
+                encoding=None,
+            )
+            _copy_stream(
+                cursor,
+                sql,
+                wrapper,
+                buffer_size,
+                pipeline=pipeline,
+                name=filepath,
+                report=report,
+            )
+        return cursor.rowcount
+
+    with _open_range(
+        filepath,
+        start,
+        end,
+        "r",
+        encoding=encoding,
+        progress_bar=progress_bar,
+        compression=compression,
+        stream=stream,
+    ) as f_in:
+        f_err = None
         if skip_error:
-            err_filepath = filepath + ".err"
-            # TODO: only create err file if errors are found
-            with io.open(err_filepath, "w", encoding=encoding) as f_err:
-                wrapper = StringIteratorIO(
+            err_filepath = err_filepath or filepath + ".err"
+            f_err = ErrorFile(
+                err_filepath, err_mode, encoding=encoding, header=err_header
+            )
+        try:
+            if encoders is None:
+                wrapper = BytesIteratorIO(
                     _wrap(
                         f_in,
                         f_err,
@@ -276,31 +1395,457 @@ def _copy(
                         header,
                         expected_columns,
                         verbose=verbose,
-                        progress=progress,
-                        progress_total=line_count,
+                        progress_bar=progress_bar,
                         inject_rownum=inject_rownum,
                         inject_filename=inject_filename,
-                    )
+                        first_line=first_line,
+                        engine=engine,
+                        report=report,
+                    ),
+                    encoding=text_encoding,
                 )
-                cursor.copy_expert(sql, wrapper, size=buffer_size)
-        else:
-            wrapper = StringIteratorIO(
-                _wrap(
-                    f_in,
-                    None,
-                    dialect,
-                    header,
-                    expected_columns,
-                    verbose=verbose,
-                    progress=progress,
-                    progress_total=line_count,
-                    inject_rownum=inject_rownum,
-                    inject_filename=inject_filename,
+            else:
+                wrapper = BytesIteratorIO(
+                    _wrap_binary(
+                        f_in,
+                        f_err,
+                        dialect,
+                        header,
+                        expected_columns,
+                        encoders,
+                        null=null,
+                        verbose=verbose,
+                        progress_bar=progress_bar,
+                        inject_rownum=inject_rownum,
+                        inject_filename=inject_filename,
+                        first_line=first_line,
+                        engine=engine,
+                        report=report,
+                    ),
+                    encoding=None,
                 )
+            _copy_stream(
+                cursor,
+                sql,
+                wrapper,
+                buffer_size,
+                pipeline=pipeline,
+                name=filepath,
+                report=report,
             )
-            cursor.copy_expert(sql, wrapper, size=buffer_size)
+        finally:
+            if f_err is not None:
+                f_err.close()
+
+    return cursor.rowcount
+
+
+def _copy_stream(cursor, sql, f, buffer_size, pipeline=0, name=None, report=None):
+    """
+    COPY a binary stream, read by a background thread up to `pipeline` chunks
+    ahead when pipeline is set, logging where each stage of the pipeline
+    waited for the other. The time COPY did not spend reading the stream
+    (sending it and waiting for the server) is added to report.
+    An exception raised reading the stream, that psycopg2 reports as the COPY
+    canceled, is raised as is.
+    """
+    if not pipeline:
+        timed = TimedReader(f)
+        start = time.perf_counter()
+        try:
+            _copy_expert(cursor, sql, timed, buffer_size)
+        finally:
+            if report is not None:
+                report.add(copy=time.perf_counter() - start - timed.seconds)
+        return
+
+    name = name or getattr(f, "name", None)
+    reader = ThreadedReader(f, name=name, chunk_size=PIPELINE_CHUNK, depth=pipeline)
+    timed = TimedReader(reader)
+    start = time.perf_counter()
+    try:
+        _copy_expert(cursor, sql, timed, buffer_size)
+    finally:
+        reader.close()
+        elapsed = time.perf_counter() - start
+        if report is not None:
+            report.add(copy=elapsed - timed.seconds)
+        timings = reader.timings
+        logger.info(
+            "Pipeline {name}: reader {read:.3f}s (cpu {cpu:.3f}s, io {io:.3f}s) "
+            "waiting for COPY {read_stall:.3f}s, "
+            "COPY {copy:.3f}s waiting for reader {consume_stall:.3f}s".format(
+                name=name,
+                read=timings["read"],
+                cpu=timings["read_cpu"],
+                io=max(timings["read"] - timings["read_cpu"], 0),
+                read_stall=timings["read_stall"],
+                copy=elapsed,
+                consume_stall=timings["consume_stall"],
+            )
+        )
+
+
+def _copy_expert(cursor, sql, timed, buffer_size):
+    try:
+        cursor.copy_expert(sql, timed, size=buffer_size)
+    except psycopg2.errors.QueryCanceled:
+        if timed.error is None:
+            raise
+        raise timed.error
+
+
+def _copy_optimistic(
+    cursor,
+    copy_range,
+    filepath,
+    header,
+    expected_columns,
+    dialect,
+    encoding="utf-8",
+    verbose=False,
+    start=0,
+    end=None,
+    first_line=0,
+    err_filepath=None,
+    err_mode="w",
+    err_header=True,
+    report=None,
+):
+    """
+    COPY the [start, end) byte range of a csv file in chunks of
+    OPTIMISTIC_ROWS records, each in a savepoint, without validating them.
+    A chunk rejected by the server is split around the record it reports (or
+    in halves) and copied again until the rejected records are isolated and
+    exported to the error file. The records are those of the --skip-error
+    validation. Once OPTIMISTIC_SAVEPOINTS savepoints are released, the rest
+    of the range is validated on the client. Return the number of inserted
+    rows.
+
+    copy_range(start, end, first_line, retry, checked=False) copies a range
+    of records without validation (with it if checked), counting its bytes
+    in the progress bar unless retry.
+    The accepted and rejected records are counted in report.
+    """
+    filename = os.path.basename(filepath)
+    generated_header = ["_rownum", "_error"] + expected_columns
+    check = record_check(dialect, expected_columns)
+    rowcount = 0
+    released = 0  # savepoints released, each holding a lock until the commit
+    resume = None  # (offset, line) the client validation starts from
+    with ErrorFile(
+        err_filepath or filepath + ".err",
+        err_mode,
+        encoding=encoding,
+        header=_error_header(expected_columns, dialect) if err_header else None,
+    ) as f_err:
+        writer = csv.writer(f_err, dialect=dialect)
+        pending = []
+        for chunk in iter_chunks(
+            filepath,
+            dialect,
+            encoding=encoding,
+            rows=OPTIMISTIC_ROWS,
+            start=start,
+            end=end,
+            first_line=first_line,
+            check=check,
+        ):
+            if released >= OPTIMISTIC_SAVEPOINTS:
+                resume = chunk[0], chunk[2]
+                break
+            chunk_rowcount, error = _copy_savepoint(cursor, copy_range, [chunk])
+            if error is None:
+                released += 1
+                rowcount += chunk_rowcount
+                if report is not None:
+                    report.accept(chunk_rowcount)
+                continue
+
+            # split the rejected chunk in records
+            pending = [
+                (
+                    list(
+                        iter_chunks(
+                            filepath,
+                            dialect,
+                            encoding=encoding,
+                            rows=1,
+                            start=chunk[0],
+                            end=chunk[1],
+                            first_line=chunk[2],
+                            check=check,
+                        )
+                    ),
+                    error,
+                )
+            ]
+            while pending and released < OPTIMISTIC_SAVEPOINTS:
+                records, error = pending.pop()
+                if len(records) == 1:
+                    record_start, record_end, record_line, _ = records[0]
+                    with RangeIO(filepath, record_start, record_end) as f:
+                        record = f.read().decode(encoding)
+                    parsed_line = next(
+                        csv.reader(io.StringIO(record, newline=""), dialect=dialect),
+                        [],
+                    )
+                    if not isinstance(error, CsvException):
+                        error = _rejected_row(error, expected_columns)
+                    writer.writerow(
+                        format_error(
+                            filename,
+                            parsed_line,
+                            record_line if header else record_line + 1,
+                            generated_header,
+                            error,
+                            verbose,
+                        )
+                    )
+                    if report is not None:
+                        report.reject(error)
+                    continue
+                k = _rejected_record(error, records)
+                if k is None:
+                    half = len(records) // 2
+                    parts = [records[:half], records[half:]]
+                else:
+                    parts = [records[:k], records[k : k + 1], records[k + 1 :]]
+                retried = []
+                for part in filter(None, parts):
+                    part_rowcount, part_error = _copy_savepoint(
+                        cursor, copy_range, part, retry=True
+                    )
+                    if part_error is not None:
+                        retried.append((part, part_error))
+                        continue
+                    released += 1
+                    rowcount += part_rowcount
+                    if report is not None:
+                        report.accept(part_rowcount)
+                pending.extend(reversed(retried))
+            if released >= OPTIMISTIC_SAVEPOINTS:
+                resume = chunk[1], chunk[3]
+                break
+
+        if resume is not None:
+            # too many rejected records: validate the rest on the client
+            logger.warning(
+                "{} savepoints released in {}: the rest of the range is validated on the client".format(
+                    released, filepath
+                )
+            )
+            f_err.flush()
+            for records, _ in reversed(pending):
+                rowcount += copy_range(
+                    records[0][0], records[-1][1], records[0][2], True, checked=True
+                )
+            if end is None or resume[0] < end:
+                rowcount += copy_range(resume[0], end, resume[1], False, checked=True)
+    if report is not None:
+        report.accept(0, final=True)
+
+    return rowcount
+
+
+def _copy_savepoint(cursor, copy_range, records, retry=False):
+    """
+    COPY consecutive records in a savepoint rolled back if the server rejects
+    them. Return a (rowcount, error) tuple.
+    """
+    cursor.execute("SAVEPOINT csv2pg_chunk")
+    try:
+        rowcount = copy_range(records[0][0], records[-1][1], records[0][2], retry)
+    except (psycopg2.DataError, psycopg2.IntegrityError, CsvException) as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT csv2pg_chunk")
+        return None, e
+    cursor.execute("RELEASE SAVEPOINT csv2pg_chunk")
+    return rowcount, None
+
+
+def _rejected_record(error, records):
+    """
+    Index of the record ending on the line reported in a COPY error context
+    (the physical line counted from the start of the COPY), None if unknown
+    """
+    diag = getattr(error, "diag", None)
+    match = COPY_CONTEXT_PATTERN.match(getattr(diag, "context", None) or "")
+    if not match:
+        return None
+    line = records[0][2] + int(match.group(1))
+    k = bisect.bisect_left([end_line for _, _, _, end_line in records], line)
+    return k if k < len(records) else None
+
+
+def _rejected_row(error, expected_columns):
+    """
+    RejectedRowException from a psycopg2 error, with the index of the column
+    reported in its context if any
+    """
+    match = COPY_CONTEXT_PATTERN.match(error.diag.context or "")
+    column = match.group(2) if match else None
+    field_number = (
+        expected_columns.index(column) if column in expected_columns else None
+    )
+    return RejectedRowException(
+        (error.diag.message_primary or str(error)).strip(), field_number
+    )
+
+
+def _get_table_types(cursor, table, exclude=()):
+    """
+    Postgres type names of the table columns, but the excluded ones
+    """
+    cursor.execute(
+        "SELECT format_type(atttypid, NULL) AS type FROM pg_attribute "
+        "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped "
+        "AND attname <> ALL(%s) ORDER BY attnum",
+        (table, list(exclude)),
+    )
+    return [row["type"] for row in cursor.fetchall()]
+
+
+def _get_timezone(cursor):
+    cursor.execute("SELECT current_setting('TimeZone') AS timezone")
+    return cursor.fetchone()["timezone"]
+
+
+def _progress_bar(total):
+    """
+    Progress bar counting bytes read, shared by all the units of work
+    """
+    progress_bar = tqdm(total=total, unit="B", unit_scale=True, unit_divisor=1024)
+    progress_bar.rows = 0
+    return progress_bar
+
+
+def _progress_rows(progress_bar, rows):
+    """
+    Add rows to the rows/s estimate of a progress bar
+    """
+    with progress_bar.get_lock():
+        progress_bar.rows += rows
+        elapsed = progress_bar.format_dict["elapsed"] or 1
+        progress_bar.set_postfix_str(
+            "{} rows, {:.0f} rows/s".format(
+                progress_bar.rows, progress_bar.rows / elapsed
+            ),
+            refresh=False,
+        )
+
+
+def _file_size(filepath):
+    """
+    Size of a regular file, None for pipes and other streams
+    """
+    st = os.stat(filepath)
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
 
-    logger.info("COPY {}".format(cursor.rowcount))
+def _err_size(filepath):
+    """
+    Size of an error file, 0 if it was not created
+    """
+    return os.path.getsize(filepath) if os.path.exists(filepath) else 0
+
+
+def _pg_encoding(encoding):
+    """
+    Name of a python codec in postgres, None if postgres does not support it
+    """
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return None
+    return next(
+        (
+            pg_encoding
+            for pg_encoding, python_encoding in psycopg2.extensions.encodings.items()
+            if codecs.lookup(python_encoding).name == name
+            and pg_encoding != "SQL_ASCII"
+        ),
+        None,
+    )
+
+
+def _is_client_encoding(encoding, connection):
+    """
+    Check if a python codec is the one used by the connection client_encoding
+    """
+    try:
+        client_encoding = psycopg2.extensions.encodings[connection.encoding]
+        return codecs.lookup(encoding).name == codecs.lookup(client_encoding).name
+    except (KeyError, LookupError):
+        return False
+
+
+def _open_range(
+    filepath,
+    start=0,
+    end=None,
+    mode="r",
+    encoding=None,
+    newline=None,
+    progress_bar=None,
+    compression=None,
+    stream=None,
+):
+    """
+    Open the [start, end) byte range of a file (or a binary stream instead) in
+    text or binary mode, counting the bytes read in progress_bar and
+    decompressing them in a background thread. In binary mode, newline=None
+    translates line endings like in text mode.
+    """
+    binary = "b" in mode
+    if (
+        stream is None
+        and start == 0
+        and end is None
+        and progress_bar is None
+        and compression is None
+    ):
+        if not binary:
+            return io.open(filepath, mode, encoding=encoding, newline=newline)
+        raw = io.open(filepath, mode, buffering=0)
+    else:
+        raw = RangeIO(filepath, start, end) if stream is None else stream
+        if progress_bar is not None:
+            raw = ProgressIO(raw, progress_bar)
+        if compression is not None:
+            raw = ThreadedReader(decompress(raw, compression), name=filepath)
+    if binary and newline is None:
+        raw = NewlineIO(raw)
+    f = io.BufferedReader(raw)
+    if binary:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding, newline=newline)
+
+
+def _concat_files(filepath, parts, encoding="utf-8", header=None):
+    """
+    Append the error files parts to filepath in order, removing them.
+    filepath is created with header if it does not exist.
+    """
+    with ErrorFile(filepath, "a", encoding=encoding, header=header) as f_out:
+        for part in parts:
+            if not os.path.exists(part):
+                continue
+            with io.open(part, encoding=encoding, newline="") as f_in:
+                while True:
+                    chunk = f_in.read(COPY_BUFFER)
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+            os.remove(part)
+
+
+def _error_header(expected_columns, dialect):
+    """
+    Header row of the error files
+    """
+    f = io.StringIO()
+    csv.writer(f, dialect=dialect).writerow(["_rownum", "_error"] + expected_columns)
+    return f.getvalue()
 
 
 def _wrap(
@@ -310,87 +1855,309 @@ def _wrap(
     header,
     expected_columns,
     verbose=False,
-    progress=False,
-    progress_total=None,
+    progress_bar=None,
     inject_rownum=False,
     inject_filename=False,
+    first_line=0,
+    engine="stdlib",
+    report=None,
 ):
     filename = f_in.name.split("/")[-1]
-    field_pattern = re.compile(
-        FIELD_VALIDITY_PATTERN.format(
-            quotechar=dialect.quotechar, escapechar=dialect.escapechar
+    f_in = TimedReader(f_in)
+    if f_err:
+        records = (
+            (i, record)
+            for i, record, _ in get_engine(engine).records(
+                f_in,
+                f_err,
+                dialect,
+                header,
+                expected_columns,
+                filename,
+                verbose=verbose,
+                first_line=first_line,
+                report=report,
+            )
         )
-    )
+    elif inject_rownum or inject_filename:
+        records = _iter_records(f_in, dialect, first_line=first_line)
+    else:
+        records = enumerate(f_in, first_line)
 
-    generated_header = []
-    writer = csv.writer(f_err, dialect=dialect) if f_err else None
-    for i, line in tqdm(enumerate(f_in), disable=not progress, total=progress_total):
-        line_number = i if header else i + 1
-        reader = csv.reader([line], dialect=dialect)
-        for r in reader:
-            parsed_line = r
-            break
-
-        if f_err:
-            # Init error file
-            if i == 0:
-                if header:
-                    generated_header = ["_rownum", "_error"] + parsed_line
-                else:
-                    generated_header = ["_rownum", "_error"] + expected_columns
-                writer.writerow(generated_header)
-            # Check line and skip
-            try:
-                _check_line(expected_columns, parsed_line, field_pattern)
-            except CsvException as e:
-                err_row = _format_error(
-                    filename, parsed_line, line_number, generated_header, e, verbose
+    # time spent reading and validating the records, and injecting fields
+    clock = time.perf_counter
+    validate = inject = 0.0
+    try:
+        start = clock()
+        for rows, (i, line) in enumerate(records, 1):
+            injecting = clock()
+            validate += injecting - start
+            line_number = i if header else i + 1
+            if progress_bar is not None and not rows % PROGRESS_ROWS:
+                _progress_rows(progress_bar, PROGRESS_ROWS)
+
+            # Inject extra fields in line before insertion
+            if inject_rownum or inject_filename:
+                line = inject_fields(
+                    line,
+                    dialect.delimiter,
+                    rownum=line_number if inject_rownum else None,
+                    filename=filename if inject_filename else None,
                 )
-                writer.writerow(err_row)
-                continue
+            inject += clock() - injecting
 
-        # Inject extra fields in line before insertion
-        if inject_rownum:
-            line = "{value}{delimiter}{line}".format(
-                value=line_number, delimiter=dialect.delimiter, line=line
+            yield line
+            start = clock()
+        validate += clock() - start
+    finally:
+        if report is not None:
+            report.add(
+                read=f_in.seconds, validate=validate - f_in.seconds, inject=inject
             )
-        if inject_filename:
-            line = "{value}{delimiter}{line}".format(
-                value=filename, delimiter=dialect.delimiter, line=line
+
+
+def _wrap_parallel(
+    executor,
+    workers,
+    filepath,
+    f_err,
+    dialect,
+    header,
+    expected_columns,
+    encoding="utf-8",
+    client_encoding="utf-8",
+    verbose=False,
+    progress_bar=None,
+    inject_rownum=False,
+    inject_filename=False,
+    start=0,
+    end=None,
+    first_line=0,
+    null="",
+    engine="stdlib",
+    report=None,
+):
+    """
+    Validate the [start, end) byte range of a csv file by chunks of records in
+    a process pool of `workers`, up to WORKER_DEPTH chunks ahead per worker.
+    Export the invalid records to f_err and yield the valid ones encoded in
+    client_encoding, in the order of the file. The reports of the workers are
+    added to report.
+    The chunks are checked by the Engine named engine, in a thread pool
+    executor for the engines using threads.
+    """
+    parser = get_engine(engine)
+    options = {
+        "dialect": _dialect_options(dialect),
+        "header": header,
+        "expected_columns": expected_columns,
+        "encoding": encoding,
+        "client_encoding": client_encoding,
+        "null": null,
+        "verbose": verbose,
+        "inject_rownum": inject_rownum,
+        "inject_filename": inject_filename,
+    }
+    chunks = iter_chunks(
+        filepath,
+        dialect,
+        encoding=encoding,
+        size=parser.chunk_size,
+        start=start,
+        end=end,
+        first_line=first_line,
+        check=record_check(dialect, expected_columns),
+    )
+    pending = collections.deque()
+
+    def _result():
+        size, future = pending.popleft()
+        data, errors, rows, chunk_report = future.result()
+        if errors:
+            f_err.write(errors)
+        if report is not None:
+            report.merge(chunk_report)
+            report.accept(rows)
+        if progress_bar is not None:
+            progress_bar.update(size)
+            _progress_rows(progress_bar, rows)
+        return data
+
+    try:
+        for chunk_start, chunk_end, chunk_line, chunk_end_line in chunks:
+            future = executor.submit(
+                parser.check,
+                filepath,
+                chunk_start,
+                chunk_end,
+                chunk_line,
+                chunk_end_line,
+                **options,
             )
+            pending.append((chunk_end - chunk_start, future))
+            if len(pending) >= WORKER_DEPTH * workers:
+                yield _result()
+        while pending:
+            yield _result()
+        if report is not None:
+            report.accept(0, final=True)
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def _dialect_options(dialect):
+    """
+    Attributes of the csv dialect, to rebuild it in another process
+    """
+    return {
+        name: getattr(dialect, name)
+        for name in (
+            "delimiter",
+            "quotechar",
+            "doublequote",
+            "escapechar",
+            "lineterminator",
+            "quoting",
+            "skipinitialspace",
+        )
+    }
+
+
+def _iter_records(f_in, dialect, first_line=0):
+    """
+    Group physical lines in records the way postgres COPY CSV does, without
+    parsing fields. Yield (line index, record) tuples.
+    """
+    quotechar = dialect.quotechar or None
+    escapechar = dialect.escapechar or None
+    if escapechar == quotechar:
+        escapechar = None
+
+    i = first_line
+    in_quote = False
+    lines = []
+    for line in f_in:
+        in_quote, _ = scan_quotes(
+            line, 0, len(line), quotechar, escapechar, in_quote, False
+        )
+        lines.append(line)
+        if not in_quote:
+            yield i, lines[0] if len(lines) == 1 else "".join(lines)
+            i += len(lines)
+            lines = []
+    if lines:
+        yield i, "".join(lines)
 
-        # import pdb;pdb.set_trace()
-        yield line
 
+def _parse_records(f_in, dialect, first_line=0):
+    """
+    Parse f_in with a single csv reader, yield (line index, record, fields)
+    tuples
+    """
+    lines = []
 
-def _check_line(ref, target, pattern):
-    if len(ref) > len(target):
-        missing = len(ref) - len(target)
-        raise MissingFieldsException(f"{missing} missing fields", None)
-    if len(ref) < len(target):
-        extra = len(target) - len(ref)
-        raise TooManyFieldsException(f"{extra} extra fields", None)
+    def _lines():
+        for line in f_in:
+            lines.append(line)
+            yield line
 
-    for i, field in enumerate(target):
-        result = pattern.findall(field)
-        if len(result) != 1:
-            raise WrongFieldDialectException(field, i)
-        if result[0] != field:
-            raise WrongFieldDialectException(field, i)
+    reader = csv.reader(_lines(), dialect=dialect)
+    line_num = 0
+    for parsed_line in reader:
+        record = lines[0] if len(lines) == 1 else "".join(lines)
+        lines.clear()
+        yield first_line + line_num, record, parsed_line
+        line_num = reader.line_num
 
 
-def _format_error(
-    filename, parsed_line, line_number, generated_header, exception, verbose
+def _wrap_binary(
+    f_in,
+    f_err,
+    dialect,
+    header,
+    expected_columns,
+    encoders,
+    null="",
+    verbose=False,
+    progress_bar=None,
+    inject_rownum=False,
+    inject_filename=False,
+    first_line=0,
+    engine="stdlib",
+    report=None,
 ):
-    error = exception.__class__.__name__
-    message, field_number = exception.args
+    """
+    Yield the csv rows encoded in the COPY binary format. The conversion of
+    the rows is counted in the validate stage of report.
+    """
+    filename = f_in.name.split("/")[-1]
+    f_in = TimedReader(f_in)
+    if f_err:
+        records = get_engine(engine).records(
+            f_in,
+            f_err,
+            dialect,
+            header,
+            expected_columns,
+            filename,
+            verbose=verbose,
+            first_line=first_line,
+            report=report,
+        )
+    else:
+        records = _parse_records(f_in, dialect, first_line=first_line)
+    generated_header = ["_rownum", "_error"] + expected_columns
+    writer = csv.writer(f_err, dialect=dialect) if f_err else None
+    injected = int(inject_rownum) + int(inject_filename)
+
+    yield BINARY_HEADER
+    clock = time.perf_counter
+    validate = 0.0
     try:
-        header_error = generated_header[field_number]
-    except (IndexError, TypeError):
-        header_error = None
+        start = clock()
+        for rows, (i, record, parsed_line) in enumerate(records, 1):
+            if header and i == 0:
+                continue
+            line_number = i if header else i + 1
+            if progress_bar is not None and not rows % PROGRESS_ROWS:
+                _progress_rows(progress_bar, PROGRESS_ROWS)
 
-    logger.info(
-        f"{error} in file {filename} at line {line_number}:{field_number}:{header_error}: {message}",
-    )
-    err_row = [line_number, f"{error}:{field_number}:{header_error}"] + parsed_line
-    return err_row
+            values = parsed_line
+            if null in values:
+                # like COPY CSV, a quoted value matching null is not NULL
+                values = [
+                    None if value == null and not quoted else value
+                    for value, quoted in zip(values, quoted_fields(record, dialect))
+                ]
+            if inject_rownum:
+                values = [str(line_number)] + values
+            if inject_filename:
+                values = [filename] + values
+            try:
+                row = encode_row(values, encoders)
+            except ValueError as e:
+                message, field_number = e.args
+                exception = WrongFieldTypeException(message, field_number - injected)
+                if writer is None:
+                    raise exception
+                err_row = format_error(
+                    filename,
+                    parsed_line,
+                    line_number,
+                    generated_header,
+                    exception,
+                    verbose,
+                )
+                writer.writerow(err_row)
+                if report is not None:
+                    report.reject(exception)
+                continue
+            validate += clock() - start
+            yield row
+            start = clock()
+        validate += clock() - start
+    finally:
+        if report is not None:
+            report.add(read=f_in.seconds, validate=validate - f_in.seconds)
+    yield BINARY_TRAILER
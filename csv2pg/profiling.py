@@ -0,0 +1,121 @@
+import cProfile
+import collections
+import contextlib
+import io
+import logging
+import os
+import signal
+
+
+PROFILE_INTERVAL = 0.005  # seconds of CPU time between two samples of the stack
+COLLAPSED_SUFFIX = ".collapsed"
+# functions telling the stage of the load of a sampled stack, the innermost
+# one found in the stack wins
+STAGE_FUNCTIONS = {
+    "_check_database": "connect",
+    "_drop_table": "create_table",
+    "_create_table": "create_table",
+    "_create_staging_table": "create_table",
+    "_truncate_table": "create_table",
+    "TimedReader.readline": "read",
+    "RangeIO.readinto": "read",
+    "ProgressIO.readinto": "read",
+    "NewlineIO.readinto": "read",
+    "ThreadedReader.readinto": "read",
+    "check_records": "validate",
+    "StdlibEngine.check": "validate",
+    "ArrowEngine.check": "validate",
+    "_iter_records": "validate",
+    "_parse_records": "validate",
+    "_wrap_binary": "validate",
+    "_wrap": "inject",
+    "_copy_stream": "copy",
+}
+OTHER_STAGE = "other"
+
+logger = logging.getLogger("csv2pg")
+
+
+class StackSampler:
+    """
+    Sample the python stack of the main thread every `interval` seconds of
+    CPU time of the process, from a SIGPROF handler
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._handler = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        self.samples[tuple(stack)] += 1
+
+    def start(self):
+        self._handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._handler)
+
+    def collapsed(self):
+        """
+        Count the samples by stack in the collapsed format of flamegraph.pl:
+        the stage of the load, then the frames from the outermost one
+        """
+        stacks = collections.Counter()
+        for codes, count in self.samples.items():
+            names = [_code_name(code) for code in codes]
+            stage = next(
+                (
+                    STAGE_FUNCTIONS[_qualname(code)]
+                    for code in codes
+                    if _qualname(code) in STAGE_FUNCTIONS
+                ),
+                OTHER_STAGE,
+            )
+            stacks[";".join([stage] + names[::-1])] += count
+        return stacks
+
+
+@contextlib.contextmanager
+def profiled(filepath, interval=PROFILE_INTERVAL):
+    """
+    Profile the block: the deterministic profile of the calling thread is
+    dumped to filepath (pstats), and its stack is sampled every `interval`
+    seconds of CPU time and written to filepath.collapsed under the stage of
+    the load it is in, ready for a flamegraph. Sampling needs SIGPROF and the
+    main thread, only the pstats are written otherwise.
+    """
+    sampler = StackSampler(interval)
+    try:
+        sampler.start()
+    except (AttributeError, ValueError) as e:
+        logger.warning("Stack sampling unavailable ({}): pstats only".format(e))
+        sampler = None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+        profiler.dump_stats(filepath)
+        if sampler is not None:
+            with io.open(filepath + COLLAPSED_SUFFIX, "w") as f:
+                for stack, count in sorted(sampler.collapsed().items()):
+                    f.write("{} {}\n".format(stack, count))
+
+
+def _qualname(code):
+    return getattr(code, "co_qualname", code.co_name)
+
+
+def _code_name(code):
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return "{}:{}".format(module, _qualname(code)).replace(" ", "_")
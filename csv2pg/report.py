@@ -0,0 +1,187 @@
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+
+from csv2pg.exceptions import ErrorBudgetException
+
+
+# stages of a load, the time of a stage is summed over the threads and the
+# worker processes running it
+STAGES = ("connect", "create_table", "read", "validate", "inject", "copy")
+REJECTED = (
+    "MissingFieldsException",
+    "TooManyFieldsException",
+    "WrongFieldDialectException",
+)
+PROMETHEUS_SUFFIX = ".prom"
+ERROR_RATE_ROWS = 1000  # rows read before checking max_error_rate mid-load
+
+
+class LoadReport:
+    """
+    Counters and stage timings of a load, shared by the threads loading it.
+    Counting a rejected row raises ErrorBudgetException when more than
+    max_errors rows, or a ratio of the rows read above max_error_rate, are
+    rejected.
+    """
+
+    def __init__(self, table=None, files=None, max_errors=None, max_error_rate=None):
+        self.table = table
+        self.files = files or []
+        self.bytes_read = 0
+        self.rows_sent = 0
+        self.rows_rejected = dict.fromkeys(REJECTED, 0)
+        self.rows_accepted = 0
+        self.max_errors = max_errors
+        self.max_error_rate = max_error_rate
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._wall = None
+
+    def add(self, bytes_read=0, rows_sent=0, **timings):
+        """
+        Add bytes, rows and seconds spent in stages
+        """
+        with self._lock:
+            self.bytes_read += bytes_read
+            self.rows_sent += rows_sent
+            for stage, seconds in timings.items():
+                self.timings[stage] += max(seconds, 0.0)
+
+    def reject(self, exception):
+        """
+        Count a row rejected with exception (or the name of its class)
+        """
+        error = exception if isinstance(exception, str) else type(exception).__name__
+        with self._lock:
+            self.rows_rejected[error] = self.rows_rejected.get(error, 0) + 1
+            self._check_budget()
+
+    def accept(self, rows, final=False):
+        """
+        Count rows that passed the validation, for max_error_rate. The rate
+        is checked after ERROR_RATE_ROWS rows, or at once when final (the
+        end of a unit of work)
+        """
+        with self._lock:
+            self.rows_accepted += rows
+            self._check_budget(final)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(**{stage: time.perf_counter() - start})
+
+    def merge(self, other):
+        """
+        Add the counters of the as_dict() of another report, from a worker
+        process
+        """
+        self.add(
+            bytes_read=other["bytes_read"],
+            rows_sent=other["rows_sent"],
+            **other["timings"],
+        )
+        with self._lock:
+            for error, count in other["rows_rejected"].items():
+                self.rows_rejected[error] = self.rows_rejected.get(error, 0) + count
+            self._check_budget()
+
+    def _check_budget(self, final=False):
+        rejected = sum(self.rows_rejected.values())
+        if self.max_errors is not None and rejected > self.max_errors:
+            raise ErrorBudgetException(
+                "{} rows rejected, more than --max-errors {}".format(
+                    rejected, self.max_errors
+                )
+            )
+        read = rejected + self.rows_accepted
+        if (
+            self.max_error_rate is not None
+            and read
+            and (final or read >= ERROR_RATE_ROWS)
+            and rejected / read > self.max_error_rate
+        ):
+            raise ErrorBudgetException(
+                "{} of {} rows rejected, more than --max-error-rate {}".format(
+                    rejected, read, self.max_error_rate
+                )
+            )
+
+    def stop(self):
+        self._wall = time.perf_counter() - self._start
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "table": self.table,
+                "files": list(self.files),
+                "bytes_read": self.bytes_read,
+                "rows_sent": self.rows_sent,
+                "rows_rejected": dict(self.rows_rejected),
+                "timings": dict(self.timings),
+                "wall": self._wall,
+                "timestamp": time.time(),
+            }
+
+
+def write_report(report, filepath):
+    """
+    Write the as_dict() of a report as json, or as a prometheus textfile when
+    filepath ends with .prom. The file is replaced atomically.
+    """
+    if filepath.endswith(PROMETHEUS_SUFFIX):
+        content = prometheus_metrics(report)
+    else:
+        content = json.dumps(report, indent=2) + "\n"
+    with io.open(filepath + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(filepath + ".tmp", filepath)
+
+
+def prometheus_metrics(report):
+    """
+    Format the as_dict() of a report in the prometheus text format
+    """
+    table = _label(report["table"])
+    metrics = [
+        ("bytes_read", "Bytes read from the csv files", [("", report["bytes_read"])]),
+        ("rows_sent", "Rows inserted by COPY", [("", report["rows_sent"])]),
+        (
+            "rows_rejected",
+            "Rows rejected by error class",
+            [
+                (',error="{}"'.format(_label(error)), count)
+                for error, count in sorted(report["rows_rejected"].items())
+            ],
+        ),
+        (
+            "stage_seconds",
+            "Seconds spent in each stage of the load",
+            [
+                (',stage="{}"'.format(stage), seconds)
+                for stage, seconds in report["timings"].items()
+            ],
+        ),
+        ("wall_seconds", "Duration of the load", [("", report["wall"] or 0.0)]),
+        ("timestamp_seconds", "End of the load", [("", report["timestamp"])]),
+    ]
+    lines = []
+    for name, help, samples in metrics:
+        name = "csv2pg_load_" + name
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in samples:
+            lines.append('{}{{table="{}"{}}} {}'.format(name, table, labels, value))
+    return "\n".join(lines) + "\n"
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
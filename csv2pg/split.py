@@ -0,0 +1,342 @@
+import codecs
+import collections
+import csv
+import io
+import os
+import re
+
+
+SCAN_BUFFER = 2 ** 20  # read buffer size used to scan for record boundaries
+# encodings whose multibyte characters may contain ascii bytes (quote, escape
+# or newline), their raw bytes can not be scanned for record boundaries
+UNSPLITTABLE_ENCODINGS = {
+    "big5",
+    "big5hkscs",
+    "cp932",
+    "cp949",
+    "cp950",
+    "gb18030",
+    "gbk",
+    "hz",
+    "johab",
+    "shift_jis",
+    "shift_jis_2004",
+    "shift_jisx0213",
+}
+
+
+def split_ranges(filepath, jobs, dialect, encoding="utf-8", check=None):
+    """
+    Split a csv file in at most `jobs` byte ranges snapped on record boundaries.
+
+    The scan follows the quoting rules of the postgres COPY CSV reader so that
+    a range never starts inside a quoted field spanning several lines, or
+    with check those of the --skip-error validation (see csv_records), whose
+    records are not the same once a quote is malformed.
+    Return a list of (start, end, first_line) tuples where first_line is the
+    number of physical lines preceding the range.
+    """
+    size = os.stat(filepath).st_size
+    if jobs <= 1 or size == 0:
+        return [(0, size, 0)]
+    targets = [size * k // jobs for k in range(1, jobs)]
+    if check is not None:
+        boundaries = [(0, 0)]
+        offset = line_count = 0
+        with io.open(filepath, "rb") as f:
+            for record_size, record_lines in csv_records(f, dialect, encoding, check):
+                offset += record_size
+                line_count += record_lines
+                if offset < targets[0]:
+                    continue
+                while targets and targets[0] <= offset:
+                    targets.pop(0)
+                if offset < size:
+                    boundaries.append((offset, line_count))
+                if not targets:
+                    break
+        ends = [start for start, _ in boundaries[1:]] + [size]
+        return [
+            (start, end, first_line)
+            for (start, first_line), end in zip(boundaries, ends)
+        ]
+
+    quotechar = dialect.quotechar.encode(encoding) if dialect.quotechar else None
+    escapechar = dialect.escapechar.encode(encoding) if dialect.escapechar else None
+    if escapechar == quotechar:
+        # a doubled quote toggles the quote state twice
+        escapechar = None
+    newline = "\n".encode(encoding)
+
+    boundaries = [(0, 0)]
+    in_quote = False
+    escaped = False
+    line_count = 0
+    offset = 0
+    with io.open(filepath, "rb") as f:
+        while targets:
+            block = f.read(SCAN_BUFFER)
+            if not block:
+                break
+            pos = 0
+            while targets and targets[0] < offset + len(block):
+                target = max(targets[0] - offset, pos)
+                in_quote, escaped = scan_quotes(
+                    block, pos, target, quotechar, escapechar, in_quote, escaped
+                )
+                line_count += block.count(newline, pos, target)
+                pos = target
+                while True:
+                    nl = block.find(newline, pos)
+                    if nl == -1:
+                        break
+                    in_quote, escaped = scan_quotes(
+                        block, pos, nl, quotechar, escapechar, in_quote, escaped
+                    )
+                    line_count += 1
+                    pos = nl + 1
+                    escaped = False
+                    if not in_quote:
+                        break
+                if nl == -1:
+                    break
+                boundary = offset + pos
+                while targets and targets[0] <= boundary:
+                    targets.pop(0)
+                if boundary < size:
+                    boundaries.append((boundary, line_count))
+            in_quote, escaped = scan_quotes(
+                block, pos, len(block), quotechar, escapechar, in_quote, escaped
+            )
+            line_count += block.count(newline, pos)
+            offset += len(block)
+
+    ends = [start for start, _ in boundaries[1:]] + [size]
+    return [
+        (start, end, first_line) for (start, first_line), end in zip(boundaries, ends)
+    ]
+
+
+def iter_chunks(
+    filepath,
+    dialect,
+    encoding="utf-8",
+    rows=None,
+    size=None,
+    start=0,
+    end=None,
+    first_line=0,
+    check=None,
+):
+    """
+    Cut the [start, end) byte range of a csv file, preceded by `first_line`
+    lines and starting on a record boundary, in consecutive chunks of `rows`
+    records or of at least `size` bytes snapped on record boundaries.
+
+    The records follow the postgres quoting rules, or with check those of the
+    --skip-error validation (see csv_records).
+    The chunks are scanned lazily. Yield (start, end, first_line, end_line)
+    tuples, end_line being the number of lines preceding the next chunk.
+    """
+    chunk_start = offset = start
+    chunk_line = line_count = first_line
+    records = 0
+    with io.BufferedReader(RangeIO(filepath, start, end)) as f:
+        if check is None:
+            sizes = postgres_records(f, dialect, encoding)
+        else:
+            sizes = csv_records(f, dialect, encoding, check)
+        for record_size, record_lines in sizes:
+            offset += record_size
+            line_count += record_lines
+            records += 1
+            if (rows and records >= rows) or (size and offset - chunk_start >= size):
+                yield chunk_start, offset, chunk_line, line_count
+                chunk_start, chunk_line, records = offset, line_count, 0
+    if offset > chunk_start:
+        yield chunk_start, offset, chunk_line, line_count
+
+
+def postgres_records(f, dialect, encoding="utf-8"):
+    """
+    Read the records of a binary csv file like the postgres COPY CSV reader,
+    every quote toggling the quote state. Yield the (size, lines) of each
+    record, its size in bytes and its number of lines.
+    """
+    quotechar = dialect.quotechar.encode(encoding) if dialect.quotechar else None
+    escapechar = dialect.escapechar.encode(encoding) if dialect.escapechar else None
+    if escapechar == quotechar:
+        escapechar = None
+
+    record_size = record_lines = 0
+    in_quote = False
+    for line in f:
+        record_size += len(line)
+        record_lines += 1
+        if quotechar is not None and quotechar in line:
+            in_quote, _ = scan_quotes(
+                line, 0, len(line), quotechar, escapechar, in_quote, False
+            )
+        if in_quote:
+            continue
+        yield record_size, record_lines
+        record_size = record_lines = 0
+    if record_lines:
+        yield record_size, record_lines
+
+
+def csv_records(f, dialect, encoding="utf-8", check=None):
+    """
+    Read the records of a binary csv file like the --skip-error validation:
+    with the csv module, in universal newlines mode, the lines following the
+    first one of a multi-line record failing check(fields) being parsed
+    again. Yield the (size, lines) of each record, its size in bytes and its
+    number of lines, the first line of such a record being yielded with the
+    records following it up to the end of the lines it was parsed from: a
+    range ending inside them would be validated otherwise.
+
+    A quote inside an unquoted field is literal for the csv module but
+    toggles the quote state of postgres, the records differ after it.
+    """
+    # the bytes a record of a single line does not contain
+    special = re.compile(
+        b"|".join(
+            [
+                re.escape(c.encode(encoding))
+                for c in (dialect.quotechar, dialect.escapechar)
+                if c
+            ]
+            + [b"\r(?!\n)"]
+        )
+    )
+    pending = collections.deque()  # (size, line) to parse before reading f
+    lines = []  # (size, line) of the record being parsed
+
+    def _push(raw):
+        if raw.count(b"\r") > raw.endswith(b"\r\n"):
+            # a bare carriage return ends a line in text mode
+            pending.extend(
+                (len(part), part.decode(encoding)) for part in raw.splitlines(True)
+            )
+        else:
+            pending.append((len(raw), raw.decode(encoding)))
+
+    def _lines():
+        while True:
+            if not pending:
+                raw = f.readline()
+                if not raw:
+                    return
+                _push(raw)
+            lines.append(pending.popleft())
+            yield lines[-1][1]
+
+    reader = csv.reader(_lines(), dialect=dialect)
+    held_size = held_lines = 0  # records no range may end after
+    covered = 0  # lines of the held records a range must contain
+    while True:
+        record = None
+        if not pending:
+            raw = f.readline()
+            if not raw:
+                break
+            if special.search(raw):
+                _push(raw)
+            else:
+                # neither quoted nor escaped: a record of a single line
+                record = [(len(raw), raw)]
+        if record is None:
+            try:
+                fields = next(reader)
+            except StopIteration:
+                break
+            except csv.Error:
+                fields = None
+            record = lines[:]
+            lines.clear()
+            if len(record) > 1 and (
+                fields is None or (check is not None and not check(fields))
+            ):
+                pending.extendleft(reversed(record[1:]))
+                reader = csv.reader(_lines(), dialect=dialect)
+                covered = max(covered, held_lines + len(record))
+                record = record[:1]
+        held_size += sum(size for size, _ in record)
+        held_lines += len(record)
+        if held_lines < covered:
+            continue
+        yield held_size, held_lines
+        held_size = held_lines = covered = 0
+    if held_lines:
+        yield held_size, held_lines
+
+
+def is_splittable(encoding):
+    """
+    Check that the raw bytes of an encoding can be scanned for quotes and
+    newlines, like in utf-8 or single byte encodings
+    """
+    name = codecs.lookup(encoding).name
+    return not (
+        name in UNSPLITTABLE_ENCODINGS
+        or name.startswith(("utf-16", "utf-32", "iso2022"))
+    )
+
+
+def scan_quotes(data, start, end, quotechar, escapechar, in_quote, escaped):
+    """
+    Return the (in_quote, escaped) state after reading data[start:end],
+    data being either str or bytes.
+    """
+    if quotechar is None:
+        return in_quote, False
+    if escapechar is None or (not escaped and data.find(escapechar, start, end) == -1):
+        if data.count(quotechar, start, end) % 2:
+            in_quote = not in_quote
+        return in_quote, False
+
+    separator = b"|" if isinstance(quotechar, bytes) else "|"
+    pattern = re.compile(re.escape(quotechar) + separator + re.escape(escapechar))
+    last_was_escape = escaped
+    previous = start - 1
+    for match in pattern.finditer(data, start, end):
+        i = match.start()
+        if i != previous + 1:
+            last_was_escape = False
+        previous = i
+        c = match.group()
+        if in_quote and c == escapechar:
+            last_was_escape = not last_was_escape
+        if c == quotechar and not last_was_escape:
+            in_quote = not in_quote
+        if c != escapechar:
+            last_was_escape = False
+    return in_quote, last_was_escape and previous == end - 1
+
+
+class RangeIO(io.RawIOBase):
+    """
+    Read only the [start, end) byte range of a file
+    """
+
+    def __init__(self, filepath, start=0, end=None):
+        self.name = filepath
+        self._f = io.open(filepath, "rb")
+        self._f.seek(start)
+        self._left = None if end is None else end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = len(b) if self._left is None else min(len(b), self._left)
+        if n <= 0:
+            return 0
+        n = self._f.readinto(memoryview(b)[:n])
+        if self._left is not None:
+            self._left -= n
+        return n
+
+    def close(self):
+        self._f.close()
+        super().close()
@@ -1,4 +1,5 @@
 import io
+import time
 
 
 class StringIteratorIO(io.TextIOBase):
@@ -56,3 +57,227 @@ class StringIteratorIO(io.TextIOBase):
                 self._left = self._left[i + 1 :]
                 break
         return "".join(_list)
+
+
+class BytesIteratorIO(io.RawIOBase):
+    """
+    Read the output of a string (or bytes if encoding is None) generator as bytes.
+
+    Generated items are gathered and encoded by chunks of at least chunk_size
+    into a single buffer, read(n) is then served by moving an offset in that
+    buffer so a long line is never copied more than twice.
+    """
+
+    def __init__(self, iter, encoding="utf-8", chunk_size=2 ** 16):
+        self._iter = iter
+        self._encoding = encoding
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._pos = 0
+        self._exhausted = False
+
+    def readable(self):
+        return True
+
+    def _fill(self, n):
+        """
+        Gather generated items until at least n bytes are available
+        """
+        del self._buffer[: self._pos]
+        self._pos = 0
+        size = len(self._buffer)
+        target = max(n, self._chunk_size)
+        _list = []
+        while size < target:
+            try:
+                item = next(self._iter)
+            except StopIteration:
+                self._exhausted = True
+                break
+            _list.append(item)
+            size += len(item)
+        if not _list:
+            return
+        if self._encoding is None:
+            self._buffer += b"".join(_list)
+        else:
+            self._buffer += "".join(_list).encode(self._encoding)
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            while not self._exhausted:
+                self._fill(len(self._buffer) + self._chunk_size)
+            n = len(self._buffer) - self._pos
+        elif len(self._buffer) - self._pos < n and not self._exhausted:
+            self._fill(n)
+        with memoryview(self._buffer) as view:
+            ret = bytes(view[self._pos : self._pos + n])
+        self._pos += len(ret)
+        return ret
+
+    def readinto(self, b):
+        ret = self.read(len(b))
+        b[: len(ret)] = ret
+        return len(ret)
+
+
+class ProgressIO(io.RawIOBase):
+    """
+    Count the bytes read from a binary stream in a tqdm progress bar
+    """
+
+    def __init__(self, raw, progress_bar):
+        self.raw = raw
+        self._progress_bar = progress_bar
+
+    @property
+    def name(self):
+        return self.raw.name
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.raw.readinto(b)
+        if n:
+            self._progress_bar.update(n)
+        return n
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class TimedReader:
+    """
+    Sum the time spent reading a file object, by read, readline or iteration.
+    The exception raised by a read is kept in error.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.seconds = 0.0
+        self.error = None
+
+    @property
+    def name(self):
+        return self._f.name
+
+    def read(self, n=-1):
+        start = time.perf_counter()
+        try:
+            data = self._f.read(n)
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.seconds += time.perf_counter() - start
+        return data
+
+    def readline(self):
+        start = time.perf_counter()
+        line = self._f.readline()
+        self.seconds += time.perf_counter() - start
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        self._f.close()
+
+
+class NewlineIO(io.RawIOBase):
+    """
+    Translate CRLF and CR line endings of a binary stream to LF, like the
+    universal newlines mode of text files
+    """
+
+    def __init__(self, raw, chunk_size=2 ** 16):
+        self.raw = raw
+        self._chunk_size = chunk_size
+        self._buffer = b""
+        self._pos = 0
+        self._carriage_return = False
+
+    @property
+    def name(self):
+        return self.raw.name
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while True:
+            data = self.raw.read(self._chunk_size)
+            if not data:
+                data = b"\n" if self._carriage_return else b""
+                self._carriage_return = False
+                return data
+            if self._carriage_return:
+                data = b"\r" + data
+            # a CR ending the chunk may be followed by a LF
+            self._carriage_return = data.endswith(b"\r")
+            if self._carriage_return:
+                data = data[:-1]
+            if b"\r" in data:
+                data = data.replace(b"\r\n", b"\n")
+                if b"\r" in data:
+                    data = data.replace(b"\r", b"\n")
+            if data:
+                return data
+
+    def readinto(self, b):
+        if self._pos >= len(self._buffer):
+            self._buffer = self._fill()
+            self._pos = 0
+            if not self._buffer:
+                return 0
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class ReplayIO(io.RawIOBase):
+    """
+    Read the bytes read ahead from a binary stream, then the rest of the
+    stream. tell() is the number of bytes read.
+    """
+
+    def __init__(self, head, raw, name=None):
+        self.raw = raw
+        self._head = head
+        self._pos = 0
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name or self.raw.name
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, b):
+        if self._pos < len(self._head):
+            n = min(len(b), len(self._head) - self._pos)
+            b[:n] = self._head[self._pos : self._pos + n]
+        else:
+            n = self.raw.readinto(b)
+        self._pos += n or 0
+        return n
+
+    def close(self):
+        self.raw.close()
+        super().close()
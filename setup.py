@@ -29,6 +29,10 @@ setup(
         'psycopg2-binary>=2.0.6',
         'tqdm',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'arrow': ['pyarrow'],
+    },
     python_requires='>=3.5',
     entry_points={'console_scripts': ['csv2pg=csv2pg.cli:cli'], },
     #entry_points='''
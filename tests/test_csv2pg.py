@@ -1,9 +1,30 @@
+import bz2
+import contextlib
+import csv
+import gzip
+import io
+import logging
+import lzma
 import os
+import pstats
+import shutil
+import subprocess
+import sys
+import threading
 
 import psycopg2
 import pytest
 
 from csv2pg import copy_to
+from csv2pg.checkpoint import checkpoint_path, parse_commit_every, read_checkpoint
+from csv2pg.errfile import ErrorFile
+from csv2pg.exceptions import (
+    ErrorBudgetException,
+    IndexRebuildException,
+    WrongHeaderException,
+)
+from csv2pg.profiling import COLLAPSED_SUFFIX, profiled
+from csv2pg.striter import BytesIteratorIO, NewlineIO
 
 
 HOST = "localhost"
@@ -473,6 +494,39 @@ def test_rownum_encoding_GB18030():
             assert rows[0][1] == "气广"
 
 
+@pytest.mark.parametrize(
+    "asset, encoding, value",
+    [
+        ("tests/assets/encoding_ISO_8859_1.csv", "ISO-8859-1", "ÑÆÛý¼àáäæ"),
+        ("tests/assets/encoding_GB18030.csv", "GB18030", "气广"),
+    ],
+)
+def test_client_encoding(asset, encoding, value):
+    tablename = "client_encoding"
+    results = []
+    # the file sent as read with the session client_encoding, then decoded
+    # and encoded to UTF8 by python
+    for connection_options in ({}, {"client_encoding": "UTF8"}):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            connection_options=connection_options,
+            overwrite=True,
+            encoding=encoding,
+        )
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute("SELECT * FROM {tablename}".format(tablename=tablename))
+                results.append(curs.fetchall())
+
+    assert results[0] == results[1] == [(value,)]
+
+
 def test_error_delimiter():
     tablename = "error_delimiter"
     asset = "tests/assets/error_delimiter.csv"
@@ -564,6 +618,132 @@ def test_check_unterminated_quote():
             assert 3 not in [a for a, b, c in rows]
 
 
+def test_check_complex():
+    tablename = "check_complex"
+    asset = "tests/assets/complex_LE-LF_header_bom.csv"
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=True,
+        lineterminator="\n",
+    )
+
+    # the rows rejected by the per-field check of the parsed values
+    with open(asset + ".err") as f:
+        errors = list(csv.reader(f))
+        assert [error[0] for error in errors[1:]] == (
+            "43 127 160 243 285 322 364 458 505 518 529 565 676 687 738 781 782 847 961"
+        ).split()
+        assert {error[1] for error in errors[1:]} == {
+            "WrongFieldDialectException:18:price"
+        }
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            # a comment field """""" is parsed as "", valid
+            curs.execute("SELECT count(*) FROM {} WHERE id = '95'".format(tablename))
+            assert curs.fetchone()[0] == 1
+
+
+@pytest.mark.parametrize(
+    "options, aborted",
+    [
+        ({"max_errors": 1}, True),
+        ({"max_errors": 2}, False),
+        ({"max_error_rate": 0.1}, True),
+        ({"max_error_rate": 0.5}, False),
+        ({"max_errors": 1, "optimistic": True}, True),
+        ({"max_error_rate": 0.1, "workers": 2}, True),
+        ({"max_error_rate": 0.1, "engine": "arrow"}, True),
+    ],
+)
+def test_error_budget(tmp_path, options, aborted):
+    tablename = "error_budget"
+    asset = str(tmp_path / "error_delimiter.csv")
+    shutil.copy("tests/assets/error_delimiter.csv", asset)
+
+    with pytest.raises(ErrorBudgetException) if aborted else contextlib.nullcontext():
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            skip_error=True,
+            **options,
+        )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT count(*) FROM {}".format(tablename))
+            assert curs.fetchone()[0] == (0 if aborted else 8)
+
+
+def test_error_file(tmp_path):
+    tablename = "error_file"
+    asset = str(tmp_path / "simple.csv")
+    shutil.copy("tests/assets/simple.csv", asset)
+    with open(asset + ".err", "w") as f:
+        f.write("errors of a previous load\n")
+
+    copy_to(HOST, PORT, DBNAME, USER, PASSWORD, tablename, asset, skip_error=True)
+    assert not os.path.exists(asset + ".err")
+
+    error_dir = tmp_path / "errors"
+    asset = str(tmp_path / "error_delimiter.csv")
+    shutil.copy("tests/assets/error_delimiter.csv", asset)
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=True,
+        error_dir=str(error_dir),
+    )
+    assert not os.path.exists(asset + ".err")
+    with open(str(error_dir / "error_delimiter.csv.err")) as f:
+        errors = list(csv.reader(f))
+        assert errors[0] == ["_rownum", "_error", "id", "name", "date"]
+        assert [error[0] for error in errors[1:]] == ["2", "5"]
+
+
+def test_error_file_writer(tmp_path):
+    filepath = str(tmp_path / "writer.err")
+    rows = ["{},error\n".format(i) for i in range(1000)]
+    f_err = ErrorFile(filepath, header="_rownum,_error\n", buffer_size=64, depth=2)
+    for row in rows:
+        f_err.write(row)
+    # the full buffers are written by the thread, flush waits for them
+    f_err.flush()
+    with open(filepath) as f:
+        assert f.read() == "_rownum,_error\n" + "".join(rows)
+    f_err.write("1000,error\n")
+    f_err.close()
+    with open(filepath) as f:
+        assert f.read().endswith("999,error\n1000,error\n")
+
+    # the error of the writer thread is raised by the loading thread
+    f_err = ErrorFile(str(tmp_path / "missing" / "writer.err"), buffer_size=64)
+    with pytest.raises(FileNotFoundError):
+        with f_err:
+            for row in rows:
+                f_err.write(row)
+
+
 def test_unlogged():
     tablename = "not_logged"
     asset = "tests/assets/simple.csv"
@@ -614,3 +794,1671 @@ def test_filename():
             assert len(rows) == 10
             for c in rows:
                 assert c[0] == "simple.csv"
+
+
+def test_jobs():
+    tablename = "jobs"
+    asset = "tests/assets/complex_LE-LF_header_bom.csv"
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        lineterminator="\n",
+        inject_rownum=True,
+        jobs=4,
+    )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                "SELECT _rownum, id FROM {tablename} ORDER BY _rownum".format(
+                    tablename=tablename
+                )
+            )
+            rows = curs.fetchall()
+            assert len(rows) == 1000
+            for i, row in enumerate(rows):
+                assert row[0] == i + 1
+                assert int(row[1]) == i + 1
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"jobs": 4},
+        {"commit_every": 300},
+        {"binary": True},
+        {"skip_error": True},
+        {"skip_error": True, "optimistic": True},
+    ],
+)
+def test_server_inject(options):
+    tablename = "server_inject"
+    asset = "tests/assets/complex_LE-LF_header_bom.csv"
+    results = []
+    for server_inject in (False, True):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            lineterminator="\n",
+            inject_rownum=True,
+            inject_filename=True,
+            server_inject=server_inject,
+            **options,
+        )
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute("SELECT * FROM {} ORDER BY _rownum".format(tablename))
+                results.append(curs.fetchall())
+                # the defaults are removed after the load
+                curs.execute(
+                    "SELECT count(*) FROM pg_attrdef WHERE adrelid = %s::regclass",
+                    (tablename,),
+                )
+                assert curs.fetchone()[0] == 0
+
+    assert results[1]
+    assert results[0] == results[1]
+
+
+def test_server_inject_existing_table(caplog):
+    tablename = "server_inject_existing"
+    asset = "tests/assets/simple.csv"
+    options = dict(inject_rownum=True, inject_filename=True, server_inject=True)
+    copy_to(
+        HOST, PORT, DBNAME, USER, PASSWORD, tablename, asset, overwrite=True, **options
+    )
+    # appending to the table: the rows are injected by csv2pg
+    copy_to(HOST, PORT, DBNAME, USER, PASSWORD, tablename, asset, **options)
+    assert "--server-inject ignored" in caplog.text
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                "SELECT _filename, _rownum, count(*) FROM {} "
+                "GROUP BY 1, 2 ORDER BY 2".format(tablename)
+            )
+            assert curs.fetchall() == [("simple.csv", i, 2) for i in range(1, 11)]
+            curs.execute(
+                "SELECT count(*) FROM pg_attrdef WHERE adrelid = %s::regclass",
+                (tablename,),
+            )
+            assert curs.fetchone()[0] == 0
+
+
+def test_jobs_skip_error():
+    tablename = "jobs_skip_error"
+    asset = "tests/assets/error_delimiter.csv"
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=True,
+        jobs=3,
+    )
+
+    with open(asset + ".err") as f:
+        errors = f.readlines()
+        assert len(errors) == 3
+        assert errors[0].startswith("_rownum")
+        assert errors[1].startswith("2")
+        assert errors[2].startswith("5")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT * FROM {tablename}".format(tablename=tablename))
+            rows = curs.fetchall()
+            assert len(rows) == 8
+
+
+def _write_broken_quote(filepath, rows=20000):
+    # a quote inside an unquoted field toggles the quote state of postgres,
+    # but not of the csv module, before many multi-line records
+    with open(filepath, "w", newline="") as f:
+        f.write("id,label\n")
+        for i in range(1, rows + 1):
+            if i == 5:
+                f.write('5,ab"c\n')
+            elif i % 10:
+                f.write("{},line {}\n".format(i, i))
+            else:
+                f.write('{},"multi\nline {}"\n'.format(i, i))
+
+
+@pytest.mark.parametrize(
+    "options", [{"jobs": 4}, {"workers": 2}, {"commit_every": 1000}]
+)
+def test_skip_error_broken_quote(tmp_path, monkeypatch, options):
+    monkeypatch.setattr("csv2pg.engines.WORKER_CHUNK", 2 ** 14)
+    tablename = "skip_error_broken_quote"
+    asset = str(tmp_path / "broken_quote.csv")
+    _write_broken_quote(asset)
+
+    results = []
+    for load_options in ({}, options):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            lineterminator="\n",
+            skip_error=True,
+            **load_options,
+        )
+        with open(asset + ".err") as f:
+            errors = f.readlines()
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute("SELECT count(*) FROM {}".format(tablename))
+                results.append((curs.fetchone()[0], errors))
+
+    assert results[0][0] == 19999
+    assert len(results[0][1]) == 2
+    assert results[0][1][1].startswith("5,WrongFieldDialectException")
+    assert results[1] == results[0]
+
+
+@pytest.mark.parametrize("options", [{"jobs": 4}, {"workers": 2}])
+def test_skip_error_rejected_multiline(tmp_path, monkeypatch, options):
+    # a range ending after the first line of a rejected multi-line record
+    # would read an unterminated quoted field, a valid one
+    monkeypatch.setattr("csv2pg.engines.WORKER_CHUNK", 64)
+    tablename = "skip_error_rejected_multiline"
+    asset = str(tmp_path / "rejected_multiline.csv")
+    with open(asset, "w", newline="") as f:
+        f.write("id,label\n")
+        for i in range(1, 2001):
+            if i % 7:
+                f.write("{},line {}\n".format(i, i))
+            else:
+                f.write('{},"\nline",{}\n'.format(i, i))
+
+    results = []
+    for load_options in ({}, options):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            lineterminator="\n",
+            skip_error=True,
+            **load_options,
+        )
+        with open(asset + ".err") as f:
+            errors = f.read()
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute("SELECT count(*) FROM {}".format(tablename))
+                results.append((curs.fetchone()[0], errors))
+
+    assert results[0][0] == 2000 - 2000 // 7
+    assert results[1] == results[0]
+
+
+def test_jobs_multibyte_encoding(tmp_path):
+    tablename = "jobs_multibyte_encoding"
+    asset = str(tmp_path / "gb18030.csv")
+    # the second byte of 昞 in gb18030 is a backslash, the escape character
+    with open(asset, "w", encoding="gb18030", newline="") as f:
+        f.write('id,label\n1,"x昞"\n')
+        for i in range(2, 200):
+            f.write('{},"line\nbreak, {}"\n'.format(i, i))
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        lineterminator="\n",
+        encoding="gb18030",
+        jobs=4,
+    )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT label FROM {} ORDER BY id::int".format(tablename))
+            rows = curs.fetchall()
+            assert len(rows) == 199
+            assert rows[0][0] == "x昞"
+            assert rows[1][0] == "line\nbreak, 2"
+
+
+def test_mixed_line_endings(tmp_path):
+    asset = str(tmp_path / "mixed_line_endings.csv")
+    with open(asset, "wb") as f:
+        f.write(b'id,label\r\n1,"x\r\ny"\r\n2,b\n3,c\r\n')
+
+    for tablename, inject_rownum in (
+        ("mixed_line_endings_raw", False),
+        ("mixed_line_endings_rownum", True),
+    ):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            inject_rownum=inject_rownum,
+        )
+
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute("SELECT id, label FROM {} ORDER BY id".format(tablename))
+                assert curs.fetchall() == [("1", "x\ny"), ("2", "b"), ("3", "c")]
+
+
+def test_newline_io():
+    data = b"a\r\nb\rc\n\r\r\nd\r"
+    for chunk_size in (1, 2, 3, 64):
+        f = NewlineIO(io.BytesIO(data), chunk_size=chunk_size)
+        assert io.BufferedReader(f).read() == b"a\nb\nc\n\n\nd\n"
+
+
+def test_bytes_iterator_io():
+    rows = ["a,é\n", "x" * 100000 + "\n", "", "b,c\n"]
+    reader = BytesIteratorIO(iter(rows), encoding="utf-8", chunk_size=16)
+
+    chunks = []
+    while True:
+        chunk = reader.read(1000)
+        if not chunk:
+            break
+        assert len(chunk) <= 1000
+        chunks.append(chunk)
+    assert b"".join(chunks) == "".join(rows).encode("utf-8")
+
+
+def test_multiline_skip_error():
+    tablename = "multiline_skip_error"
+    asset = "tests/assets/multiline.csv"
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=True,
+        inject_rownum=True,
+    )
+
+    with open(asset + ".err", newline="") as f:
+        errors = list(csv.reader(f))
+        assert len(errors) == 2
+        assert errors[1][0] == "7"
+        assert errors[1][1].startswith("MissingFieldsException")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                "SELECT _rownum, id, name FROM {tablename}".format(tablename=tablename)
+            )
+            rows = curs.fetchall()
+            assert len(rows) == 9
+            assert rows[0] == (1, "1", "Jabber\ntype")
+            assert rows[2] == (4, "3", "Oyo\nyo\nyo")
+            assert rows[3] == (8, "5", "Link")
+
+
+def test_progress():
+    tablename = "progress"
+    asset = "tests/assets/complex_LE-LF_header_bom.csv"
+
+    for inject_rownum in (False, True):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            lineterminator="\n",
+            inject_rownum=inject_rownum,
+            progress=True,
+        )
+
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute("SELECT * FROM {tablename}".format(tablename=tablename))
+                rows = curs.fetchall()
+                assert len(rows) == 1000
+
+
+@pytest.mark.parametrize(
+    "opener, extension",
+    [(gzip.open, ".gz"), (bz2.open, ".bz2"), (lzma.open, ".xz"), (gzip.open, "")],
+)
+def test_compression(tmp_path, opener, extension):
+    tablename = "compression"
+    asset = str(tmp_path / ("error_delimiter.csv" + extension))
+    with open("tests/assets/error_delimiter.csv", "rb") as f_in:
+        with opener(asset, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=True,
+        inject_filename=True,
+        progress=True,
+    )
+
+    with open(asset + ".err") as f:
+        errors = f.readlines()
+        assert len(errors) == 3
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT * FROM {tablename}".format(tablename=tablename))
+            rows = curs.fetchall()
+            assert len(rows) == 8
+            for row in rows:
+                assert row[0] == "error_delimiter.csv" + extension
+
+
+def test_multiple_files(tmp_path):
+    tablename = "multiple_files"
+    for i in range(5):
+        shutil.copy(
+            "tests/assets/simple.csv", str(tmp_path / "simple_{}.csv".format(i))
+        )
+    # an existing file is not a pattern
+    shutil.copy("tests/assets/simple.csv", str(tmp_path / "simple[1].csv"))
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        [
+            str(tmp_path / "simple_*.csv"),
+            "tests/assets/simple.csv",
+            str(tmp_path / "simple[1].csv"),
+        ],
+        overwrite=True,
+        inject_filename=True,
+        inject_rownum=True,
+        jobs=2,
+    )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                "SELECT _filename, count(*), max(_rownum) FROM {tablename} GROUP BY 1 ORDER BY 1".format(
+                    tablename=tablename
+                )
+            )
+            rows = curs.fetchall()
+            assert rows == [("simple.csv", 10, 10), ("simple[1].csv", 10, 10)] + [
+                ("simple_{}.csv".format(i), 10, 10) for i in range(5)
+            ]
+
+
+def test_connection_reuse(tmp_path):
+    tablename = "connection_reuse"
+    for i in range(6):
+        shutil.copy(
+            "tests/assets/simple.csv", str(tmp_path / "simple_{}.csv".format(i))
+        )
+
+    # log the backend of each COPY statement
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("DROP TABLE IF EXISTS {t}, {t}_pids".format(t=tablename))
+            curs.execute("CREATE TABLE {}_pids (pid INTEGER)".format(tablename))
+            curs.execute(
+                "CREATE TABLE {} (id TEXT, name TEXT, date TEXT)".format(tablename)
+            )
+            curs.execute(
+                "CREATE OR REPLACE FUNCTION {t}_log() RETURNS trigger AS $$ BEGIN "
+                "INSERT INTO {t}_pids VALUES (pg_backend_pid()); RETURN NULL; "
+                "END $$ LANGUAGE plpgsql".format(t=tablename)
+            )
+            curs.execute(
+                "CREATE TRIGGER {t}_log AFTER INSERT ON {t} "
+                "FOR EACH STATEMENT EXECUTE FUNCTION {t}_log()".format(t=tablename)
+            )
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        str(tmp_path / "simple_*.csv"),
+        jobs=2,
+    )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                "SELECT count(*), count(DISTINCT pid) FROM {}_pids".format(tablename)
+            )
+            copies, backends = curs.fetchone()
+            curs.execute("DROP TRIGGER {t}_log ON {t}".format(t=tablename))
+            curs.execute("DROP FUNCTION {t}_log()".format(t=tablename))
+            curs.execute("DROP TABLE {t}_pids".format(t=tablename))
+            assert copies == 6
+            assert backends <= 2
+
+
+def test_multiple_files_header_mismatch():
+    with pytest.raises(WrongHeaderException):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            "header_mismatch",
+            ["tests/assets/simple.csv", "tests/assets/single_column.csv"],
+        )
+
+
+def test_infer_types():
+    tablename = "infer_types"
+    asset = "tests/assets/types.csv"
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        infer_types=True,
+    )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                "SELECT data_type FROM information_schema.columns WHERE table_name = '{tablename}' ORDER BY ordinal_position".format(
+                    tablename=tablename
+                )
+            )
+            types = [row[0] for row in curs.fetchall()]
+            assert types == [
+                "integer",
+                "numeric",
+                "bigint",
+                "date",
+                "timestamp without time zone",
+                "boolean",
+                "text",
+                "text",
+            ]
+            curs.execute("SELECT * FROM {tablename}".format(tablename=tablename))
+            rows = curs.fetchall()
+            assert len(rows) == 10
+
+
+def test_binary():
+    asset = "tests/assets/types.csv"
+
+    for tablename, binary in (("binary_csv", False), ("binary_copy", True)):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            infer_types=True,
+            inject_rownum=True,
+            inject_filename=True,
+            binary=binary,
+        )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT * FROM binary_copy")
+            rows = curs.fetchall()
+            assert len(rows) == 10
+            curs.execute("SELECT * FROM binary_copy EXCEPT SELECT * FROM binary_csv")
+            assert curs.fetchall() == []
+
+
+def test_binary_numeric(tmp_path):
+    tablename = "binary_numeric"
+    values = ["0", "-0.25", "1e3", "0.0001", "123456789.987654321", "-10000", "NaN"]
+    asset = str(tmp_path / "numeric.csv")
+    with open(asset, "w") as f:
+        f.write("value\n" + "\n".join(values) + "\n")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("DROP TABLE IF EXISTS {}".format(tablename))
+            curs.execute("CREATE TABLE {} (value NUMERIC)".format(tablename))
+
+    copy_to(HOST, PORT, DBNAME, USER, PASSWORD, tablename, asset, binary=True)
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT value::text FROM {}".format(tablename))
+            rows = [row[0] for row in curs.fetchall()]
+            curs.execute(
+                "SELECT v::numeric::text FROM unnest(%s::text[]) AS v", (values,)
+            )
+            assert rows == [row[0] for row in curs.fetchall()]
+
+
+def test_binary_null_and_timestamptz(tmp_path):
+    asset = str(tmp_path / "binary_null.csv")
+    with open(asset, "w") as f:
+        f.write(
+            "id,a,b,ts\n"
+            '1,"",,2020-01-01 10:00:00\n'
+            '2,x,"",2020-07-01T10:00:00+02:00\n'
+            '3,"a,b","",2020-01-01 10:00\n'
+            "4,,c,\n"
+        )
+
+    tables = (("binary_null_csv", False), ("binary_null_copy", True))
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            for tablename, _ in tables:
+                curs.execute("DROP TABLE IF EXISTS {}".format(tablename))
+                curs.execute(
+                    "CREATE TABLE {} (id INTEGER, a TEXT, b TEXT, ts TIMESTAMPTZ)".format(
+                        tablename
+                    )
+                )
+
+    for tablename, binary in tables:
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            connection_options={"options": "-c%20TimeZone%3DEurope%2FParis"},
+            lineterminator="\n",
+            binary=binary,
+        )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            results = []
+            for tablename, _ in tables:
+                curs.execute("SELECT * FROM {} ORDER BY id".format(tablename))
+                results.append(curs.fetchall())
+            assert results[0] == results[1]
+            assert [row[1:3] for row in results[1]] == [
+                ("", None),
+                ("x", ""),
+                ("a,b", ""),
+                (None, "c"),
+            ]
+
+
+def test_binary_skip_error(tmp_path):
+    tablename = "binary_skip_error"
+    asset = str(tmp_path / "binary_skip_error.csv")
+    with open(asset, "w") as f:
+        f.write("id,day\n1,2020-01-01\n2,not a date\n3,2020-01-03\n")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("DROP TABLE IF EXISTS {}".format(tablename))
+            curs.execute("CREATE TABLE {} (id INTEGER, day DATE)".format(tablename))
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        binary=True,
+        skip_error=True,
+    )
+
+    with open(asset + ".err") as f:
+        errors = f.readlines()
+        assert len(errors) == 2
+        assert errors[1].startswith("2,WrongFieldTypeException:1")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT id FROM {}".format(tablename))
+            assert [row[0] for row in curs.fetchall()] == [1, 3]
+
+
+DEFINITIONS_QUERY = """
+    SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+    FROM pg_constraint WHERE conrelid = %(t)s::regclass OR confrelid = %(t)s::regclass
+    UNION ALL
+    SELECT indrelid::regclass::text, indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+    FROM pg_index WHERE indrelid = %(t)s::regclass
+    ORDER BY 1, 2, 3
+"""
+
+
+def _create_indexed_table(curs, tablename):
+    curs.execute("DROP TABLE IF EXISTS {t}_child, {t}, {t}_parent".format(t=tablename))
+    curs.execute("CREATE TABLE {}_parent (code TEXT PRIMARY KEY)".format(tablename))
+    curs.execute("INSERT INTO {}_parent VALUES ('a'), ('b')".format(tablename))
+    curs.execute(
+        "CREATE TABLE {t} (id TEXT CONSTRAINT {t}_pk PRIMARY KEY, "
+        "code TEXT REFERENCES {t}_parent, label TEXT UNIQUE)".format(t=tablename)
+    )
+    curs.execute("CREATE INDEX {t}_lower ON {t} (lower(label))".format(t=tablename))
+    curs.execute("CREATE TABLE {t}_child (id TEXT REFERENCES {t})".format(t=tablename))
+    curs.execute("INSERT INTO {t} VALUES ('0', 'a', 'zero')".format(t=tablename))
+    curs.execute("INSERT INTO {t}_child VALUES ('0')".format(t=tablename))
+
+
+def test_defer_indexes(tmp_path):
+    tablename = "defer_indexes"
+    asset = str(tmp_path / "defer_indexes.csv")
+    with open(asset, "w") as f:
+        f.write("id,code,label\n")
+        for i in range(1, 1001):
+            f.write("{},{},label {}\n".format(i, "ab"[i % 2], i))
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            _create_indexed_table(curs, tablename)
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            definitions = curs.fetchall()
+            assert len(definitions) == 7
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        lineterminator="\n",
+        jobs=2,
+        defer_indexes=True,
+    )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            assert curs.fetchall() == definitions
+            curs.execute("SELECT count(*) FROM {}".format(tablename))
+            assert curs.fetchone()[0] == 1001
+            curs.execute(
+                "SELECT count(*) FROM pg_constraint WHERE NOT convalidated "
+                "AND conrelid::regclass::text LIKE %s",
+                (tablename + "%",),
+            )
+            assert curs.fetchone()[0] == 0
+
+
+def test_defer_indexes_rebuild_error(tmp_path):
+    tablename = "defer_indexes_error"
+    asset = str(tmp_path / "defer_indexes_error.csv")
+    with open(asset, "w") as f:
+        f.write("id,code,label\n0,b,duplicate\n1,c,one\n")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            _create_indexed_table(curs, tablename)
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            definitions = curs.fetchall()
+
+    with pytest.raises(IndexRebuildException) as e:
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            lineterminator="\n",
+            defer_indexes=True,
+        )
+    # the duplicated id breaks the primary key
+    assert "{}_pk".format(tablename) in str(e.value)
+
+    # the load is rolled back with the dropped definitions
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            assert curs.fetchall() == definitions
+            curs.execute("SELECT id FROM {}".format(tablename))
+            assert curs.fetchall() == [("0",)]
+
+
+def test_defer_indexes_ranges(tmp_path, caplog):
+    tablename = "defer_indexes_ranges"
+    asset = str(tmp_path / "defer_indexes_ranges.csv")
+    with open(asset, "w") as f:
+        f.write("id,code,label\n")
+        for i in range(1, 1001):
+            f.write("{},{},label {}\n".format(i, "ab"[i % 2], i))
+        f.write("0,b,duplicate\n")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            _create_indexed_table(curs, tablename)
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            definitions = curs.fetchall()
+
+    caplog.set_level(logging.INFO, logger="csv2pg")
+    with pytest.raises(IndexRebuildException) as e:
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            lineterminator="\n",
+            jobs=2,
+            defer_indexes=True,
+        )
+    # the ranges are committed in parallel, the primary key rebuilt afterwards
+    assert "USING INDEX" in caplog.text
+    assert "{}_pk".format(tablename) in str(e.value)
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT count(*) FROM {}".format(tablename))
+            assert curs.fetchone()[0] == 1002
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            restored = curs.fetchall()
+    # the primary key, and the foreign key referencing it, are not restored
+    missing = [d for d in definitions if d not in restored]
+    assert sorted(d[1] for d in missing) == [
+        "{}_child_id_fkey".format(tablename),
+        "{}_pk".format(tablename),
+        "{}_pk".format(tablename),
+    ]
+
+
+def test_defer_indexes_schema(tmp_path):
+    tablename = "defer_indexes_schema.data"
+    asset = str(tmp_path / "defer_indexes_schema.csv")
+    with open(asset, "w") as f:
+        f.write("id,label\n")
+        for i in range(1000):
+            f.write("{},label {}\n".format(i, i))
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("DROP SCHEMA IF EXISTS defer_indexes_schema CASCADE")
+            curs.execute("CREATE SCHEMA defer_indexes_schema")
+            curs.execute(
+                "CREATE TABLE {} (id TEXT PRIMARY KEY, label TEXT)".format(tablename)
+            )
+            curs.execute("CREATE INDEX ON {} (label)".format(tablename))
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            definitions = curs.fetchall()
+
+    for jobs in (1, 4):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            lineterminator="\n",
+            truncate=True,
+            defer_indexes=True,
+            jobs=jobs,
+        )
+
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+                assert curs.fetchall() == definitions
+                curs.execute("SELECT count(*) FROM {}".format(tablename))
+                assert curs.fetchone()[0] == 1000
+
+
+def test_atomic(tmp_path):
+    tablename = "atomic"
+    asset = str(tmp_path / "atomic.csv")
+    with open(asset, "w") as f:
+        f.write("id,code,label\n1,a,one\n2,b,two\n")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            _create_indexed_table(curs, tablename)
+            curs.execute("DROP TABLE {}_child".format(tablename))
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            definitions = curs.fetchall()
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        lineterminator="\n",
+        atomic=True,
+    )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            assert curs.fetchall() == definitions
+            curs.execute("SELECT id FROM {} ORDER BY id".format(tablename))
+            assert [row[0] for row in curs.fetchall()] == ["1", "2"]
+            curs.execute(
+                "SELECT relpersistence FROM pg_class WHERE oid = %s::regclass",
+                (tablename,),
+            )
+            assert curs.fetchone()[0] == "p"
+            curs.execute("SELECT to_regclass(%s)", (tablename + "_staging",))
+            assert curs.fetchone()[0] is None
+
+
+def test_atomic_typed_table(tmp_path):
+    tablename = "atomic_typed"
+    asset = str(tmp_path / "atomic_typed.csv")
+    with open(asset, "w") as f:
+        f.write(
+            "id,name,date,serial,identity\n1,a,2020-01-01,1,1\n2,b,2020-01-02,2,2\n"
+        )
+
+    columns_query = (
+        "SELECT column_name, data_type, is_nullable, column_default, is_identity "
+        "FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position"
+    )
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("DROP TABLE IF EXISTS {}".format(tablename))
+            curs.execute(
+                "CREATE TABLE {} (id INTEGER PRIMARY KEY, "
+                "name TEXT NOT NULL DEFAULT 'x', date DATE, serial SERIAL, "
+                "identity INTEGER GENERATED BY DEFAULT AS IDENTITY, "
+                "CHECK (id > 0))".format(tablename)
+            )
+            curs.execute("INSERT INTO {} (id) VALUES (1), (2), (3)".format(tablename))
+            curs.execute(columns_query, (tablename,))
+            columns = curs.fetchall()
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            definitions = curs.fetchall()
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        lineterminator="\n",
+        atomic=True,
+    )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(columns_query, (tablename,))
+            assert curs.fetchall() == columns
+            curs.execute(DEFINITIONS_QUERY, {"t": tablename})
+            assert curs.fetchall() == definitions
+            curs.execute(
+                "INSERT INTO {} (id) VALUES (4) RETURNING name, serial, identity".format(
+                    tablename
+                )
+            )
+            assert curs.fetchone() == ("x", 4, 4)
+            with pytest.raises(psycopg2.errors.CheckViolation):
+                curs.execute("INSERT INTO {} (id) VALUES (-1)".format(tablename))
+
+
+def test_atomic_error(tmp_path):
+    tablename = "atomic_error"
+    asset = str(tmp_path / "atomic_error.csv")
+    with open(asset, "w") as f:
+        f.write("id,code,label\n1,a,one\n1,b,two\n")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            _create_indexed_table(curs, tablename)
+            curs.execute("DROP TABLE {}_child".format(tablename))
+
+    with pytest.raises(IndexRebuildException):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            lineterminator="\n",
+            atomic=True,
+        )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT id FROM {}".format(tablename))
+            assert [row[0] for row in curs.fetchall()] == ["0"]
+            curs.execute("SELECT to_regclass(%s)", (tablename + "_staging",))
+            assert curs.fetchone()[0] is None
+
+
+def test_freeze():
+    asset = "tests/assets/simple.csv"
+    tables = (("copy_unfrozen", False, 0), ("copy_frozen", True, 10))
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            for tablename, _, _ in tables:
+                curs.execute("DROP TABLE IF EXISTS {}".format(tablename))
+
+    # frozen rows are visible to the snapshot of an older transaction
+    snapshot = psycopg2.connect(DSN)
+    try:
+        snapshot.set_session(isolation_level="REPEATABLE READ")
+        with snapshot.cursor() as curs:
+            curs.execute("SELECT 1")
+            for tablename, freeze, count in tables:
+                copy_to(
+                    HOST,
+                    PORT,
+                    DBNAME,
+                    USER,
+                    PASSWORD,
+                    tablename,
+                    asset,
+                    freeze=freeze,
+                )
+                curs.execute("SELECT count(*) FROM {}".format(tablename))
+                assert curs.fetchone()[0] == count
+    finally:
+        snapshot.close()
+
+
+def test_truncate():
+    tablename = "truncate"
+    asset = "tests/assets/simple.csv"
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("DROP TABLE IF EXISTS {}".format(tablename))
+            curs.execute(
+                "CREATE TABLE {} (id TEXT, name TEXT, date TEXT)".format(tablename)
+            )
+            curs.execute("CREATE INDEX {t}_id ON {t} (id)".format(t=tablename))
+            curs.execute("INSERT INTO {} VALUES ('a', 'b', 'c')".format(tablename))
+
+    for _ in range(2):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            truncate=True,
+            freeze=True,
+        )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT count(*) FROM {}".format(tablename))
+            assert curs.fetchone()[0] == 10
+            curs.execute("SELECT to_regclass(%s)", (tablename + "_id",))
+            assert curs.fetchone()[0] is not None
+
+
+def _write_chunked_csv(filepath, rows, bad_row=None):
+    with io.open(filepath, "w", newline="") as f:
+        f.write("id,name\n")
+        for i in range(rows):
+            if i == bad_row:
+                f.write("{i},name{i},extra\n".format(i=i))
+            elif i % 7 == 3:
+                f.write('{i},"multi\nline {i}"\n'.format(i=i))
+            else:
+                f.write("{i},name{i}\n".format(i=i))
+
+
+def test_stream_fifo(tmp_path):
+    tablename = "stream_fifo"
+    asset = str(tmp_path / "chunked.csv")
+    _write_chunked_csv(asset, 500, bad_row=321)
+    fifo = str(tmp_path / "fifo")
+    os.mkfifo(fifo)
+
+    def _feed():
+        with io.open(asset, "rb") as f_in, io.open(fifo, "wb") as f_out:
+            with gzip.GzipFile(fileobj=f_out, mode="wb") as f_gz:
+                shutil.copyfileobj(f_in, f_gz)
+
+    feeder = threading.Thread(target=_feed)
+    feeder.start()
+    report = copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        fifo,
+        overwrite=True,
+        skip_error=True,
+        inject_rownum=True,
+        inject_filename=True,
+        infer_types=True,
+        infer_sample=10,
+        jobs=2,
+    )
+    feeder.join()
+
+    assert report["bytes_read"] == os.path.getsize(asset)
+    with io.open(fifo + ".err") as f:
+        errors = list(csv.reader(f))
+        assert errors[1][:3] == ["368", "TooManyFieldsException:None:None", "321"]
+        assert len(errors) == 2
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                "SELECT _filename, _rownum, id, name FROM {}".format(tablename)
+            )
+            rows = curs.fetchall()
+            assert len(rows) == 499
+            assert rows[3] == ("fifo", 4, 3, "multi\nline 3")
+
+
+def test_stream_stdin(tmp_path):
+    tablename = "stream_stdin"
+    asset = str(tmp_path / "chunked.csv")
+    _write_chunked_csv(asset, 50)
+
+    with io.open(asset, "rb") as f:
+        subprocess.run(
+            [sys.executable, "-m", "csv2pg.cli", "-h", HOST, "-p", str(PORT)]
+            + ["-d", DBNAME, "-U", USER, "--overwrite", "--rownum", tablename, "-"],
+            stdin=f,
+            check=True,
+        )
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT _rownum, id, name FROM {}".format(tablename))
+            rows = curs.fetchall()
+            assert len(rows) == 50
+            assert rows[3] == (4, "3", "multi\nline 3")
+
+
+def test_commit_every(tmp_path):
+    tablename = "commit_every"
+    asset = str(tmp_path / "chunked.csv")
+    _write_chunked_csv(asset, 25)
+
+    for commit_every in ("4", "64B"):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            inject_rownum=True,
+            commit_every=commit_every,
+        )
+        assert not os.path.exists(checkpoint_path(asset))
+
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute(
+                    "SELECT _rownum, id FROM {} ORDER BY 2::int".format(tablename)
+                )
+                rows = curs.fetchall()
+                assert [row[1] for row in rows] == [str(i) for i in range(25)]
+                # the multiline records shift the line numbers
+                assert rows[-1][0] == 28
+
+
+def test_commit_every_resume(tmp_path):
+    tablename = "commit_every_resume"
+    asset = str(tmp_path / "chunked.csv")
+    _write_chunked_csv(asset, 25, bad_row=12)
+
+    options = dict(inject_rownum=True, commit_every="5", resume=True)
+    with pytest.raises(psycopg2.Error):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            **options,
+        )
+    checkpoint = read_checkpoint(asset)
+    assert checkpoint["rows"] == 9
+    assert checkpoint["chunks"] == 2
+
+    # the committed chunks are kept, the load continues after them
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=True,
+        **options,
+    )
+    assert not os.path.exists(checkpoint_path(asset))
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT _rownum, id FROM {} ORDER BY 2::int".format(tablename))
+            rows = curs.fetchall()
+            assert [row[1] for row in rows] == [str(i) for i in range(25) if i != 12]
+            assert rows[-1][0] == 28
+    with io.open(asset + ".err") as f:
+        assert f.read().count("extra") == 1
+
+
+def test_parse_commit_every():
+    assert parse_commit_every("1000") == (1000, None)
+    assert parse_commit_every("512MB") == (None, 512 * 2 ** 20)
+    assert parse_commit_every("1 kb") == (None, 1024)
+    for value in ("0", "-5", "10 rows", "1.5GB"):
+        with pytest.raises(ValueError):
+            parse_commit_every(value)
+
+
+def test_optimistic(tmp_path):
+    tablename = "optimistic"
+    asset = str(tmp_path / "error_delimiter.csv")
+    shutil.copy("tests/assets/error_delimiter.csv", asset)
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=True,
+        inject_rownum=True,
+        optimistic=True,
+    )
+
+    with open(asset + ".err") as f:
+        errors = f.readlines()
+        assert len(errors) == 3
+        assert errors[0].startswith("_rownum,_error,id,name,date")
+        assert errors[1].startswith("2,RejectedRowException")
+        assert errors[2].startswith("5,RejectedRowException")
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT _rownum, id FROM {}".format(tablename))
+            rows = curs.fetchall()
+            assert len(rows) == 8
+            assert all(rownum == int(id) for rownum, id in rows)
+
+
+def test_optimistic_unterminated_quote(tmp_path):
+    tablename = "optimistic_unterminated_quote"
+    asset = str(tmp_path / "error_unterminated_quote.csv")
+    shutil.copy("tests/assets/error_unterminated_quote.csv", asset)
+
+    results = []
+    for optimistic in (False, True):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            skip_error=True,
+            inject_rownum=True,
+            optimistic=optimistic,
+        )
+        with open(asset + ".err") as f:
+            errors = list(csv.reader(f))
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute("SELECT * FROM {} ORDER BY _rownum".format(tablename))
+                results.append((errors, curs.fetchall()))
+
+    # the same rows rejected, by the validation then by the server
+    assert results[0][1] == results[1][1]
+    assert len(results[1][1]) == 9
+    for errors in (results[0][0], results[1][0]):
+        assert [error[0] for error in errors[1:]] == ["3"]
+        assert errors[1][2:] == ["3", 'Oy"oyo', "8/13/2020"]
+    assert results[0][0][1][1].startswith("WrongFieldDialectException")
+    assert results[1][0][1][1].startswith("RejectedRowException")
+
+
+def test_optimistic_bisection(tmp_path, monkeypatch):
+    monkeypatch.setattr("csv2pg.main.OPTIMISTIC_ROWS", 4)
+    tablename = "optimistic_bisection"
+    asset = str(tmp_path / "typed.csv")
+    with io.open(asset, "w") as f:
+        f.write("id,name\n")
+        for i in range(30):
+            if i == 7:
+                f.write("x7,wrong type\n")
+            elif i == 20:
+                f.write("3,duplicate\n")
+            else:
+                f.write('{i},"name\n{i}"\n'.format(i=i))
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("DROP TABLE IF EXISTS {}".format(tablename))
+            curs.execute(
+                "CREATE TABLE {} (id INT PRIMARY KEY, name TEXT)".format(tablename)
+            )
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        skip_error=True,
+        optimistic=True,
+        commit_every="9",
+    )
+
+    with open(asset + ".err") as f:
+        errors = list(csv.reader(f))
+        assert [error[0] for error in errors[1:]] == ["15", "40"]
+        assert errors[1][1] == "RejectedRowException:0:_rownum"
+        assert errors[1][2:] == ["x7", "wrong type"]
+        assert errors[2][1] == "RejectedRowException:None:None"
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT id, name FROM {} ORDER BY id".format(tablename))
+            rows = curs.fetchall()
+            assert [row[0] for row in rows] == [
+                i for i in range(30) if i not in (7, 20)
+            ]
+            assert rows[3] == (3, "name\n3")
+
+
+@pytest.mark.parametrize("savepoints", [1000, 3])
+def test_optimistic_broken_quote(tmp_path, monkeypatch, caplog, savepoints):
+    monkeypatch.setattr("csv2pg.main.OPTIMISTIC_ROWS", 100)
+    monkeypatch.setattr("csv2pg.main.OPTIMISTIC_SAVEPOINTS", savepoints)
+    tablename = "optimistic_broken_quote"
+    asset = str(tmp_path / "broken_quote.csv")
+    _write_broken_quote(asset)
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        lineterminator="\n",
+        skip_error=True,
+        optimistic=True,
+        freeze=True,
+    )
+    assert "--freeze ignored" in caplog.text
+    assert ("validated on the client" in caplog.text) == (savepoints == 3)
+
+    with open(asset + ".err") as f:
+        errors = list(csv.reader(f))
+        assert [error[0] for error in errors[1:]] == ["5"]
+        assert errors[1][2:] == ["5", 'ab"c']
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT count(*) FROM {}".format(tablename))
+            assert curs.fetchone()[0] == 19999
+
+
+@pytest.mark.parametrize("skip_error", [False, True])
+def test_pipeline(tmp_path, caplog, skip_error):
+    tablename = "pipeline"
+    asset = str(tmp_path / "chunked.csv")
+    _write_chunked_csv(asset, 20000)
+
+    caplog.set_level("INFO", logger="csv2pg")
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=skip_error,
+        pipeline=2,
+    )
+    assert "Pipeline {}: reader".format(asset) in caplog.text
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                "SELECT count(*), count(DISTINCT id) FROM {}".format(tablename)
+            )
+            assert curs.fetchone() == (20000, 20000)
+            curs.execute("SELECT name FROM {} WHERE id = '3'".format(tablename))
+            assert curs.fetchone()[0] == "multi\nline 3"
+
+
+def test_pipeline_error():
+    with pytest.raises(psycopg2.DataError):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            "pipeline_error",
+            "tests/assets/error_delimiter.csv",
+            overwrite=True,
+            inject_rownum=True,
+            pipeline=2,
+        )
+
+
+def test_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr("csv2pg.engines.WORKER_CHUNK", 256)
+    tablename = "workers"
+    asset = str(tmp_path / "chunked.csv")
+    _write_chunked_csv(asset, 500, bad_row=321)
+
+    copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=True,
+        inject_rownum=True,
+        workers=3,
+    )
+
+    with io.open(asset + ".err") as f:
+        errors = list(csv.reader(f))
+        assert errors[0] == ["_rownum", "_error", "id", "name"]
+        assert errors[1][:3] == ["368", "TooManyFieldsException:None:None", "321"]
+        assert len(errors) == 2
+
+    with psycopg2.connect(DSN) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT _rownum, id, name FROM {}".format(tablename))
+            rows = curs.fetchall()
+            assert [int(row[1]) for row in rows] == [i for i in range(500) if i != 321]
+            assert rows[3] == (4, "3", "multi\nline 3")
+            assert rows[-1][0] == 571
+
+
+def test_engine_arrow(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr("csv2pg.engines.ARROW_CHUNK", 256)
+    asset = str(tmp_path / "chunked.csv")
+    _write_chunked_csv(asset, 500, bad_row=321)
+    with io.open(asset, "a", newline="") as f:
+        # an empty line: its chunk is checked by the csv module
+        f.write('\n500,""\n501,\n')
+
+    results = {}
+    for engine in ("stdlib", "arrow"):
+        tablename = "engine_" + engine
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            skip_error=True,
+            inject_rownum=True,
+            inject_filename=True,
+            engine=engine,
+            workers=2,
+        )
+        with io.open(asset + ".err") as f:
+            errors = list(csv.reader(f))
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute(
+                    "SELECT _filename, _rownum, id, name FROM {}".format(tablename)
+                )
+                results[engine] = errors, curs.fetchall()
+
+    errors, rows = results["arrow"]
+    assert results["arrow"] == results["stdlib"]
+    assert [error[:2] for error in errors[1:]] == [
+        ["368", "TooManyFieldsException:None:None"],
+        ["572", "MissingFieldsException:None:None"],
+    ]
+    assert rows[3] == ("chunked.csv", 4, "3", "multi\nline 3")
+    assert rows[-2:] == [
+        ("chunked.csv", 573, "500", ""),
+        ("chunked.csv", 574, "501", None),
+    ]
+
+
+@pytest.mark.parametrize("chunk", [64, 2 ** 12])
+def test_engine_arrow_rejects(tmp_path, monkeypatch, chunk):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr("csv2pg.engines.ARROW_CHUNK", chunk)
+    tablename = "engine_arrow_rejects"
+    asset = str(tmp_path / "rejects.csv")
+    with open(asset, "w", newline="") as f:
+        f.write("id,label\n")
+        for i in range(1, 2001):
+            if i % 50 == 5:
+                f.write('{},ab"c\n'.format(i))
+            elif i % 50 == 17:
+                f.write('{}, "spaced"\n'.format(i))
+            elif i % 50 == 29:
+                f.write('{},"\nline",{}\n'.format(i, i))
+            elif i % 10:
+                f.write("{},line {}\n".format(i, i))
+            else:
+                f.write('{},"multi\nline {}"\n'.format(i, i))
+
+    results = {}
+    for engine in ("stdlib", "arrow"):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            overwrite=True,
+            lineterminator="\n",
+            skip_error=True,
+            inject_rownum=True,
+            engine=engine,
+            workers=1,
+        )
+        with open(asset + ".err") as f:
+            errors = f.read()
+        with psycopg2.connect(DSN) as conn:
+            with conn.cursor() as curs:
+                curs.execute(
+                    "SELECT _rownum, id FROM {} ORDER BY _rownum".format(tablename)
+                )
+                results[engine] = errors, curs.fetchall()
+
+    assert results["arrow"] == results["stdlib"]
+    errors, rows = results["arrow"]
+    assert "\n5,WrongFieldDialectException" in errors
+    assert (18, "17") in rows
+    assert len(rows) == 2000 - 2 * 40
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_report(tmp_path, workers):
+    tablename = "report"
+    asset = str(tmp_path / "chunked.csv")
+    _write_chunked_csv(asset, 25, bad_row=12)
+    report_filepath = str(tmp_path / "report.prom")
+
+    report = copy_to(
+        HOST,
+        PORT,
+        DBNAME,
+        USER,
+        PASSWORD,
+        tablename,
+        asset,
+        overwrite=True,
+        skip_error=True,
+        inject_rownum=True,
+        workers=workers,
+        report_filepath=report_filepath,
+    )
+
+    assert report["table"] == tablename
+    assert report["bytes_read"] == os.path.getsize(asset)
+    assert report["rows_sent"] == 24
+    assert report["rows_rejected"] == {
+        "MissingFieldsException": 0,
+        "TooManyFieldsException": 1,
+        "WrongFieldDialectException": 0,
+    }
+    assert set(report["timings"]) == {
+        "connect",
+        "create_table",
+        "read",
+        "validate",
+        "inject",
+        "copy",
+    }
+    assert report["timings"]["validate"] > 0
+    assert report["wall"] >= report["timings"]["connect"]
+
+    with io.open(report_filepath) as f:
+        metrics = f.read().splitlines()
+        assert "# TYPE csv2pg_load_rows_sent gauge" in metrics
+        assert 'csv2pg_load_rows_sent{table="report"} 24' in metrics
+        assert (
+            'csv2pg_load_rows_rejected{table="report",error="TooManyFieldsException"} 1'
+            in metrics
+        )
+
+
+def test_profile(tmp_path):
+    tablename = "profile"
+    asset = str(tmp_path / "chunked.csv")
+    _write_chunked_csv(asset, 20000, bad_row=12)
+    profile = str(tmp_path / "load.prof")
+
+    with profiled(profile, interval=0.001):
+        copy_to(
+            HOST,
+            PORT,
+            DBNAME,
+            USER,
+            PASSWORD,
+            tablename,
+            asset,
+            skip_error=True,
+            inject_rownum=True,
+        )
+
+    stats = pstats.Stats(profile)
+    assert any(function == "check_record" for _, _, function in stats.stats)
+
+    with io.open(profile + COLLAPSED_SUFFIX) as f:
+        stacks = [line.rsplit(" ", 1) for line in f.read().splitlines()]
+        assert stacks
+        assert all(count.isdigit() for _, count in stacks)
+        stages = {stack.split(";", 1)[0] for stack, _ in stacks}
+        assert "validate" in stages
+        assert stages <= {
+            "connect",
+            "create_table",
+            "read",
+            "validate",
+            "inject",
+            "copy",
+            "other",
+        }